@@ -148,6 +148,10 @@ setup(
             'many_stop_words >= 0.2.0',
             'mmh3',
         ],
+        'fast_compression': [
+            'zstandard',
+            'lz4',
+        ],
     },
     entry_points={
         'console_scripts': [
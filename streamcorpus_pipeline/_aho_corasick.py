@@ -0,0 +1,94 @@
+'''Aho-Corasick multi-pattern matching over arbitrary symbol sequences.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2014 Diffeo, Inc.
+
+The automaton is symbol-agnostic: a pattern is any sequence of
+hashable symbols, so the same code matches characters inside strings
+(substring search) and whole words inside token sequences.  Building
+the automaton costs time linear in the total pattern length; scanning
+a sequence is a single pass that reports every occurrence of every
+pattern.
+'''
+from __future__ import absolute_import
+import collections
+
+
+class AhoCorasick(object):
+    '''Automaton that finds all occurrences of many patterns at once.
+
+    `patterns` is a sequence of symbol sequences.  Matches are reported
+    by pattern index, that is, the position of the pattern in
+    `patterns`.  Empty patterns cannot be located by position, so they
+    are never reported by :meth:`iter_matches`; their indexes are
+    available in :attr:`empty` for callers that need them.
+    '''
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        ## for each state, list of (pattern index, pattern length)
+        ## ending at that state, including those reached via failure
+        ## links
+        self._out = [[]]
+        self.lengths = []
+        self.empty = []
+        for idx, pattern in enumerate(patterns):
+            pattern = tuple(pattern)
+            self.lengths.append(len(pattern))
+            if not pattern:
+                self.empty.append(idx)
+                continue
+            state = 0
+            for sym in pattern:
+                nxt = self._goto[state].get(sym)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][sym] = nxt
+                state = nxt
+            self._out[state].append((idx, len(pattern)))
+        self._build_failure_links()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _build_failure_links(self):
+        ## states one symbol deep always fail back to the root, which
+        ## is their initial value; breadth-first order guarantees that
+        ## a state's failure target is finished before the state is
+        queue = collections.deque(self._goto[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for sym, nxt in self._goto[state].iteritems():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and sym not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(sym, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, sequence):
+        '''Yield ``(start, end, pattern_index)`` for every occurrence.
+
+        `start` and `end` are positions in `sequence` of the first and
+        last symbols of the match, inclusive.  Occurrences are yielded
+        in order of their end position.
+        '''
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = 0
+        for pos, sym in enumerate(sequence):
+            while state and sym not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(sym, 0)
+            for idx, length in out[state]:
+                yield pos - length + 1, pos, idx
+
+    def search(self, sequence):
+        '''Return True if any non-empty pattern occurs in `sequence`.'''
+        for _ in self.iter_matches(sequence):
+            return True
+        return False
@@ -0,0 +1,317 @@
+'''Persistent Bloom filters of stored stream IDs or doc IDs.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2016 Diffeo, Inc.
+
+Checking whether a stream item was stored already otherwise takes a
+:mod:`kvlayer` lookup per item, or a list of every ID in memory.  A
+:class:`BloomFilter` answers the same question from a fixed-size bit
+array: it never misses an ID that was added, and wrongly claims an ID
+it never saw with a probability set when the filter is created.
+
+The filter is a single file, a short header followed by the bit
+array, and is used through :mod:`mmap`, so opening even a large
+filter reads nothing until it is probed, and a filter opened for
+writing sees bits set by other processes at once.  Additions are made
+under an exclusive :func:`fcntl.flock` on the file, so several
+pipelines may add to one filter.
+
+:class:`~streamcorpus_pipeline._kvlayer.to_kvlayer` and
+:class:`~streamcorpus_pipeline._local_storage.to_local_chunks` add the
+items they write to a filter when configured with a
+`bloom_filter_path`, and the :class:`bloom_dedup` transform drops
+items already in one.
+
+.. autoclass:: BloomFilter
+   :members:
+.. autoclass:: bloom_dedup
+
+'''
+from __future__ import absolute_import, division
+import errno
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import uuid
+
+from streamcorpus_pipeline.stages import Configured
+import yakonfig
+
+logger = logging.getLogger(__name__)
+
+BLOOM_MAGIC = 'SCBLOOM1'
+## magic, bits, hash functions, capacity, keys added
+_HEADER = struct.Struct('>8sQIQQ')
+_HASHES = struct.Struct('>QQ')
+
+#: attributes of a stream item that a filter may be keyed on
+KEY_ATTRIBUTES = ('stream_id', 'doc_id')
+
+
+def bloom_parameters(capacity, error_rate):
+    '''Get the number of bits and of hash functions for a filter of
+    `capacity` keys with false positive rate `error_rate`.'''
+    if capacity < 1:
+        raise ValueError('bloom filter capacity must be positive')
+    if not 0 < error_rate < 1:
+        raise ValueError('bloom filter error rate must be between 0 and 1')
+    num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                             math.log(2) ** 2))
+    ## whole bytes
+    num_bits = (num_bits + 7) // 8 * 8
+    num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+    return num_bits, num_hashes
+
+
+class BloomFilter(object):
+    '''A Bloom filter in a file.
+
+    :param str path: file holding the filter; created if it does not
+      exist
+    :param int capacity: keys the new filter is sized for
+    :param float error_rate: false positive rate of the new filter
+      once it holds `capacity` keys
+    :param bool writable: allow :meth:`add`
+
+    `capacity` and `error_rate` only apply when the file is created;
+    an existing filter keeps its own.
+
+    '''
+    def __init__(self, path, capacity=10 ** 7, error_rate=0.001,
+                 writable=True):
+        self.path = path
+        self.writable = writable
+        if not os.path.exists(path):
+            self._create(path, capacity, error_rate)
+        self._fh = open(path, 'r+b' if writable else 'rb')
+        self._data = mmap.mmap(
+            self._fh.fileno(), 0,
+            access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        if len(self._data) < _HEADER.size:
+            self.close()
+            raise ValueError('{0!r} is not a bloom filter'.format(path))
+        (magic, self.num_bits, self.num_hashes, self.capacity,
+         _) = _HEADER.unpack_from(self._data, 0)
+        if (magic != BLOOM_MAGIC or
+                len(self._data) != _HEADER.size + self.num_bits // 8):
+            self.close()
+            raise ValueError('{0!r} is not a bloom filter'.format(path))
+
+    @staticmethod
+    def _create(path, capacity, error_rate):
+        num_bits, num_hashes = bloom_parameters(capacity, error_rate)
+        dir_path, name = os.path.split(os.path.abspath(path))
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        tmp_path = os.path.join(dir_path,
+                                '.%s.tmp-%s' % (name, uuid.uuid4().hex))
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_HEADER.pack(BLOOM_MAGIC, num_bits, num_hashes,
+                                     capacity, 0))
+                f.truncate(_HEADER.size + num_bits // 8)
+            ## another process may have created it first; keep theirs
+            try:
+                os.link(tmp_path, path)
+            except OSError, exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            else:
+                logger.info('created %d-byte bloom filter %r for %d keys '
+                            'at error rate %g', num_bits // 8, path,
+                            capacity, error_rate)
+        finally:
+            os.remove(tmp_path)
+
+    @property
+    def count(self):
+        '''Approximate number of distinct keys added.'''
+        return _HEADER.unpack_from(self._data, 0)[4]
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = _HASHES.unpack(hashlib.md5(key).digest())
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def __contains__(self, key):
+        data = self._data
+        for pos in self._positions(key):
+            if not ord(data[_HEADER.size + (pos >> 3)]) & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, keys):
+        '''Add an iterable of `keys` to the filter.
+
+        :return: number of `keys` that were not in the filter already
+
+        '''
+        if not self.writable:
+            raise IOError(errno.EBADF,
+                          '{0!r} is open read-only'.format(self.path))
+        data = self._data
+        added = 0
+        fcntl.flock(self._fh, fcntl.LOCK_EX)
+        try:
+            for key in keys:
+                new = False
+                for pos in self._positions(key):
+                    offset = _HEADER.size + (pos >> 3)
+                    byte = ord(data[offset])
+                    mask = 1 << (pos & 7)
+                    if not byte & mask:
+                        data[offset] = chr(byte | mask)
+                        new = True
+                added += new
+            if added:
+                (magic, num_bits, num_hashes, capacity,
+                 count) = _HEADER.unpack_from(data, 0)
+                data[:_HEADER.size] = _HEADER.pack(
+                    magic, num_bits, num_hashes, capacity, count + added)
+        finally:
+            fcntl.flock(self._fh, fcntl.LOCK_UN)
+        if added and self.count > self.capacity:
+            logger.warning('bloom filter %r holds %d keys, more than its '
+                           'capacity %d; its error rate is now higher',
+                           self.path, self.count, self.capacity)
+        return added
+
+    def flush(self):
+        '''Write additions through to disk.
+
+        Other processes see additions at once without this; it only
+        matters if the machine goes down.
+
+        '''
+        if self.writable:
+            self._data.flush()
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+            self._data = None
+        self._fh.close()
+
+
+def check_key(config, name, option):
+    '''Check that `config[option]`, if set, names a key attribute.'''
+    if (config.get(option) or 'stream_id') not in KEY_ATTRIBUTES:
+        raise yakonfig.ConfigurationError(
+            'invalid {0} {1} {2!r}, must be one of {3}'
+            .format(name, option, config[option], ', '.join(KEY_ATTRIBUTES)))
+
+
+class WriterBloomFilter(object):
+    '''The bloom filter a writer stage adds the items it writes to.
+
+    :param dict config: the writer's configuration, with
+      `bloom_filter_path` and optionally `bloom_key`,
+      `bloom_capacity` and `bloom_error_rate`
+
+    '''
+    def __init__(self, config):
+        self.key = config.get('bloom_key') or 'stream_id'
+        self.bloom = BloomFilter(
+            config['bloom_filter_path'],
+            capacity=config.get('bloom_capacity') or 10 ** 7,
+            error_rate=config.get('bloom_error_rate') or 0.001)
+
+    def key_of(self, si):
+        return getattr(si, self.key)
+
+    def add(self, keys):
+        '''Add `keys` from :meth:`key_of` to the filter.'''
+        added = self.bloom.add(keys)
+        self.bloom.flush()
+        logger.debug('added %d new %ss to bloom filter %r',
+                      added, self.key, self.bloom.path)
+
+
+def writer_bloom_filter(config):
+    '''Open the bloom filter configured for a writer stage, or return
+    :const:`None` if it has none.'''
+    if not config.get('bloom_filter_path'):
+        return None
+    return WriterBloomFilter(config)
+
+
+class bloom_dedup(Configured):
+    '''Transform that drops stream items already in a bloom filter.
+
+    .. code-block:: yaml
+
+        bloom_dedup:
+          bloom_filter_path: /data/stored.bloom
+          key: stream_id
+          capacity: 10000000
+          error_rate: 0.001
+          within_input: true
+
+    `bloom_filter_path` is required, and is usually the filter that
+    :class:`~streamcorpus_pipeline._kvlayer.to_kvlayer` or
+    :class:`~streamcorpus_pipeline._local_storage.to_local_chunks`
+    add to.  `key` is ``stream_id`` or ``doc_id``.  If the filter does
+    not exist it is created for `capacity` keys at `error_rate`; about
+    that fraction of new items will be dropped wrongly once it is
+    full.  With `within_input`, repeats of an item within one input
+    are dropped too, remembering the keys seen in memory until the
+    next input starts.
+
+    This stage only reads the filter.  Items are added by the writers
+    once they are stored, so an input that fails after this stage is
+    not mistaken for stored when it is retried.
+
+    '''
+    config_name = 'bloom_dedup'
+    default_config = {
+        'key': 'stream_id',
+        'capacity': 10 ** 7,
+        'error_rate': 0.001,
+        'within_input': False,
+    }
+
+    @staticmethod
+    def check_config(config, name):
+        if not config.get('bloom_filter_path'):
+            raise yakonfig.ConfigurationError(
+                '{0} requires bloom_filter_path'.format(name))
+        check_key(config, name, 'key')
+
+    def __init__(self, *args, **kwargs):
+        super(bloom_dedup, self).__init__(*args, **kwargs)
+        self.key = self.config.get('key') or 'stream_id'
+        self.within_input = self.config.get('within_input')
+        self.bloom = BloomFilter(self.config['bloom_filter_path'],
+                                 capacity=self.config.get('capacity'),
+                                 error_rate=self.config.get('error_rate'),
+                                 writable=False)
+        self._i_str = None
+        self._seen = set()
+        self.kept = 0
+        self.dropped = 0
+
+    def __call__(self, si, context):
+        key = getattr(si, self.key)
+        if key in self.bloom:
+            self.dropped += 1
+            logger.debug('bloom_dedup dropping %s %s', self.key, key)
+            return None
+        if self.within_input:
+            i_str = context.get('i_str')
+            if i_str != self._i_str:
+                self._i_str = i_str
+                self._seen = set()
+            if key in self._seen:
+                self.dropped += 1
+                logger.debug('bloom_dedup dropping repeated %s %s',
+                             self.key, key)
+                return None
+            self._seen.add(key)
+        self.kept += 1
+        return si
@@ -0,0 +1,89 @@
+'''On-disk cache of decoded S3 chunks.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2016 Diffeo, Inc.
+
+Several pipelines on one host often read the same chunks from S3, for
+instance when reprocessing a corpus with a different stage
+configuration.  :class:`ChunkCache` keeps the decrypted, uncompressed
+bytes of chunks that
+:class:`~streamcorpus_pipeline._s3_storage.from_s3_chunks` has
+downloaded, so a later read of the same object skips the download,
+:command:`gpg` and decompression.
+
+Entries are addressed by a digest of the bucket name, key name and
+ETag, so an object that is overwritten in S3 is never served stale.
+Entries are stored, shared between processes and evicted by
+:class:`~streamcorpus_pipeline._disk_cache.DiskCache`.
+
+The cache is enabled by setting ``chunk_cache_path``:
+
+.. code-block:: yaml
+
+    from_s3_chunks:
+      chunk_cache_path: /data/chunk-cache
+      chunk_cache_max_bytes: 100000000000
+
+'''
+from __future__ import absolute_import
+import hashlib
+import logging
+
+from streamcorpus_pipeline._disk_cache import DiskCache
+
+logger = logging.getLogger(__name__)
+
+#: default cap on the total size of a cache directory
+DEFAULT_MAX_BYTES = 2 ** 33
+
+
+class ChunkCache(DiskCache):
+    '''Size-capped on-disk store of decoded chunk contents.
+
+    :param str path: root directory of the cache
+    :param int max_bytes: total size of `path` above which the least
+      recently used entries are evicted
+
+    .. attribute:: hits
+    .. attribute:: misses
+    .. attribute:: evictions
+
+       Counters since this object was created.
+
+    .. attribute:: bytes_hit
+
+       Total size of the entries served from the cache.
+
+    '''
+    kind = 'chunk cache'
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        super(ChunkCache, self).__init__(path, max_bytes)
+        self.bytes_hit = 0
+
+    @classmethod
+    def from_config(cls, config):
+        '''Build a cache from stage configuration, or return
+        :const:`None` if ``chunk_cache_path`` is not set.'''
+        path = config.get('chunk_cache_path')
+        if not path:
+            return None
+        return cls(path, max_bytes=int(config.get('chunk_cache_max_bytes')
+                                       or DEFAULT_MAX_BYTES))
+
+    def key(self, bucket_name, key_name, etag):
+        '''Digest identifying one version of one S3 object.'''
+        return hashlib.sha1('\0'.join([bucket_name, key_name,
+                                       etag.strip('"')])).hexdigest()
+
+    def get(self, key):
+        '''Return the bytes stored for `key`, or :const:`None`.'''
+        data = super(ChunkCache, self).get(key)
+        if data is not None:
+            self.bytes_hit += len(data)
+        return data
+
+    def log_stats(self, level=logging.INFO):
+        logger.log(level, 'chunk cache %s: %d hits (%d bytes), %d misses, '
+                   '%d evictions', self.path, self.hits, self.bytes_hit,
+                   self.misses, self.evictions)
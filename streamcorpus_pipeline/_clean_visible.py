@@ -336,11 +336,16 @@ class clean_visible(Configured):
 
 
 def make_clean_visible_file(i_chunk, clean_visible_path):
-    '''make a temp file of clean_visible text'''
+    '''make a temp file of clean_visible text
+
+    :returns: number of FILENAME elements written
+    '''
     _clean = open(clean_visible_path, 'wb')
     _clean.write('<?xml version="1.0" encoding="UTF-8"?>')
     _clean.write('<root>')
+    count = 0
     for idx, si in enumerate(i_chunk):
+        count += 1
         if si.stream_id is None:
             # create the FILENAME element anyway, so the ordering
             # remains the same as the i_chunk and can be aligned.
@@ -374,6 +379,7 @@ def make_clean_visible_file(i_chunk, clean_visible_path):
     _clean.write('</root>')
     _clean.close()
     logger.info(clean_visible_path)
+    return count
 
     '''
     ## hack to capture html for inspection
@@ -0,0 +1,575 @@
+'''In-process streaming compression for chunk files.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+:func:`streamcorpus.compress_and_encrypt_path` runs a shell pipeline
+that writes its output to a second temporary file.  The functions
+here compress in the pipeline process instead, a block at a time, so
+a chunk is read once and its compressed form is written straight to
+its destination.  :class:`CompressedFile` is a file object that
+compresses whatever is written to it, so it can also be handed to
+:class:`streamcorpus.Chunk` as `file_obj` to compress items as they
+are added.
+
+Compression schemes are named by their file extension: ``xz``,
+``gz``, ``sz``, ``zst``, ``lz4``, or the empty string for no
+compression.  :func:`parse_file_extensions` is a version of
+:func:`streamcorpus.parse_file_extensions` that knows all of them.
+``xz`` compression can use several threads, compressing independent
+blocks that are concatenated into a multi-stream ``.xz`` file, which
+``xz``, :mod:`backports.lzma` and :class:`streamcorpus.Chunk` all
+read.  ``zst`` uses the :mod:`zstandard` library's own threads.
+
+'''
+from __future__ import absolute_import
+import collections
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import shutil
+import time
+import uuid
+import zlib
+
+try:
+    from backports import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from streamcorpus import Chunk
+from streamcorpus_pipeline._exceptions import ConfigurationError
+
+logger = logging.getLogger(__name__)
+
+#: bytes read from an input file at a time
+BLOCK_SIZE = 2 ** 20
+
+#: uncompressed bytes in each independently compressed block of
+#: multi-threaded xz output
+XZ_BLOCK_SIZE = 2 ** 23
+
+
+class _identity(object):
+    def compress(self, data):
+        return data
+
+    decompress = compress
+
+    def flush(self):
+        return ''
+
+
+class _lzma_decompressor(object):
+    '''decompresses any number of concatenated xz streams'''
+    def __init__(self):
+        self._d = lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        out = []
+        while data:
+            if self._d.eof:
+                self._d = lzma.LZMADecompressor()
+            out.append(self._d.decompress(data))
+            data = self._d.unused_data if self._d.eof else ''
+        return ''.join(out)
+
+    def flush(self):
+        return ''
+
+
+class _parallel_compressor(object):
+    '''Compress blocks of `block_size` bytes into independent streams
+    with `compress_block` on `threads` threads, and emit them in
+    order.'''
+    def __init__(self, compress_block, threads, block_size):
+        self._compress_block = compress_block
+        self._block_size = block_size
+        self._pool = ThreadPool(threads)
+        self._max_pending = 2 * threads
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffered = 0
+        self._submitted = False
+
+    def _submit(self, block):
+        self._submitted = True
+        self._pending.append(
+            self._pool.apply_async(self._compress_block, (block,)))
+
+    def compress(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        out = []
+        while self._buffered >= self._block_size:
+            data = ''.join(self._buffer)
+            self._submit(data[:self._block_size])
+            data = data[self._block_size:]
+            self._buffer = [data]
+            self._buffered = len(data)
+            ## bound the memory held by blocks in flight
+            while len(self._pending) >= self._max_pending:
+                out.append(self._pending.popleft().get())
+        while self._pending and self._pending[0].ready():
+            out.append(self._pending.popleft().get())
+        return ''.join(out)
+
+    def flush(self):
+        if self._buffered or not self._submitted:
+            self._submit(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        try:
+            return ''.join(result.get() for result in self._pending)
+        finally:
+            self._pending.clear()
+            self._pool.close()
+            self._pool.join()
+
+
+def _xz_compressor(level, threads):
+    preset = 6 if level is None else level
+    if threads > 1:
+        return _parallel_compressor(
+            lambda block: lzma.compress(block, preset=preset),
+            threads, XZ_BLOCK_SIZE)
+    return lzma.LZMACompressor(preset=preset)
+
+
+class _lz4_compressor(object):
+    def __init__(self, level):
+        self._c = lz4.frame.LZ4FrameCompressor(
+            compression_level=0 if level is None else level)
+        self._begun = False
+
+    def _begin(self):
+        if self._begun:
+            return ''
+        self._begun = True
+        return self._c.begin()
+
+    def compress(self, data):
+        if not data:
+            return ''
+        return self._begin() + self._c.compress(data)
+
+    def flush(self):
+        return self._begin() + self._c.flush()
+
+
+class _zstd_decompressor(object):
+    def __init__(self):
+        self._d = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        return self._d.decompress(data)
+
+    def flush(self):
+        return ''
+
+
+class _lz4_decompressor(object):
+    def __init__(self):
+        self._d = lz4.frame.LZ4FrameDecompressor()
+
+    def decompress(self, data):
+        return self._d.decompress(data)
+
+    def flush(self):
+        return ''
+
+
+def _zstd_compressor(level, threads):
+    return zstandard.ZstdCompressor(
+        level=3 if level is None else level,
+        threads=threads if threads > 1 else 0).compressobj()
+
+
+class _snappy_compressor(object):
+    def __init__(self):
+        self._c = snappy.StreamCompressor()
+
+    def compress(self, data):
+        if not data:
+            return ''
+        return self._c.add_chunk(data)
+
+    def flush(self):
+        return ''
+
+
+class _snappy_decompressor(object):
+    def __init__(self):
+        self._d = snappy.StreamDecompressor()
+
+    def decompress(self, data):
+        return self._d.decompress(data)
+
+    def flush(self):
+        ## raises if the stream was truncated
+        self._d.flush()
+        return ''
+
+
+class Codec(object):
+    '''A compression scheme.
+
+    :param str name: file extension, such as ``xz``
+    :param make_compressor: callable taking a compression level, or
+      :const:`None` for the scheme's default, and a number of threads,
+      and returning an object with `compress` and `flush` methods like
+      :func:`zlib.compressobj`
+    :param make_decompressor: callable returning an object with
+      `decompress` and `flush` methods
+    :param str requires: name of the Python package that provides
+      this scheme, or :const:`None` if it is always available
+
+    '''
+    def __init__(self, name, make_compressor, make_decompressor,
+                 requires=None):
+        self.name = name
+        self.make_compressor = make_compressor
+        self.make_decompressor = make_decompressor
+        self.requires = requires
+
+    @property
+    def available(self):
+        return self.make_compressor is not None
+
+    def compressor(self, level=None, threads=1):
+        return self.make_compressor(level, threads or 1)
+
+    def decompressor(self):
+        return self.make_decompressor()
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    '''Make `codec` available by name to :func:`get_codec`.'''
+    CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    '''Get the :class:`Codec` for the compression scheme `name`.
+
+    :raise streamcorpus_pipeline._exceptions.ConfigurationError:
+      if the scheme is unknown or its package is not installed
+
+    '''
+    name = name or ''
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ConfigurationError('unknown compression {0!r} (known: {1})'
+                                 .format(name, ', '.join(sorted(CODECS))))
+    if not codec.available:
+        raise ConfigurationError('{0} compression requires {1}'
+                                 .format(name, codec.requires))
+    return codec
+
+
+register_codec(Codec('', lambda level, threads: _identity(), _identity))
+register_codec(Codec(
+    'gz',
+    lambda level, threads: zlib.compressobj(6 if level is None else level,
+                                            zlib.DEFLATED,
+                                            16 + zlib.MAX_WBITS),
+    lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)))
+register_codec(Codec(
+    'xz',
+    lzma and _xz_compressor,
+    lzma and _lzma_decompressor,
+    requires='backports.lzma'))
+register_codec(Codec(
+    'sz',
+    snappy and (lambda level, threads: _snappy_compressor()),
+    snappy and _snappy_decompressor,
+    requires='python-snappy'))
+register_codec(Codec(
+    'zst',
+    zstandard and _zstd_compressor,
+    zstandard and _zstd_decompressor,
+    requires='zstandard'))
+register_codec(Codec(
+    'lz4',
+    lz4 and (lambda level, threads: _lz4_compressor(level)),
+    lz4 and _lz4_decompressor,
+    requires='lz4'))
+
+#: compression schemes that :class:`streamcorpus.Chunk` and
+#: :func:`streamcorpus.decrypt_and_uncompress` handle themselves
+STREAMCORPUS_SCHEMES = frozenset(['', 'xz', 'gz', 'sz'])
+
+
+def parse_file_extensions(path):
+    '''Split the extensions at the end of `path` into its chunk type,
+    compression scheme and encryption, any of which may be
+    :const:`None`, as in :func:`streamcorpus.parse_file_extensions`
+    but recognizing every registered compression scheme.'''
+    m = re.match(r'.*?(\.(?P<type>(fc|sc)))?'
+                 r'(\.(?P<compression>(%s)))?'
+                 r'(\.(?P<encryption>gpg))?$'
+                 % '|'.join(re.escape(name) for name in CODECS if name),
+                 path)
+    return m.group('type'), m.group('compression'), m.group('encryption')
+
+
+class CompressionStats(object):
+    '''Running totals of compression work, for logging.'''
+    def __init__(self):
+        self.files = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def add(self, bytes_in, bytes_out, seconds):
+        self.files += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.seconds += seconds
+
+    @property
+    def ratio(self):
+        '''uncompressed size divided by compressed size'''
+        if not self.bytes_out:
+            return 0.0
+        return float(self.bytes_in) / self.bytes_out
+
+    @property
+    def mb_per_sec(self):
+        '''uncompressed megabytes compressed per second'''
+        if not self.seconds:
+            return 0.0
+        return self.bytes_in / self.seconds / 2 ** 20
+
+    def __str__(self):
+        return ('%d files, %d bytes -> %d bytes (ratio %.2f) '
+                'at %.1f MB/s' % (self.files, self.bytes_in, self.bytes_out,
+                                  self.ratio, self.mb_per_sec))
+
+
+class CompressedFile(object):
+    '''Write-only file object that compresses into another file object.
+
+    :param fh: file object to write compressed data to; it is closed
+      by :meth:`close`
+    :param str compression: name of the compression scheme
+    :param int level: compression level, or :const:`None` for the
+      scheme's default
+    :param int threads: number of threads to compress with, where the
+      scheme supports it
+
+    .. attribute:: bytes_in
+    .. attribute:: bytes_out
+
+       Uncompressed bytes written so far, and compressed bytes
+       written to `fh`.
+
+    '''
+    mode = 'wb'
+
+    def __init__(self, fh, compression, level=None, threads=1):
+        self._fh = fh
+        self._compressor = get_codec(compression).compressor(level, threads)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+
+    def _emit(self, data):
+        if data:
+            self._fh.write(data)
+            self.bytes_out += len(data)
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._emit(self._compressor.compress(data))
+
+    def flush(self):
+        ## flushing the compressor would cost compression ratio, so
+        ## only flush what it has already produced
+        self._fh.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._emit(self._compressor.flush())
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def compress_file(i_path, o_path, compression, level=None, stats=None,
+                  threads=1):
+    '''Compress the file `i_path` into `o_path` in a single pass.
+
+    The output is written under a temporary name in the directory of
+    `o_path` and renamed into place, so `o_path` only ever holds a
+    complete file.
+
+    :param str compression: name of the compression scheme
+    :param int level: compression level, or :const:`None` for the
+      scheme's default
+    :param stats: :class:`CompressionStats` to add this file to
+    :param int threads: number of threads to compress with
+    :return: pair of uncompressed and compressed sizes
+
+    '''
+    start_time = time.time()
+    o_dir, o_name = os.path.split(o_path)
+    tmp_path = os.path.join(o_dir, '.%s.tmp-%s' % (o_name, uuid.uuid4().hex))
+    try:
+        with open(i_path, 'rb') as fi:
+            with CompressedFile(open(tmp_path, 'wb'), compression,
+                                level, threads) as fo:
+                shutil.copyfileobj(fi, fo, BLOCK_SIZE)
+        os.rename(tmp_path, o_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    elapsed = time.time() - start_time
+    if stats is not None:
+        stats.add(fo.bytes_in, fo.bytes_out, elapsed)
+    logger.debug('compressed %r (%d bytes) to %r (%d bytes) with %r '
+                 'in %.3f seconds', i_path, fo.bytes_in, o_path,
+                 fo.bytes_out, compression, elapsed)
+    return fo.bytes_in, fo.bytes_out
+
+
+def decompress_file(i_path, o_path, compression):
+    '''Decompress the `compression`-compressed file `i_path` into
+    `o_path`, a block at a time.'''
+    with DecompressedFile(open(i_path, 'rb'), compression) as fi:
+        with open(o_path, 'wb') as fo:
+            while True:
+                data = fi.read(BLOCK_SIZE)
+                if not data:
+                    break
+                fo.write(data)
+
+
+def decompress(data, compression):
+    '''Decompress a string of `compression`-compressed `data`.'''
+    decompressor = get_codec(compression).decompressor()
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+class DecompressedFile(object):
+    '''Read-only file object that decompresses another file object.
+
+    :param fh: file object holding compressed data; it is closed by
+      :meth:`close`
+    :param str compression: name of the compression scheme
+
+    '''
+    mode = 'rb'
+
+    def __init__(self, fh, compression):
+        self._fh = fh
+        self._decompressor = get_codec(compression).decompressor()
+        self._buffer = ''
+        self._eof = False
+
+    def _fill(self, size):
+        parts = [self._buffer]
+        have = len(self._buffer)
+        while not self._eof and (size < 0 or have < size):
+            data = self._fh.read(BLOCK_SIZE)
+            if data:
+                data = self._decompressor.decompress(data)
+            else:
+                self._eof = True
+                data = self._decompressor.flush()
+            parts.append(data)
+            have += len(data)
+        self._buffer = ''.join(parts)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_chunk(path, message=None):
+    '''Open the chunk file at `path` for reading, decompressing it
+    according to its file extension.'''
+    kwargs = {}
+    if message is not None:
+        kwargs['message'] = message
+    compression = parse_file_extensions(path)[1]
+    if compression in STREAMCORPUS_SCHEMES or compression is None:
+        return Chunk(path=path, mode='rb', **kwargs)
+    return Chunk(file_obj=DecompressedFile(open(path, 'rb'), compression),
+                 mode='rb', **kwargs)
+
+
+def benchmark(paths, schemes=None, levels=(None,), threads=1):
+    '''Compress each chunk file in `paths` with each compression
+    scheme and level.
+
+    Compressed files may themselves be any compression scheme; they
+    are decompressed first.  Returns a list of ``(scheme, level,
+    stats)`` tuples, where `stats` is a :class:`CompressionStats`
+    that also records decompression time as `decompress_seconds`.
+
+    '''
+    datas = []
+    for path in paths:
+        compression = parse_file_extensions(path)[1]
+        with open(path, 'rb') as f:
+            datas.append(decompress(f.read(), compression or ''))
+    if schemes is None:
+        schemes = sorted(name for name, codec in CODECS.iteritems()
+                         if name and codec.available)
+    results = []
+    for scheme in schemes:
+        codec = get_codec(scheme)
+        for level in levels:
+            stats = CompressionStats()
+            stats.decompress_seconds = 0.0
+            for data in datas:
+                start_time = time.time()
+                compressor = codec.compressor(level, threads)
+                compressed = compressor.compress(data) + compressor.flush()
+                stats.add(len(data), len(compressed),
+                          time.time() - start_time)
+                start_time = time.time()
+                assert decompress(compressed, scheme) == data
+                stats.decompress_seconds += time.time() - start_time
+            logger.info('%s level %r: %s', scheme, level, stats)
+            results.append((scheme, level, stats))
+    return results
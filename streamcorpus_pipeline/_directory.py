@@ -91,8 +91,7 @@ import dblogger
 import kvlayer
 import coordinate
 import streamcorpus_pipeline
-from streamcorpus_pipeline._coordinate import coordinate_run_function
-from streamcorpus_pipeline.run import SimpleWorkUnit
+from streamcorpus_pipeline.run import make_pipeline, process_inputs
 import yakonfig
 
 logging.basicConfig()
@@ -207,11 +206,10 @@ def main():
             count += len(chunk)
             print('loaded %d of %d WorkUnits' % (count, len(fnames)))
     elif scdconfig['engine'] == 'standalone':
-        for filename in get_filenames():
-            u = SimpleWorkUnit(filename)
-            u.spec = work_spec
-            u.data = v
-            coordinate_run_function(u)
+        ## one pipeline for all of the files, so that its reader can
+        ## prefetch the ones coming up
+        pipeline = make_pipeline(gconfig['streamcorpus_pipeline'])
+        process_inputs(pipeline, get_filenames())
 
 if __name__ == '__main__':
     main()
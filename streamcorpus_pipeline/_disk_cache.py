@@ -0,0 +1,151 @@
+'''Size-capped on-disk caches shared between processes.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2016 Diffeo, Inc.
+
+:class:`DiskCache` is the store under
+:class:`~streamcorpus_pipeline._chunk_cache.ChunkCache` and
+:class:`~streamcorpus_pipeline._tagger_cache.TaggerCache`.  Each entry
+is one file named by a hex digest key.  Entries are written to a
+temporary name and renamed into place, so readers only ever see
+complete entries, and several processes may share one cache
+directory.  When the directory grows past its size cap, the least
+recently used entries are removed by whichever process holds the
+directory's lock file; an entry removed while another process is
+reading it stays readable through the open file.
+
+'''
+from __future__ import absolute_import
+import errno
+import fcntl
+import logging
+import os
+import uuid
+
+logger = logging.getLogger(__name__)
+
+#: name of the lock file held while evicting
+LOCK_NAME = '.lock'
+
+#: prefix of entries still being written
+TMP_PREFIX = '.tmp-'
+
+
+class DiskCache(object):
+    '''Size-capped on-disk store of byte strings.
+
+    :param str path: root directory of the cache
+    :param int max_bytes: total size of `path` above which the least
+      recently used entries are evicted
+
+    .. attribute:: hits
+    .. attribute:: misses
+    .. attribute:: evictions
+
+       Counters since this object was created.
+
+    '''
+    kind = 'disk cache'
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._total_bytes = None
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        '''Return the bytes stored for `key`, or :const:`None`.'''
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            self.misses += 1
+            return None
+        ## mark as recently used for eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        '''Store `data` for `key`, evicting if the cache is over its
+        size cap.'''
+        path = self._entry_path(key)
+        dir_path = os.path.dirname(path)
+        try:
+            os.makedirs(dir_path)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        tmp_path = os.path.join(dir_path, TMP_PREFIX + uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+        if self._total_bytes is None:
+            self._total_bytes = self._scan_total_bytes()
+        else:
+            self._total_bytes += len(data)
+        if self._total_bytes > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            for name in file_names:
+                if name == LOCK_NAME or name.startswith(TMP_PREFIX):
+                    continue
+                path = os.path.join(dir_path, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    ## removed by a concurrent eviction
+                    continue
+                ## get() touches the mtime, so this is last use
+                yield st.st_mtime, st.st_size, path
+
+    def _scan_total_bytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        '''Remove least recently used entries until the cache is at
+        most 90% of its size cap.
+
+        Only one process evicts at a time; if another holds the lock,
+        this returns at once and leaves the work to it.
+
+        '''
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, LOCK_NAME), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, exc:
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                self._total_bytes = None
+                return
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    self.evictions += 1
+                except OSError:
+                    pass
+                total -= size
+        self._total_bytes = total
+        logger.debug('%s %s evicted down to %d bytes',
+                     self.kind, self.path, total)
@@ -0,0 +1,177 @@
+'''Kernel-assisted file copies for moving output across file systems.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2016 Diffeo, Inc.
+
+When the temporary directory and the output directory are on
+different file systems, finished chunks and tarballs cannot simply be
+renamed into place.  :func:`copy_file` copies them with the Linux
+``copy_file_range(2)`` system call, which lets the file system (or an
+NFS server) copy without the data passing through this process, and
+falls back to ``sendfile(2)``, which at least keeps the copy in the
+kernel, and then to an ordinary read/write loop.  Python 2 has
+neither call in :mod:`os`, so they are reached through :mod:`ctypes`.
+
+:func:`move_file` builds a crash-safe cross-device move on top of
+this: the copy is written under a temporary name in the target
+directory, flushed to disk, and renamed over the target, so the
+target path only ever names a complete file.
+
+'''
+from __future__ import absolute_import
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import shutil
+import uuid
+
+from streamcorpus_pipeline._compression import BLOCK_SIZE
+
+logger = logging.getLogger(__name__)
+
+#: most bytes asked of the kernel in one call
+MAX_CALL_BYTES = 2 ** 30
+
+#: errors meaning a copy method does not work for this pair of files
+_UNSUPPORTED = frozenset([errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                          errno.EOPNOTSUPP, errno.EBADF])
+
+
+def _libc_function(name, restype, argtypes):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+_copy_file_range = _libc_function(
+    'copy_file_range', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+     ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _libc_function(
+    'sendfile', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _kernel_copy(call, fd_in, fd_out, size):
+    '''copy `size` bytes with `call(fd_in, fd_out, count)`, which
+    moves up to `count` bytes from the current offset of `fd_in` to
+    that of `fd_out`
+
+    Some file systems return 0 from the very first call for files they
+    cannot copy this way, which is treated as unsupported; running out
+    of data after copying some raises :exc:`IOError`.
+
+    '''
+    copied = 0
+    while copied < size:
+        n = call(fd_in, fd_out, min(size - copied, MAX_CALL_BYTES))
+        if n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if copied == 0 and err in _UNSUPPORTED:
+                raise _Unsupported()
+            raise OSError(err, os.strerror(err))
+        if n == 0:
+            if copied == 0:
+                raise _Unsupported()
+            raise IOError(errno.EIO, 'copied only {0} of {1} bytes'
+                          .format(copied, size))
+        copied += n
+    return copied
+
+
+def _copy_file_range_method(fd_in, fd_out, size):
+    return _kernel_copy(
+        lambda i, o, count: _copy_file_range(i, None, o, None, count, 0),
+        fd_in, fd_out, size)
+
+
+def _sendfile_method(fd_in, fd_out, size):
+    return _kernel_copy(
+        lambda i, o, count: _sendfile(o, i, None, count),
+        fd_in, fd_out, size)
+
+
+def copy_file(src, dst):
+    '''Copy the contents and permission bits of `src` to `dst`, as
+    :func:`shutil.copy2` would, and flush `dst` to disk.
+
+    :return: name of the method that did the copy: one of
+      ``copy_file_range``, ``sendfile`` or ``read``
+
+    '''
+    with open(src, 'rb') as fi:
+        with open(dst, 'wb') as fo:
+            size = os.fstat(fi.fileno()).st_size
+            method = None
+            for name, func, available in [
+                    ('copy_file_range', _copy_file_range_method,
+                     _copy_file_range is not None),
+                    ('sendfile', _sendfile_method, _sendfile is not None)]:
+                if not available:
+                    continue
+                try:
+                    func(fi.fileno(), fo.fileno(), size)
+                    method = name
+                    break
+                except _Unsupported:
+                    logger.debug('%s cannot copy %r to %r', name, src, dst)
+            if method is None:
+                shutil.copyfileobj(fi, fo, BLOCK_SIZE)
+                method = 'read'
+                if fo.tell() != size:
+                    raise IOError(errno.EIO, 'copied only {0} of {1} bytes'
+                                  .format(fo.tell(), size))
+            fo.flush()
+            os.fsync(fo.fileno())
+    shutil.copystat(src, dst)
+    return method
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        ## not all file systems allow this
+        pass
+    finally:
+        os.close(fd)
+
+
+def move_file(src, dst):
+    '''Move `src` to `dst`, which may be on another file system.
+
+    The copy is made under a temporary name next to `dst`, flushed to
+    disk, and renamed to `dst`; only then is `src` removed.
+
+    '''
+    o_dir, o_name = os.path.split(os.path.abspath(dst))
+    tmp_path = os.path.join(o_dir, '.%s.tmp-%s' % (o_name, uuid.uuid4().hex))
+    try:
+        method = copy_file(src, tmp_path)
+        os.rename(tmp_path, dst)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_dir(o_dir)
+    logger.debug('moved %r to %r with %s', src, dst, method)
+    try:
+        os.remove(src)
+    except OSError:
+        logger.critical('ignoring failure to os.remove(%r)', src)
@@ -17,10 +17,13 @@ logger = logging.getLogger(__name__)
 is_hex_32 = re.compile('[a-fA-F0-9]{32}')
 
 def get_name_info(chunk_path, assert_one_date_hour=False, i_str=None,
-                  chunk_type=Chunk):
+                  chunk_type=Chunk, key_attr=None):
     '''
     takes a chunk blob and obtains the date_hour, md5, num
 
+    if key_attr is set, also lists that attribute of every stream
+    item, in order, as keys, in the same pass over the chunk
+
     makes fields:
     i_str
     input_fname
@@ -35,6 +38,7 @@ def get_name_info(chunk_path, assert_one_date_hour=False, i_str=None,
     date_now
     time_now
     date_time_now
+    keys (only with key_attr)
     '''
     assert i_str is not None, 'must provide i_str as keyword arg'
 
@@ -63,8 +67,11 @@ def get_name_info(chunk_path, assert_one_date_hour=False, i_str=None,
     doc_ids = set()
     epoch_ticks = None
     count = 0
+    keys = []
     try:
         for si in ch:
+            if key_attr is not None:
+                keys.append(getattr(si, key_attr))
             if chunk_type is Chunk:
                 if epoch_ticks is None:
                     epoch_ticks = si.stream_time.epoch_ticks
@@ -91,6 +98,8 @@ def get_name_info(chunk_path, assert_one_date_hour=False, i_str=None,
             name_info['md5'] = 'broken'
     name_info['num'] = count
     name_info['epoch_ticks'] = epoch_ticks
+    if key_attr is not None:
+        name_info['keys'] = keys
 
     name_info['target_names'] = '-'.join( target_names )
     name_info['doc_ids_8'] = '-'.join( [di[:8] for di in doc_ids] )
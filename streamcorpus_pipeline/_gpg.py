@@ -0,0 +1,292 @@
+'''Streaming :command:`gpg` encryption and decryption.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2016 Diffeo, Inc.
+
+:func:`streamcorpus.decrypt_and_uncompress` hands :command:`gpg` the
+whole chunk in memory and gets the whole result back, and
+:func:`streamcorpus.compress_and_encrypt_path` runs a shell pipeline
+into another temporary file.  The file objects here instead run
+:command:`gpg` as a filter between two file objects, pumping a block
+at a time through its pipes, so they can be stacked with
+:class:`~streamcorpus_pipeline._compression.CompressedFile` and
+:class:`~streamcorpus_pipeline._compression.DecompressedFile` and with
+the S3 readers and writers, and memory use does not grow with the
+size of the chunk.  The only files written are the key ring that
+:command:`gpg` imports the key into, in a private directory that is
+removed on :meth:`close`.
+
+:func:`open_decoded` builds the stack for reading a chunk with a
+given compression scheme and key, and :func:`encode_file` writes one.
+
+'''
+from __future__ import absolute_import
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from streamcorpus_pipeline._compression import BLOCK_SIZE, \
+    CompressedFile, DecompressedFile
+from streamcorpus_pipeline._exceptions import FailedExtraction
+
+logger = logging.getLogger(__name__)
+
+_GPG = ['gpg', '--batch', '--quiet', '--no-permission-warning']
+
+
+class _GpgFilter(object):
+    ''':command:`gpg` process with an imported key, filtering stdin to
+    stdout.'''
+    def __init__(self, key_path, args, tmp_dir=None):
+        self._home = tempfile.mkdtemp(prefix='tmp-gpg-', dir=tmp_dir)
+        try:
+            child = subprocess.Popen(
+                _GPG + ['--homedir', self._home, '--import', key_path],
+                stderr=subprocess.PIPE)
+            s_out, errors = child.communicate()
+            if child.returncode != 0:
+                raise FailedExtraction('gpg could not import {0!r}: {1}'
+                                       .format(key_path, errors))
+            ## ascii armoring is off by default, and --output - must
+            ## come before the command
+            self._proc = subprocess.Popen(
+                _GPG + ['--homedir', self._home, '--trust-model', 'always',
+                        '--output', '-'] + args + ['-'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        except:
+            self._remove_home()
+            raise
+        self._stderr = []
+        self._failure = None
+        self._threads = []
+        self._start(self._read_stderr)
+        self.finished = False
+
+    def _start(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _read_stderr(self):
+        self._stderr.append(self._proc.stderr.read())
+
+    def _fail(self, exc):
+        if self._failure is None:
+            self._failure = exc
+
+    def _finish(self):
+        '''wait for :command:`gpg` to exit, and raise if it or a pump
+        thread failed'''
+        if self.finished:
+            return
+        self.finished = True
+        self._proc.wait()
+        for thread in self._threads:
+            thread.join()
+        self._remove_home()
+        errors = ''.join(self._stderr)
+        if self._failure is not None:
+            raise self._failure
+        if self._proc.returncode != 0:
+            raise FailedExtraction('gpg exited with status {0}: {1}'
+                                   .format(self._proc.returncode, errors))
+        if errors:
+            logger.debug('gpg logs to stderr:\n%s', errors)
+
+    def _kill(self):
+        if self.finished:
+            return
+        self.finished = True
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        self._remove_home()
+
+    def _remove_home(self):
+        if os.path.exists(os.path.join(self._home, 'S.gpg-agent')):
+            ## importing a secret key starts an agent in the key ring
+            try:
+                subprocess.call(['gpgconf', '--homedir', self._home,
+                                 '--kill', 'gpg-agent'])
+            except OSError:
+                pass
+        shutil.rmtree(self._home, ignore_errors=True)
+
+
+class DecryptedFile(_GpgFilter):
+    '''Read-only file object that decrypts another file object.
+
+    :param fh: file object holding encrypted data; it is closed by
+      :meth:`close`
+    :param str gpg_private: path to the private key to decrypt with
+    :param str tmp_dir: directory for the key ring
+    :raise streamcorpus_pipeline._exceptions.FailedExtraction: from
+      :meth:`read` at the end of the data, if :command:`gpg` fails
+
+    '''
+    mode = 'rb'
+
+    def __init__(self, fh, gpg_private, tmp_dir=None):
+        self._fh = fh
+        super(DecryptedFile, self).__init__(gpg_private, ['--decrypt'],
+                                            tmp_dir)
+        self._start(self._feed)
+
+    def _feed(self):
+        try:
+            while True:
+                data = self._fh.read(BLOCK_SIZE)
+                if not data:
+                    break
+                self._proc.stdin.write(data)
+        except Exception, exc:
+            ## including gpg exiting early, which it reports itself
+            self._fail(exc)
+        finally:
+            try:
+                self._proc.stdin.close()
+            except IOError:
+                pass
+
+    def read(self, size=-1):
+        data = self._proc.stdout.read(size)
+        if not data and size != 0:
+            self._finish()
+        elif size < 0:
+            self._finish()
+        return data
+
+    def close(self):
+        self._kill()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class EncryptedFile(_GpgFilter):
+    '''Write-only file object that encrypts into another file object.
+
+    :param fh: file object to write encrypted data to; it is closed by
+      :meth:`close`
+    :param str gpg_public: path to the public key to encrypt with
+    :param str gpg_recipient: name of the key's owner
+    :param str tmp_dir: directory for the key ring
+    :raise streamcorpus_pipeline._exceptions.FailedExtraction: from
+      :meth:`close`, if :command:`gpg` fails
+
+    .. attribute:: bytes_out
+
+       Encrypted bytes written to `fh`.
+
+    '''
+    mode = 'wb'
+
+    def __init__(self, fh, gpg_public, gpg_recipient='trec-kba',
+                 tmp_dir=None):
+        self._fh = fh
+        self.bytes_out = 0
+        self.closed = False
+        ## the data is normally compressed already
+        super(EncryptedFile, self).__init__(
+            gpg_public, ['-r', gpg_recipient, '-z', '0', '--encrypt'],
+            tmp_dir)
+        self._start(self._drain)
+
+    def _drain(self):
+        try:
+            while True:
+                data = self._proc.stdout.read(BLOCK_SIZE)
+                if not data:
+                    break
+                self._fh.write(data)
+                self.bytes_out += len(data)
+        except Exception, exc:
+            self._fail(exc)
+            ## let gpg see a broken pipe rather than block
+            self._proc.stdout.close()
+
+    def write(self, data):
+        try:
+            self._proc.stdin.write(data)
+        except IOError:
+            ## gpg or the drain thread gave up; say why
+            self._finish()
+            raise
+
+    def flush(self):
+        ## gpg emits packets as it pleases
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._proc.stdin.close()
+            self._finish()
+        except:
+            self._kill()
+            raise
+        self._fh.close()
+
+    def abort(self):
+        '''Stop encrypting, without closing the underlying file.'''
+        self.closed = True
+        self._kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def open_decoded(fh, compression, gpg_private=None, tmp_dir=None):
+    '''Wrap `fh`, holding a chunk compressed with `compression` and
+    encrypted to `gpg_private` if that is not :const:`None`, in a file
+    object that reads the plain chunk.'''
+    if gpg_private is not None:
+        fh = DecryptedFile(fh, gpg_private, tmp_dir=tmp_dir)
+    return DecompressedFile(fh, compression or '')
+
+
+def encode_file(i_path, o_path, compression, gpg_public,
+                gpg_recipient='trec-kba', level=None, threads=1,
+                tmp_dir=None):
+    '''Compress the file `i_path` with `compression` and encrypt it to
+    `gpg_public`, into `o_path`, in a single pass.
+
+    :return: pair of the sizes of `i_path` and of the compressed and
+      encrypted `o_path`
+
+    '''
+    try:
+        with open(o_path, 'wb') as raw:
+            encrypted = EncryptedFile(raw, gpg_public, gpg_recipient,
+                                      tmp_dir=tmp_dir)
+            try:
+                fo = CompressedFile(encrypted, compression or '',
+                                    level, threads)
+                with open(i_path, 'rb') as fi:
+                    shutil.copyfileobj(fi, fo, BLOCK_SIZE)
+                fo.close()
+            except:
+                encrypted.abort()
+                raise
+    except:
+        if os.path.exists(o_path):
+            os.remove(o_path)
+        raise
+    return fo.bytes_in, encrypted.bytes_out
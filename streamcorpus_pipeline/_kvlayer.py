@@ -9,12 +9,22 @@
 '''
 from __future__ import absolute_import
 import base64
+import collections
+import itertools
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
 import re
 import struct
+import sys
+import threading
+import time
 
 import kvlayer
 import streamcorpus
+from streamcorpus_pipeline._bloom import check_key, writer_bloom_filter
 from streamcorpus_pipeline.stages import Configured
 from streamcorpus_pipeline._kvlayer_table_names import \
     BY_TIME, WITH_SOURCE, KEYWORDS, HASH_TF_SID, HASH_FREQUENCY, \
@@ -61,15 +71,57 @@ class from_kvlayer(Configured):
     Typically this reads stream items previously written by
     :class:`to_kvlayer`.
 
-    The input string is a sequence of stream IDs; see :meth:`__call__`
-    for details.  If no values are specified, scans the entire
+    The input string is a sequence of stream IDs, or a query on the
+    time and source indexes that :class:`to_kvlayer` writes; see
+    :meth:`__call__` for details.  If no values are specified, scans
+    the entire
     :data:`~streamcorpus_pipeline._kvlayer_table_names.STREAM_ITEMS_TABLE`
     table.
 
+    Runs of single stream IDs are fetched `get_batch_size` at a time
+    in one :meth:`kvlayer.AbstractStorage.get` call each.  If
+    `num_workers` is more than 1, stored stream items are decrypted
+    and decompressed on a pool of that many processes, started when
+    first needed and kept until :meth:`shutdown`: each batch of
+    fetched keys, and batches of `get_batch_size` rows from range
+    scans, decoded while the scan goes on fetching with at most two
+    batches per worker outstanding for each range.  Deserializing
+    stays in the pipeline process, so stream item objects are not
+    pickled.  The default, 1, decodes everything in the pipeline
+    process.  Either way stream items are yielded in order, and ones
+    in a range scan that fail to decompress are logged and skipped.
+
+    .. code-block:: yaml
+
+        from_kvlayer:
+          get_batch_size: 100
+          num_workers: 4
+          scan_threads: 8
+          scan_splits: 32
+          scan_buffer: 100
+
+    If `scan_threads` is more than 0, a scan of the whole table is
+    split into `scan_splits` contiguous key ranges with
+    :func:`split_key_space`, by default 4 per thread, which are
+    scanned on that many threads.  Stream items are still yielded in
+    key order; each thread reads at most `scan_buffer` stream items
+    ahead.  The :mod:`kvlayer` backend must then allow its client to
+    be used from several threads.  To spread a whole-table scan
+    across machines instead, submit the ranges from
+    :func:`key_space_work_units` as separate inputs.
+
     .. automethod:: __call__
+    .. automethod:: shutdown
 
     '''
     config_name = 'from_kvlayer'
+    default_config = {
+        'get_batch_size': 100,
+        'num_workers': 1,
+        'scan_threads': 0,
+        'scan_splits': None,
+        'scan_buffer': 100,
+    }
 
     @staticmethod
     def check_config(config, name):
@@ -80,25 +132,228 @@ class from_kvlayer(Configured):
         self.client = kvlayer.client()
         self.client.setup_namespace(STREAM_ITEM_TABLE_DEFS,
                                     STREAM_ITEM_VALUE_DEFS)
+        self.get_batch_size = self.config.get('get_batch_size') or 100
+        self.num_workers = self.config.get('num_workers') or 1
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.scan_threads = self.config.get('scan_threads') or 0
+        self.scan_splits = (self.config.get('scan_splits') or
+                            4 * self.scan_threads)
+        self.scan_buffer = self.config.get('scan_buffer') or 100
+        self.index_stats = {}
+
+    def _get_pool(self):
+        '''the pool of `num_workers` processes, started on first use'''
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.num_workers)
+            return self._pool
+
+    def shutdown(self):
+        '''Stop the decompression worker processes, if any.'''
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+    def _decompress(self, datas):
+        '''decrypt and decompress each of `datas`, returning a list of
+        ``(errors, data)`` in the same order'''
+        if self.num_workers <= 1 or len(datas) <= 1:
+            return _decompress_batch(datas)
+        ## contiguous slices, so the results come back in order
+        size = -(-len(datas) // self.num_workers)
+        results = self._get_pool().map(
+            _decompress_batch,
+            [datas[i:i + size] for i in xrange(0, len(datas), size)])
+        return [result for batch in results for result in batch]
 
     def _loadkey(self, k):
-        key, data = iter_one_or_ex(self.client.get(STREAM_ITEMS_TABLE, k))
-        errors, data = streamcorpus.decrypt_and_uncompress(data)
-        if errors:
-            if not isinstance(errors, Exception):
-                errors = Exception(repr(errors))
-            raise errors
-        yield streamcorpus.deserialize(data)
+        return self._loadkeys([k])
+
+    def _loadkeys(self, keys, missing_ok=False):
+        '''yield the stream items for `keys`, in order, fetching them
+        in one request; keys that are not present raise
+        :exc:`KeyError`, or with `missing_ok` are skipped'''
+        datas = get_many(self.client, STREAM_ITEMS_TABLE, keys)
+        if None in datas:
+            missing = [kvlayer_key_to_stream_id(key)
+                       for key, data in zip(keys, datas) if data is None]
+            if not missing_ok:
+                raise KeyError(missing[0])
+            logger.warning('index names missing stream items %s',
+                           ', '.join(missing))
+            datas = [data for data in datas if data is not None]
+        for errors, data in self._decompress(datas):
+            if errors:
+                if not isinstance(errors, Exception):
+                    errors = Exception(repr(errors))
+                raise errors
+            yield streamcorpus.deserialize(data)
+
+    def _decompressed(self, rows):
+        '''yield ``(key, errors, data)`` for each ``(key, data)`` in
+        `rows`, in order, decompressing on the worker pool while more
+        rows are read'''
+        pool = self._get_pool()
+        pending = collections.deque()
+
+        def finished(limit):
+            while len(pending) > limit:
+                keys, result = pending.popleft()
+                for key, (errors, data) in zip(keys, result.get()):
+                    yield key, errors, data
+
+        while True:
+            batch = list(itertools.islice(rows, self.get_batch_size))
+            if not batch:
+                break
+            pending.append(([key for key, _ in batch], pool.apply_async(
+                _decompress_batch, ([data for _, data in batch],))))
+            for decompressed in finished(2 * self.num_workers - 1):
+                yield decompressed
+        for decompressed in finished(0):
+            yield decompressed
 
     def _loadrange(self, keya, keyb):
-        for key, data in self.client.scan(STREAM_ITEMS_TABLE, (keya, keyb)):
-            errors, data = streamcorpus.decrypt_and_uncompress(data)
+        if keya is not None and tuple(keya) == FIRST_SI_KEY:
+            keya = None
+        if keyb is not None and tuple(keyb) == LAST_SI_KEY:
+            keyb = None
+        rows = iter(self.client.scan(STREAM_ITEMS_TABLE, (keya, keyb)))
+        if self.num_workers > 1:
+            decompressed = self._decompressed(rows)
+        else:
+            decompressed = ((key,) + streamcorpus.decrypt_and_uncompress(data)
+                            for key, data in rows)
+        for key, errors, data in decompressed:
             if errors:
                 logger.error('could not decrypet_and_uncompress %s: %s',
                              key, errors)
                 continue
             yield streamcorpus.deserialize(data)
 
+    def _scan_ranges(self, ranges):
+        '''yield the stream items in each of `ranges` in turn, scanning
+        them on `scan_threads` threads'''
+        queues = [Queue.Queue(self.scan_buffer) for _ in ranges]
+        ## ranges are claimed in order, so the one being yielded from
+        ## always has a thread, and the others only read ahead
+        todo = Queue.Queue()
+        for i in xrange(len(ranges)):
+            todo.put(i)
+        stop = threading.Event()
+
+        def send(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def scan():
+            while not stop.is_set():
+                try:
+                    i = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    for si in self._loadrange(*ranges[i]):
+                        if not send(queues[i], (si, None)):
+                            return
+                except Exception:
+                    send(queues[i], (None, sys.exc_info()))
+                    return
+                send(queues[i], (None, None))
+
+        threads = []
+        for _ in xrange(min(self.scan_threads, len(ranges))):
+            thread = threading.Thread(target=scan)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for q in queues:
+                while True:
+                    si, exc_info = q.get()
+                    if exc_info is not None:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    if si is None:
+                        break
+                    yield si
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _count_index(self, table_name, scanned=0, matched=0):
+        stats = self.index_stats.setdefault(table_name,
+                                            {'scanned': 0, 'matched': 0})
+        stats['scanned'] += scanned
+        stats['matched'] += matched
+
+    def _time_index_keys(self, start, end):
+        '''yield the stream item keys with stream times from `start`
+        up to but not including `end`, either of which may be
+        :const:`None`, from the time index'''
+        keya = None if start is None else (start,)
+        keyb = None if end is None else (end - 1,)
+        for epoch_ticks, doc_id in self.client.scan_keys(
+                STREAM_ITEMS_TIME_INDEX, (keya, keyb)):
+            self._count_index(STREAM_ITEMS_TIME_INDEX, 1, 1)
+            yield doc_id, epoch_ticks
+
+    def _source_index_keys(self, sources, keys=None):
+        '''yield the stream item keys whose source is in `sources`,
+        scanning the whole source index or looking up only `keys`'''
+        if keys is None:
+            for key, source in self.client.scan(STREAM_ITEMS_SOURCE_INDEX):
+                matched = source in sources
+                self._count_index(STREAM_ITEMS_SOURCE_INDEX, 1, matched)
+                if matched:
+                    yield key
+            return
+        keys = iter(keys)
+        while True:
+            batch = list(itertools.islice(keys, self.get_batch_size))
+            if not batch:
+                return
+            for key, source in zip(batch, get_many(
+                    self.client, STREAM_ITEMS_SOURCE_INDEX, batch)):
+                matched = source in sources
+                self._count_index(STREAM_ITEMS_SOURCE_INDEX, 1, matched)
+                if matched:
+                    yield key
+
+    def _loadquery(self, query):
+        '''yield the stream items matching an index query from
+        :func:`parse_index_query`'''
+        self.index_stats = {}
+        keys = None
+        if query['time'] is not None:
+            keys = self._time_index_keys(*query['time'])
+        if query['sources'] is not None:
+            keys = self._source_index_keys(query['sources'], keys)
+        fetched = 0
+        while True:
+            batch = list(itertools.islice(keys, self.get_batch_size))
+            if not batch:
+                break
+            for si in self._loadkeys(batch, missing_ok=True):
+                fetched += 1
+                yield si
+        for table_name in (STREAM_ITEMS_TIME_INDEX, STREAM_ITEMS_SOURCE_INDEX):
+            stats = self.index_stats.get(table_name)
+            if stats is not None:
+                logger.info('%s index: %d of %d entries matched (%.1f%%)',
+                            table_name, stats['matched'], stats['scanned'],
+                            100.0 * stats['matched'] /
+                            max(stats['scanned'], 1))
+        logger.info('fetched %d stream items for index query', fetched)
+
     def __call__(self, i_str):
         '''Actually scan the table, yielding stream items.
 
@@ -110,19 +365,116 @@ class from_kvlayer(Configured):
         encoded stream ID to specify a range of documents; or a list
         of either of the preceding separated by literal ``;``.
 
+        `i_str` can instead be a query on the indexes written by
+        :class:`to_kvlayer` with its ``by_time`` and ``with_source``
+        indexes, as :func:`parse_index_query` describes; for instance,
+        ``time:1420070400-1420675200;source:news,social`` reads the
+        stream items from the first week of 2015 whose source is
+        ``news`` or ``social``.  The index tables are scanned for
+        matching keys, which are then fetched `get_batch_size` at a
+        time.  The number of index entries that matched is logged
+        for each index and kept in :attr:`index_stats`.
+
         .. todo:: make this support keyword index strings
 
         '''
+        query = parse_index_query(i_str)
+        if query is not None:
+            for si in self._loadquery(query):
+                yield si
+            return
         if not i_str:
-            for si in self._loadrange(None, None):
+            if self.scan_threads > 0:
+                if self.num_workers > 1:
+                    ## fork the worker processes before the threads
+                    self._get_pool()
+                scan = self._scan_ranges(split_key_space(self.scan_splits))
+            else:
+                scan = self._loadrange(None, None)
+            for si in scan:
                 yield si
             return
-        for si in parse_keys_and_ranges(i_str, self._loadkey,
-                                        self._loadrange):
-            yield si
+        keys = []
+        for key, keyb in iter_keys_and_ranges(i_str):
+            if keyb is None:
+                keys.append(key)
+                if len(keys) < self.get_batch_size:
+                    continue
+            if keys:
+                for si in self._loadkeys(keys):
+                    yield si
+                keys = []
+            if keyb is not None:
+                for si in self._loadrange(key, keyb):
+                    yield si
+        if keys:
+            for si in self._loadkeys(keys):
+                yield si
+
+
+def _decompress_batch(datas):
+    '''decrypt and decompress stored stream items, possibly in a
+    worker process'''
+    return [streamcorpus.decrypt_and_uncompress(data) for data in datas]
+
+
+def get_many(client, table_name, keys):
+    '''Get the values for `keys` from `table_name` in one request.
+
+    :return: list of values in the same order as `keys`, with
+      :const:`None` for keys that are not present
+
+    '''
+    if not keys:
+        return []
+    found = dict((tuple(key), value)
+                 for key, value in client.get(table_name, *keys))
+    return [found.get(tuple(key)) for key in keys]
 
 
 _STREAM_ID_RE = re.compile(r'[0-9]+-[0-9a-fA-F]{32}')
+_INDEX_QUERY_RE = re.compile(r'(time|source):')
+_TIME_RANGE_RE = re.compile(r'^(-?[0-9]*)-(-?[0-9]*)$')
+
+
+def parse_index_query(i_str):
+    '''Parse a :class:`from_kvlayer` index query.
+
+    A query is one or more clauses separated by ``;``.  A clause
+    ``time:start-end`` selects stream items with stream times in
+    epoch seconds from `start` up to but not including `end`; either
+    may be left out for an open range.  A clause
+    ``source:name,name`` selects stream items whose source is one of
+    the listed names.  Both may be given, and a stream item must
+    then match both.
+
+    :return: dictionary with keys ``time``, a pair of start and end
+      (either of which may be :const:`None`) or :const:`None`, and
+      ``sources``, a set of names or :const:`None`; or :const:`None`
+      if `i_str` is not a query
+    :raise exceptions.ValueError: if `i_str` is a malformed query
+
+    '''
+    if not i_str or not _INDEX_QUERY_RE.match(i_str):
+        return None
+    query = {'time': None, 'sources': None}
+    for clause in i_str.split(';'):
+        m = _INDEX_QUERY_RE.match(clause)
+        if not m:
+            raise ValueError('bad index query clause {0!r}'.format(clause))
+        value = clause[m.end():]
+        if m.group(1) == 'time':
+            tm = _TIME_RANGE_RE.match(value)
+            if not tm or query['time'] is not None:
+                raise ValueError('bad time clause {0!r}'.format(clause))
+            query['time'] = tuple(int(part) if part else None
+                                  for part in tm.groups())
+        else:
+            sources = set(name for name in value.split(',') if name)
+            if not sources or query['sources'] is not None:
+                raise ValueError('bad source clause {0!r}'.format(clause))
+            query['sources'] = sources
+    return query
 
 
 def parse_keys_and_ranges(i_str, keyfunc, rangefunc):
@@ -138,13 +490,29 @@ def parse_keys_and_ranges(i_str, keyfunc, rangefunc):
     `keyfunc` and `rangefunc` are run as generators and their yields
     are yielded from this function.
 
+    '''
+    for key, keyb in iter_keys_and_ranges(i_str):
+        if keyb is None:
+            results = keyfunc(key)
+        else:
+            results = rangefunc(key, keyb)
+        for retval in results:
+            yield retval
+
+
+def iter_keys_and_ranges(i_str):
+    '''Parse the :class:`from_kvlayer` input string, as
+    :func:`parse_keys_and_ranges`.
+
+    Yields pairs of :mod:`kvlayer` keys: a range of keys as its first
+    and last key, and a single key as the key and :const:`None`.
+
     '''
     while i_str:
         m = _STREAM_ID_RE.match(i_str)
         if m:
             # old style text stream_id
-            for retval in keyfunc(stream_id_to_kvlayer_key(m.group())):
-                yield retval
+            yield stream_id_to_kvlayer_key(m.group()), None
             i_str = i_str[m.end():]
             while i_str and ((i_str[0] == ',') or (i_str[0] == ';')):
                 i_str = i_str[1:]
@@ -152,9 +520,7 @@ def parse_keys_and_ranges(i_str, keyfunc, rangefunc):
 
         if len(i_str) == SI_KEY_LENGTH:
             # one key, get it.
-            key = parse_si_key(i_str)
-            for retval in keyfunc(key):
-                yield retval
+            yield parse_si_key(i_str), None
             return
 
         keya = i_str[:SI_KEY_LENGTH]
@@ -163,22 +529,78 @@ def parse_keys_and_ranges(i_str, keyfunc, rangefunc):
             # range
             keyb = i_str[SI_KEY_LENGTH+1:SI_KEY_LENGTH+1+SI_KEY_LENGTH]
             i_str = i_str[SI_KEY_LENGTH+1+SI_KEY_LENGTH:]
-            keya = parse_si_key(keya)
-            keyb = parse_si_key(keyb)
-            for retval in rangefunc(keya, keyb):
-                yield retval
+            yield parse_si_key(keya), parse_si_key(keyb)
+            if i_str[:1] == ';':
+                i_str = i_str[1:]
         elif splitc == ';':
             # keya is single key to load
-            keya = parse_si_key(keya)
-            for retval in keyfunc(keya):
-                yield retval
-            i_str = i_str[SI_KEY_LENGTH+1+1:]
+            yield parse_si_key(keya), None
+            i_str = i_str[SI_KEY_LENGTH+1:]
         else:
             logger.error('bogus key splitter %s, %r', splitc, i_str)
             return
         # continue parsing i_str
 
 
+#: :mod:`kvlayer` clients made by :func:`stream_item_client`, by
+#: process and configuration
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _freeze(value):
+    '''hashable copy of a configuration value'''
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for (k, v) in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def stream_item_client(config=None):
+    '''Get a shared :mod:`kvlayer` client for the stream item tables.
+
+    One client is made for each process and :mod:`kvlayer`
+    configuration, the first time it is asked for, and its namespace
+    is set up for
+    :data:`~streamcorpus_pipeline._kvlayer_table_names.STREAM_ITEM_TABLE_DEFS`
+    then, and never again.  The helper functions in this module use
+    it when not passed a client, so calling them in a loop does not
+    connect to the database each time.  Several threads may be handed
+    the same client, so the backend must allow that if they use it at
+    once.
+
+    :param dict config: :mod:`kvlayer` configuration, or
+      :const:`None` for the global one
+    :return: :mod:`kvlayer` client object
+
+    '''
+    if config is None:
+        config = yakonfig.get_global_config('kvlayer')
+    key = (os.getpid(), _freeze(config))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = kvlayer.client(config)
+            client.setup_namespace(STREAM_ITEM_TABLE_DEFS,
+                                   STREAM_ITEM_VALUE_DEFS)
+            _clients[key] = client
+    return client
+
+
+def clear_stream_item_clients():
+    '''Close and forget the clients made by :func:`stream_item_client`
+    in this process.'''
+    pid = os.getpid()
+    with _clients_lock:
+        for key in _clients.keys():
+            ## a forked child must not close its parent's connections
+            if key[0] == pid:
+                _clients.pop(key).close()
+            else:
+                del _clients[key]
+
+
 def get_kvlayer_stream_item(client, stream_id):
     '''Retrieve a :class:`streamcorpus.StreamItem` from :mod:`kvlayer`.
 
@@ -189,11 +611,14 @@ def get_kvlayer_stream_item(client, stream_id):
                                STREAM_ITEM_VALUE_DEFS)
         si = get_kvlayer_stream_item(client, stream_id)
 
+    or be :const:`None`, to use :func:`stream_item_client`.
+
     `stream_id` is in the form of
     :data:`streamcorpus.StreamItem.stream_id` and contains the
     ``epoch_ticks``, a hyphen, and the ``doc_id``.
 
-    :param client: kvlayer client object
+    :param client: kvlayer client object, or :const:`None` to use
+      :func:`stream_item_client`
     :type client: :class:`kvlayer.AbstractStorage`
     :param str stream_id: stream Id to retrieve
     :return: corresponding :class:`streamcorpus.StreamItem`
@@ -202,9 +627,7 @@ def get_kvlayer_stream_item(client, stream_id):
 
     '''
     if client is None:
-        client = kvlayer.client()
-        client.setup_namespace(STREAM_ITEM_TABLE_DEFS,
-                               STREAM_ITEM_VALUE_DEFS)
+        client = stream_item_client()
     key = stream_id_to_kvlayer_key(stream_id)
     for k, v in client.get(STREAM_ITEMS_TABLE, key):
         if v is not None:
@@ -213,6 +636,46 @@ def get_kvlayer_stream_item(client, stream_id):
     raise KeyError(stream_id)
 
 
+def get_kvlayer_stream_items(client, stream_ids, batch_size=100):
+    '''Retrieve many :class:`streamcorpus.StreamItem` from :mod:`kvlayer`.
+
+    This is the bulk version of :func:`get_kvlayer_stream_item`,
+    fetching `batch_size` stream items per request.
+
+    :param client: kvlayer client object, or :const:`None` to use
+      :func:`stream_item_client`
+    :type client: :class:`kvlayer.AbstractStorage`
+    :param stream_ids: iterable of stream IDs to retrieve
+    :param int batch_size: number of stream items per request
+    :return: generator of pairs of stream ID and the corresponding
+      :class:`streamcorpus.StreamItem`, in the order of `stream_ids`,
+      with :const:`None` for stream IDs that are not in the database
+    :raise exceptions.KeyError: if a stream ID is malformed
+    :raise exceptions.Exception: if a stored stream item cannot be
+      decrypted or decompressed
+
+    '''
+    if client is None:
+        client = stream_item_client()
+    stream_ids = iter(stream_ids)
+    while True:
+        batch = list(itertools.islice(stream_ids, batch_size))
+        if not batch:
+            return
+        keys = [stream_id_to_kvlayer_key(stream_id) for stream_id in batch]
+        for stream_id, v in zip(batch, get_many(client, STREAM_ITEMS_TABLE,
+                                                keys)):
+            si = None
+            if v is not None:
+                errors, bytestr = streamcorpus.decrypt_and_uncompress(v)
+                if errors:
+                    if not isinstance(errors, Exception):
+                        errors = Exception(repr(errors))
+                    raise errors
+                si = streamcorpus.deserialize(bytestr)
+            yield stream_id, si
+
+
 def make_doc_id_range(doc_id):
     '''Construct a tuple(begin, end) of one-tuple kvlayer keys from a
     hexdigest doc_id.
@@ -230,15 +693,14 @@ def get_kvlayer_stream_item_by_doc_id(client, doc_id):
     Namely, it returns an iterator over all documents with the given
     docid. The docid should be an md5 hash of the document's abs_url.
 
-    :param client: kvlayer client object
+    :param client: kvlayer client object, or :const:`None` to use
+      :func:`stream_item_client`
     :type client: :class:`kvlayer.AbstractStorage`
     :param str doc_id: doc id of documents to retrieve
     :return: generator of :class:`streamcorpus.StreamItem`
     '''
     if client is None:
-        client = kvlayer.client()
-        client.setup_namespace(STREAM_ITEM_TABLE_DEFS,
-                               STREAM_ITEM_VALUE_DEFS)
+        client = stream_item_client()
     doc_id_range = make_doc_id_range(doc_id)
     for k, v in client.scan(STREAM_ITEMS_TABLE, doc_id_range):
         if v is not None:
@@ -246,21 +708,53 @@ def get_kvlayer_stream_item_by_doc_id(client, doc_id):
             yield streamcorpus.deserialize(bytestr)
 
 
+def get_kvlayer_stream_items_by_doc_ids(client, doc_ids, num_threads=8):
+    '''Retrieve the :class:`streamcorpus.StreamItem`s for many doc IDs.
+
+    This is the bulk version of
+    :func:`get_kvlayer_stream_item_by_doc_id`.  The range scan for
+    each doc ID runs on one of `num_threads` threads, all sharing
+    `client`, so the :mod:`kvlayer` backend must allow a client to be
+    used from several threads.
+
+    :param client: kvlayer client object, or :const:`None` to use
+      :func:`stream_item_client`
+    :type client: :class:`kvlayer.AbstractStorage`
+    :param doc_ids: iterable of doc IDs to retrieve
+    :param int num_threads: most scans to run at once
+    :return: generator of pairs of doc ID and list of
+      :class:`streamcorpus.StreamItem` with that doc ID, in the order
+      of `doc_ids`
+
+    '''
+    if client is None:
+        client = stream_item_client()
+
+    def fetch(doc_id):
+        return doc_id, list(get_kvlayer_stream_item_by_doc_id(client, doc_id))
+    pool = ThreadPool(num_threads)
+    try:
+        for pair in pool.imap(fetch, doc_ids):
+            yield pair
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def get_kvlayer_stream_ids_by_doc_id(client, doc_id):
     '''Retrieve stream ids from :mod:`kvlayer`.
 
     Namely, it returns an iterator over all stream ids with the given
     docid. The docid should be an md5 hash of the document's abs_url.
 
-    :param client: kvlayer client object
+    :param client: kvlayer client object, or :const:`None` to use
+      :func:`stream_item_client`
     :type client: :class:`kvlayer.AbstractStorage`
     :param str doc_id: doc id of documents to retrieve
     :return: generator of str
     '''
     if client is None:
-        client = kvlayer.client()
-        client.setup_namespace(STREAM_ITEM_TABLE_DEFS,
-                               STREAM_ITEM_VALUE_DEFS)
+        client = stream_item_client()
     doc_id_range = make_doc_id_range(doc_id)
     for k in client.scan_keys(STREAM_ITEMS_TABLE, doc_id_range):
         yield kvlayer_key_to_stream_id(k)
@@ -268,9 +762,7 @@ def get_kvlayer_stream_ids_by_doc_id(client, doc_id):
 
 def delete_kvlayer_stream_item(client, stream_id):
     if client is None:
-        client = kvlayer.client()
-        client.setup_namespace(STREAM_ITEM_TABLE_DEFS,
-                               STREAM_ITEM_VALUE_DEFS)
+        client = stream_item_client()
     key = stream_id_to_kvlayer_key(stream_id)
     client.delete(STREAM_ITEMS_TABLE, key)
 
@@ -302,16 +794,70 @@ class to_kvlayer(Configured):
     from those tagger IDs will be indexed.  If it is set to ``null``
     or left unset, all taggers' tokens will be indexed as distinct
     words.  Any tokens whose size is greater than `keyword_size_limit`
-    (default 128) will not be indexed.
+    (default 128) will not be indexed.  Keyword index counters are
+    merged across all of the stream items in a chunk and written once
+    at its end, or sooner if their estimated size passes
+    `keyword_buffer_bytes` (default 128 MiB).
+
+    The remaining parameters tune throughput:
+
+    .. code-block:: yaml
+
+        to_kvlayer:
+          num_workers: 4
+          batch_size: 16
+          buffer_items: 100
+          buffer_bytes: 4194304
+          put_threads: 1
+          max_puts_in_flight: 2
+
+    If `num_workers` is more than 1, stream items are compressed in a
+    pool of that many processes, `batch_size` items at a time; the
+    pool is started with the first chunk and kept until
+    :meth:`shutdown`.  The default, 1, compresses items in the
+    pipeline process.
+    Writes to each table are batched until `buffer_items` items or
+    `buffer_bytes` bytes of keys and values have built up.  If
+    `put_threads` is more than 0, batches are written on that many
+    background threads while the next ones fill, with at most
+    `max_puts_in_flight` outstanding per table before the writer waits
+    for one; the :mod:`kvlayer` backend must then allow its client to
+    be used from several threads.  The default, 0, writes each batch
+    before going on.  Item counts, bytes and write rates for each
+    table are logged after each chunk.
+
+    .. code-block:: yaml
+
+        to_kvlayer:
+          bloom_filter_path: /data/stored.bloom
+          bloom_key: stream_id
+          bloom_capacity: 10000000
+          bloom_error_rate: 0.001
+
+    If `bloom_filter_path` is set, the `bloom_key` (``stream_id`` or
+    ``doc_id``) of every item written is added to that
+    :class:`~streamcorpus_pipeline._bloom.BloomFilter` after each
+    chunk, creating it for `bloom_capacity` keys at false positive
+    rate `bloom_error_rate` if needed, so that the
+    :class:`~streamcorpus_pipeline._bloom.bloom_dedup` transform can
+    skip items already stored without a lookup.
 
     '''
     config_name = 'to_kvlayer'
     default_config = {'indexes': [],
-                      'keyword_size_limit': 128}
+                      'keyword_size_limit': 128,
+                      'keyword_buffer_bytes': 2 ** 27,
+                      'num_workers': 1,
+                      'batch_size': 16,
+                      'buffer_items': 100,
+                      'buffer_bytes': 2 ** 22,
+                      'put_threads': 0,
+                      'max_puts_in_flight': 2}
 
     @staticmethod
     def check_config(config, name):
         yakonfig.check_toplevel_config(kvlayer, name)
+        check_key(config, name, 'bloom_key')
         for ndx in config['indexes']:
             if ndx != KEYWORDS and ndx not in INDEX_TABLE_NAMES:
                 raise yakonfig.ConfigurationError(
@@ -351,24 +897,98 @@ class to_kvlayer(Configured):
                 hash_keywords=hash_keywords,
                 keyword_tagger_ids=keyword_tagger_ids,
                 keyword_size_limit=keyword_size_limit)
+        self.num_workers = self.config.get('num_workers') or 1
+        self._pool = None
+        self.batch_size = self.config.get('batch_size') or 16
+        self.bloom = writer_bloom_filter(self.config)
+
+    def shutdown(self):
+        '''Stop the compression worker processes, if any.'''
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _compressed(self, chunk, pool):
+        '''yield each stream item in `chunk` with its compressed form,
+        in order, compressing on the process `pool` if it is not
+        :const:`None`'''
+        if pool is None:
+            for si in chunk:
+                yield si, _compress_stream_item(streamcorpus.serialize(si))
+            return
+        ## thrift serializes in C, so only compression is worth
+        ## shipping to the workers
+        pending = collections.deque()
+
+        def submit(batch):
+            datas = [streamcorpus.serialize(si) for si in batch]
+            pending.append((batch,
+                            pool.apply_async(_compress_batch, (datas,))))
+
+        def finished(limit):
+            while len(pending) > limit:
+                batch, result = pending.popleft()
+                for pair in zip(batch, result.get()):
+                    yield pair
+
+        batch = []
+        for si in chunk:
+            batch.append(si)
+            if len(batch) >= self.batch_size:
+                submit(batch)
+                batch = []
+                ## keep every worker busy, but no more
+                for pair in finished(2 * self.num_workers - 1):
+                    yield pair
+        if batch:
+            submit(batch)
+        for pair in finished(0):
+            yield pair
+
+    def _table_buffer(self, table_name, put_pool):
+        return TableBuffer(self.client, table_name,
+                           buffer_count=self.config.get('buffer_items') or 100,
+                           buffer_bytes=self.config.get('buffer_bytes'),
+                           pool=put_pool,
+                           max_in_flight=self.config.get('max_puts_in_flight')
+                           or 2)
 
     def __call__(self, t_path, name_info, i_str):
+        ## fork the workers before starting any threads
+        if self.num_workers > 1 and self._pool is None:
+            self._pool = multiprocessing.Pool(self.num_workers)
+        put_pool = None
+        if self.config.get('put_threads'):
+            put_pool = ThreadPool(self.config['put_threads'])
+        try:
+            return self._write(t_path, self._pool, put_pool)
+        finally:
+            if put_pool is not None:
+                put_pool.terminate()
+                put_pool.join()
+
+    def _write(self, t_path, pool, put_pool):
         si_keys = []
-        sitable = TableBuffer(self.client, STREAM_ITEMS_TABLE)
+        sitable = self._table_buffer(STREAM_ITEMS_TABLE, put_pool)
         outputs = {}
         indexes = self.config.get('indexes', [])
         for index_name in indexes:
             itn = INDEX_TABLE_NAMES.get(index_name)
             if itn is not None:
-                outputs[itn] = TableBuffer(self.client, itn)
-
-        for si in streamcorpus.Chunk(t_path):
+                outputs[itn] = self._table_buffer(itn, put_pool)
+        keywords = None
+        if self.keyword_indexer:
+            keywords = self.keyword_indexer.accumulator(
+                max_bytes=self.config.get('keyword_buffer_bytes') or 2 ** 27)
+
+        bloom_keys = []
+        for si, data in self._compressed(streamcorpus.Chunk(t_path), pool):
             si_key = key_for_stream_item(si)
-            data = streamcorpus.serialize(si)
-            errors, data = streamcorpus.compress_and_encrypt(data)
-            assert not errors, errors
             sitable.put(si_key, data)
             si_keys.append(serialize_si_key(si_key))
+            if self.bloom is not None:
+                bloom_keys.append(self.bloom.key_of(si))
 
             for index_name in indexes:
                 index_func = INDEX_FUNCTIONS.get(index_name)
@@ -376,16 +996,38 @@ class to_kvlayer(Configured):
                     for tablename, kv in index_func(si):
                         outputs[tablename].put(*kv)
 
-            if self.keyword_indexer:
-                self.keyword_indexer.index(si)
+            if keywords is not None:
+                self.keyword_indexer.index(si, accumulator=keywords)
 
         sitable.flush()
         for outbuf in outputs.itervalues():
             outbuf.flush()
+        if keywords is not None:
+            keywords.flush()
+        if self.bloom is not None:
+            ## only once everything is stored
+            self.bloom.add(bloom_keys)
+        sitable.log_stats()
+        for outbuf in outputs.itervalues():
+            outbuf.log_stats()
+        if keywords is not None:
+            keywords.log_stats()
 
         return si_keys
 
 
+def _compress_stream_item(data):
+    '''compress a serialized stream item for storage'''
+    errors, data = streamcorpus.compress_and_encrypt(data)
+    assert not errors, errors
+    return data
+
+
+def _compress_batch(datas):
+    '''run :func:`_compress_stream_item` in a worker process'''
+    return [_compress_stream_item(data) for data in datas]
+
+
 SI_KEY_LENGTH = 20
 
 
@@ -408,6 +1050,76 @@ def parse_si_key(si_key_bytes):
     return struct.unpack('>16si', si_key_bytes)
 
 
+#: smallest and largest stream times a serialized key can hold
+MIN_EPOCH_TICKS = -2 ** 31
+MAX_EPOCH_TICKS = 2 ** 31 - 1
+
+#: smallest and largest keys that :func:`serialize_si_key` can encode;
+#: :class:`from_kvlayer` reads a range from or to one of these as
+#: running from the start or to the end of the table
+FIRST_SI_KEY = ('\x00' * 16, MIN_EPOCH_TICKS)
+LAST_SI_KEY = ('\xff' * 16, MAX_EPOCH_TICKS)
+
+
+def split_key_space(num_splits):
+    '''Divide the keys of
+    :data:`~streamcorpus_pipeline._kvlayer_table_names.STREAM_ITEMS_TABLE`
+    into `num_splits` contiguous ranges.
+
+    Document IDs are md5 hashes, so splitting their range evenly
+    gives ranges holding about equal numbers of stream items.  Each
+    range ends with the key that starts the next one, the first
+    starts at :data:`FIRST_SI_KEY` and the last ends at
+    :data:`LAST_SI_KEY`, so together they cover the table whatever
+    order the :mod:`kvlayer` backend keeps keys in.  Only a stream
+    item whose key is exactly a boundary, a round-numbered document
+    ID with the smallest possible stream time, would be read twice.
+
+    :param int num_splits: number of ranges
+    :return: list of pairs of first and last :mod:`kvlayer` key, in
+      key order
+
+    '''
+    if num_splits < 1:
+        raise ValueError('need at least one split, not {0!r}'
+                         .format(num_splits))
+    ## kvlayer's default key encoder sorts a zero byte after bytes 1
+    ## through 36, so boundaries avoid it to stay in the same order
+    ## for every encoder
+    bounds = [FIRST_SI_KEY]
+    for i in xrange(1, num_splits):
+        doc_id = base64.b16decode('{0:032X}'.format(i * 2 ** 128 //
+                                                    num_splits))
+        bounds.append((doc_id.replace('\x00', '\x01'), MIN_EPOCH_TICKS))
+    bounds.append(LAST_SI_KEY)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def key_space_i_strs(num_splits):
+    '''Encode the ranges from :func:`split_key_space` as
+    :class:`from_kvlayer` input strings, in the binary
+    ``keya<keyb`` form.'''
+    return [serialize_si_key(keya) + '<' + serialize_si_key(keyb)
+            for keya, keyb in split_key_space(num_splits)]
+
+
+def key_space_work_units(num_splits):
+    '''Build :mod:`coordinate` work units that together scan the whole
+    stream item table with :class:`from_kvlayer`.
+
+    The result can be passed to
+    :meth:`coordinate.TaskMaster.update_bundle` along with a work spec
+    for :mod:`streamcorpus_pipeline._coordinate` whose reader is
+    :class:`from_kvlayer`.
+
+    :param int num_splits: number of work units
+    :return: dictionary of input string to work unit data
+
+    '''
+    return dict((i_str, {'start_count': 0})
+                for i_str in key_space_i_strs(num_splits))
+
+
 def streamitem_to_key_data(si):
     '''
     extract the parts of a StreamItem that go into a kvlayer key,
@@ -416,10 +1128,7 @@ def streamitem_to_key_data(si):
     return (kvlayer key tuple), data blob
     '''
     key = key_for_stream_item(si)
-    data = streamcorpus.serialize(si)
-    errors, data = streamcorpus.compress_and_encrypt(data)
-    assert not errors, errors
-    return key, data
+    return key, _compress_stream_item(streamcorpus.serialize(si))
 
 
 def index_source(si):
@@ -442,19 +1151,88 @@ INDEX_FUNCTIONS = {
 }
 
 
+def _value_size(value):
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(_value_size(part) for part in value)
+    return 8
+
+
 class TableBuffer(object):
-    def __init__(self, kvl, table_name, buffer_count=100):
+    '''Batch writes to one :mod:`kvlayer` table.
+
+    Pairs given to :meth:`put` are written to `table_name` through
+    `kvl` once `buffer_count` of them, or pairs adding up to
+    `buffer_bytes` bytes of keys and values, have built up.  If `pool`
+    is a :class:`multiprocessing.pool.ThreadPool`, batches are written
+    on it in the background; once `max_in_flight` batches are
+    outstanding, :meth:`put` waits for the oldest.  An error writing a
+    background batch is raised from a later :meth:`put` or from
+    :meth:`flush`, which waits for everything to be written.
+
+    .. attribute:: items
+    .. attribute:: bytes
+    .. attribute:: batches
+    .. attribute:: put_seconds
+
+       Totals for the batches written so far, with the time spent
+       writing them.
+
+    '''
+    def __init__(self, kvl, table_name, buffer_count=100, buffer_bytes=None,
+                 pool=None, max_in_flight=2):
         self.kvl = kvl
         self.table_name = table_name
         self.buffer_count = buffer_count
+        self.buffer_bytes = buffer_bytes
+        self.pool = pool
+        self.max_in_flight = max_in_flight
         self.buffer = []
+        self.buffer_size = 0
+        self.in_flight = collections.deque()
+        self.items = 0
+        self.bytes = 0
+        self.batches = 0
+        self.put_seconds = 0.0
 
     def put(self, key, value):
         self.buffer.append((key, value))
-        if len(self.buffer) >= self.buffer_count:
-            self.kvl.put(self.table_name, *self.buffer)
-            self.buffer = []
+        self.buffer_size += _value_size(key) + _value_size(value)
+        if (len(self.buffer) >= self.buffer_count or
+                (self.buffer_bytes and
+                 self.buffer_size >= self.buffer_bytes)):
+            self._send()
+
+    def _send(self):
+        batch, self.buffer = self.buffer, []
+        size, self.buffer_size = self.buffer_size, 0
+        if not batch:
+            return
+        self.items += len(batch)
+        self.bytes += size
+        self.batches += 1
+        if self.pool is None:
+            self._put(batch)
+            return
+        while len(self.in_flight) >= self.max_in_flight:
+            self.in_flight.popleft().get()
+        self.in_flight.append(self.pool.apply_async(self._put, (batch,)))
+
+    def _put(self, batch):
+        start_time = time.time()
+        self.kvl.put(self.table_name, *batch)
+        self.put_seconds += time.time() - start_time
 
     def flush(self):
-        self.kvl.put(self.table_name, *self.buffer)
-        self.buffer = []
+        self._send()
+        while self.in_flight:
+            self.in_flight.popleft().get()
+
+    def log_stats(self):
+        rate = 0.0
+        if self.put_seconds > 0:
+            rate = self.bytes / self.put_seconds / 2 ** 20
+        logger.info('%s: %d items, %d bytes in %d batches, '
+                    '%.1f MB/s writing', self.table_name, self.items,
+                    self.bytes, self.batches, rate)
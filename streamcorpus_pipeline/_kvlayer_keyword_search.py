@@ -3,9 +3,12 @@
 .. This software is released under an MIT/X11 open source license.
    Copyright 2012-2015 Diffeo, Inc.
 '''
-from __future__ import absolute_import
+from __future__ import absolute_import, division
 from collections import Counter, defaultdict
+import heapq
+import itertools
 import logging
+import math
 
 import mmh3
 
@@ -20,6 +23,113 @@ logger = logging.getLogger(__name__)
 DOCUMENT_HASH_KEY = 0
 DOCUMENT_HASH_KEY_REPLACEMENT = 1
 
+#: rough memory cost of one accumulated entry beyond its strings
+ENTRY_OVERHEAD = 100
+
+#: documents whose other search terms are looked up in one
+#: :mod:`kvlayer` call
+PROBE_BATCH = 100
+
+
+class KeywordAccumulator(object):
+    '''Merge keyword index writes for many documents.
+
+    :meth:`keyword_indexer.index` writes each document's term
+    frequencies and increments the document frequency and keyword
+    counters of every term in it, so a common term is incremented
+    once per document, each in its own round trip.  Passed an
+    accumulator, it instead adds to counters held here, and
+    :meth:`flush` issues one increment per distinct term and writes
+    the term frequencies in batches of `batch_size`.
+
+    Since increments add up, the accumulator can be flushed early
+    whenever it likes.  It does so when its estimated memory use
+    passes `max_bytes`, so a very large chunk is indexed in a few
+    spills rather than all at once.
+
+    :param kvl: :mod:`kvlayer` client object
+    :param int max_bytes: estimated memory use that forces a flush
+    :param int batch_size: most records in one :mod:`kvlayer` call
+
+    .. attribute:: documents
+    .. attribute:: increments
+
+       Documents added and counter increments requested since this
+       object was created.
+
+    .. attribute:: writes
+
+       Counter records actually written.
+
+    .. attribute:: spills
+
+       Flushes forced by `max_bytes`.
+
+    '''
+    def __init__(self, kvl, max_bytes=2 ** 27, batch_size=1000):
+        self.client = kvl
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self._tf = []
+        self._frequencies = defaultdict(int)
+        self._keywords = defaultdict(int)
+        self._bytes = 0
+        self.documents = 0
+        self.increments = 0
+        self.writes = 0
+        self.spills = 0
+
+    def add(self, tf_kvps, hashes, hash_kw):
+        '''Add one document's index records.
+
+        :param tf_kvps: list of term frequency index records
+        :param hashes: hashes whose document frequency goes up by 1
+        :param hash_kw: map of token to hash whose keyword counter
+          goes up by 1
+
+        '''
+        self.documents += 1
+        self._tf.extend(tf_kvps)
+        self._bytes += len(tf_kvps) * ENTRY_OVERHEAD
+        for h in hashes:
+            if h not in self._frequencies:
+                self._bytes += ENTRY_OVERHEAD
+            self._frequencies[h] += 1
+            self.increments += 1
+        for tok, h in hash_kw.iteritems():
+            if (h, tok) not in self._keywords:
+                self._bytes += ENTRY_OVERHEAD + len(tok)
+            self._keywords[(h, tok)] += 1
+            self.increments += 1
+        if self._bytes > self.max_bytes:
+            self.spills += 1
+            self.flush()
+
+    def _batches(self, kvps):
+        for i in xrange(0, len(kvps), self.batch_size):
+            yield kvps[i:i + self.batch_size]
+
+    def flush(self):
+        '''Write out everything accumulated so far.'''
+        for batch in self._batches(self._tf):
+            self.client.put(HASH_TF_INDEX_TABLE, *batch)
+        for table_name, counts in [
+                (HASH_FREQUENCY_TABLE,
+                 [((h,), n) for h, n in self._frequencies.iteritems()]),
+                (HASH_KEYWORD_INDEX_TABLE, self._keywords.items())]:
+            for batch in self._batches(counts):
+                self.client.increment(table_name, *batch)
+            self.writes += len(counts)
+        self._tf = []
+        self._frequencies.clear()
+        self._keywords.clear()
+        self._bytes = 0
+
+    def log_stats(self):
+        logger.info('keyword index: %d documents, %d counter increments '
+                    'written as %d (%d spills)', self.documents,
+                    self.increments, self.writes, self.spills)
+
 
 class keyword_indexer(object):
     '''Do simple token-based search on documents.
@@ -30,6 +140,7 @@ class keyword_indexer(object):
 
     .. automethod:: __init__
     .. automethod:: index
+    .. automethod:: search
 
     '''
 
@@ -132,12 +243,17 @@ class keyword_indexer(object):
                         counter[term] += 1
         return counter
 
-    def index(self, si):
+    def accumulator(self, max_bytes=2 ** 27):
+        '''Make a :class:`KeywordAccumulator` for :meth:`index`.'''
+        return KeywordAccumulator(self.client, max_bytes=max_bytes)
+
+    def index(self, si, accumulator=None):
         '''Record index records for a single document.
 
         Which indexes this creates depends on the parameters to the
         constructor.  This records all of the requested indexes for
-        a single document.
+        a single document.  If `accumulator` is given, the records
+        are added to it, to be written when it is flushed.
 
         '''
         if not si.body.clean_visible:
@@ -157,6 +273,19 @@ class keyword_indexer(object):
             hash_kw[tok] = tok_hash
 
         # Convert this and write it out
+        if accumulator is not None:
+            tf_kvps = []
+            if self.hash_docs:
+                (k1, k2) = key_for_stream_item(si)
+                tf_kvps = [((h, k1, k2), n)
+                           for (h, n) in hash_counts.iteritems()
+                           if h != DOCUMENT_HASH_KEY]
+            accumulator.add(tf_kvps,
+                            hash_counts.keys() if self.hash_frequencies
+                            else [],
+                            hash_kw if self.hash_keywords else {})
+            return
+
         if self.hash_docs:
             (k1, k2) = key_for_stream_item(si)
             kvps = [((h, k1, k2), n) for (h, n) in hash_counts.iteritems()
@@ -246,6 +375,145 @@ class keyword_indexer(object):
 
 
         '''
+        for (key, v) in self._postings(h):
+            yield (kvlayer_key_to_stream_id(key), v)
+
+    def _postings(self, h):
+        '''yield stream item keys and term frequencies for hash `h`,
+        in key order'''
         for ((_, k1, k2), v) in self.client.scan(HASH_TF_INDEX_TABLE,
                                                  ((h,), (h,))):
-            yield (kvlayer_key_to_stream_id((k1, k2)), v)
+            yield ((k1, k2), v)
+
+    def query_hashes(self, query):
+        '''Get the hashes to search for in a query.
+
+        `query` is normalized the way :meth:`collect_words` normalizes
+        document tokens, so stop words and tokens longer than
+        :attr:`keyword_size_limit` are dropped.
+
+        :param query: query string, or list of query words
+        :return: list of distinct hashes, in query order
+
+        '''
+        if isinstance(query, basestring):
+            query = query.split()
+        hashes = []
+        for term in query:
+            if not isinstance(term, unicode):
+                term = term.decode('utf-8')
+            for word in cleanse(term).split():
+                if ((self.keyword_size_limit is not None and
+                     len(word) > self.keyword_size_limit)):
+                    continue
+                if word in self.stop_words:
+                    continue
+                h = self.make_hash(word)
+                if h not in hashes:
+                    hashes.append(h)
+        return hashes
+
+    def _term_frequencies(self, h, keys):
+        '''get the term frequencies of hash `h` in the stream items
+        with `keys`, as a map from key to frequency that leaves out
+        keys without the term'''
+        found = {}
+        for (k, v) in self.client.get(HASH_TF_INDEX_TABLE,
+                                      *[(h,) + tuple(key) for key in keys]):
+            if v is not None:
+                found[tuple(k[1:])] = v
+        return found
+
+    def _matches(self, hashes, require_all):
+        '''yield each stream item key with any (or all) of `hashes`
+        exactly once, with a map of hash to term frequency
+
+        Each term's postings are scanned in turn, `PROBE_BATCH`
+        keys at a time, and the other terms are looked up for each
+        batch.  A key is yielded from the first term it has, and with
+        `require_all` only the first term is scanned.
+
+        '''
+        for i, h in enumerate(hashes):
+            postings = self._postings(h)
+            while True:
+                batch = list(itertools.islice(postings, PROBE_BATCH))
+                if not batch:
+                    break
+                tfs = dict((tuple(key), {h: v}) for (key, v) in batch)
+                for j, other in enumerate(hashes):
+                    if j == i or not tfs:
+                        continue
+                    found = self._term_frequencies(other, tfs.keys())
+                    for key in tfs.keys():
+                        if key in found:
+                            if j < i:
+                                ## already yielded for that term
+                                del tfs[key]
+                            else:
+                                tfs[key][other] = found[key]
+                        elif require_all:
+                            del tfs[key]
+                for (key, _) in batch:
+                    if tuple(key) in tfs:
+                        yield tuple(key), tfs[tuple(key)]
+            if require_all:
+                return
+
+    def search(self, query, require_all=False, limit=None):
+        '''Find documents containing query terms, best first.
+
+        Each matching document is scored by TF-IDF: for each query
+        term it contains, the number of times the term occurs times
+        ``log(1 + N / df)``, where `N` is the number of documents
+        indexed and `df` the number containing the term, both from
+        :meth:`document_frequencies`.  If the index was written
+        without `hash_frequencies`, every term weighs the same.
+
+        Terms are taken rarest first.  The postings of each are
+        streamed from the term frequency index and the other terms
+        are looked up for a batch of documents at a time, so no
+        term's postings are ever held in memory, and no document is
+        scored twice.  With `require_all`, only the rarest term is
+        scanned and the search ends with its postings, however common
+        the other terms are.  With `limit`, only the best `limit`
+        documents are kept in memory as the search runs, but every
+        matching document is still read and scored: the index does
+        not record the highest frequency of each term, which skipping
+        documents that cannot make the cut would need.
+        :class:`~streamcorpus_pipeline._local_index.LocalIndex` does.
+
+        This will return nothing unless the index was written with
+        :attr:`hash_docs` set.
+
+        :param query: query string, or list of query words
+        :param bool require_all: only return documents with every
+          term, rather than any term
+        :param int limit: most documents to return, or :const:`None`
+          for all of them
+        :return: list of pairs of stream ID and score, highest score
+          first
+
+        '''
+        hashes = self.query_hashes(query)
+        if not hashes:
+            return []
+        dfs = self.document_frequencies([DOCUMENT_HASH_KEY] + hashes)
+        n_docs = dfs.pop(DOCUMENT_HASH_KEY, 0)
+        if n_docs:
+            if require_all and not all(dfs.get(h) for h in hashes):
+                return []
+            idf = dict((h, math.log(1 + n_docs / df) if df else 0.0)
+                       for (h, df) in dfs.iteritems())
+            hashes.sort(key=lambda h: dfs.get(h, 0))
+        else:
+            idf = dict((h, 1.0) for h in hashes)
+
+        scored = ((sum(v * idf[h] for (h, v) in tfs.iteritems()), key)
+                  for (key, tfs) in self._matches(hashes, require_all))
+        if limit is not None:
+            best = heapq.nlargest(limit, scored)
+        else:
+            best = sorted(scored, reverse=True)
+        return [(kvlayer_key_to_stream_id(key), score)
+                for (score, key) in best]
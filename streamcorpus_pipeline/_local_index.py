@@ -0,0 +1,795 @@
+'''Keyword index of local chunk files, without :mod:`kvlayer`.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2016 Diffeo, Inc.
+
+:class:`to_local_index` is a writer stage that builds an inverted
+index of the tokens in each chunk in a local directory, using the same
+Murmur hashes of the same normalized tokens as
+:class:`~streamcorpus_pipeline._kvlayer_keyword_search.keyword_indexer`,
+and :class:`LocalIndex` searches it.
+
+The index directory holds an uncompressed copy of each indexed chunk
+under :file:`chunks/`, and a set of segment files.  Each call of the
+writer adds one segment.  Segments are grouped into tiers by their
+number of documents, each tier holding segments up to `merge_factor`
+times larger than the one below, and whenever a tier has
+`merge_factor` segments they are merged into one, which usually lands
+in the next tier.  Each document is then rewritten about once per
+tier, rather than whenever anything is merged.  A segment file holds:
+
+* a header with the number of chunks, documents and terms;
+* the names of the chunk files its documents are in;
+* a table of documents sorted by stream ID, each with its chunk and
+  the byte offset and length of the serialized stream item there, so
+  a document is read with one seek;
+* for each term, the numbers of the documents it is in, in order and
+  delta-encoded, each followed by the term frequency, all as
+  variable-length integers;
+* a table of terms sorted by hash, with the location of each term's
+  postings, its document frequency and its highest term frequency.
+
+Segments are read through :mod:`mmap`, and both tables are searched
+in place, so opening an index costs almost nothing however large it
+is.  A search for the best few documents uses the highest term
+frequencies to skip documents that cannot make the cut.  Segments are written to temporary names and renamed into place,
+and only one process merges at a time, so several pipelines may write
+to one index directory.
+
+This module also writes and reads the sidecar offset index,
+:file:`{chunk}.offsets`, that lets
+:class:`~streamcorpus_pipeline._local_storage.from_local_chunks` read
+single stream items out of an uncompressed chunk file: a table of the
+stream items' keys, sorted, with the offset and length of each.
+
+.. autoclass:: to_local_index
+.. autoclass:: LocalIndex
+   :members:
+.. autoclass:: OffsetIndex
+   :members:
+.. autofunction:: write_offset_index
+
+'''
+from __future__ import absolute_import, division
+from collections import defaultdict
+import errno
+import fcntl
+import glob
+import heapq
+import itertools
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+import uuid
+
+import streamcorpus
+from streamcorpus._chunk import protocol
+from thrift.transport import TTransport
+
+from streamcorpus_pipeline._file_copy import copy_file
+from streamcorpus_pipeline._get_name_info import get_name_info
+from streamcorpus_pipeline._kvlayer_table_names import \
+    key_for_stream_item, kvlayer_key_to_stream_id, stream_id_to_kvlayer_key
+from streamcorpus_pipeline.stages import Configured
+import yakonfig
+
+try:
+    from streamcorpus_pipeline._kvlayer_keyword_search import keyword_indexer
+except ImportError, exc:
+    keyword_indexer = str(exc)
+
+logger = logging.getLogger(__name__)
+
+OFFSETS_MAGIC = 'SCOFFS01'
+SEGMENT_MAGIC = 'SCSEG002'
+
+## magic, number of records
+_OFFSETS_HEADER = struct.Struct('>8sI')
+## doc_id, epoch_ticks, offset, length
+_OFFSETS_RECORD = struct.Struct('>16siQI')
+## magic, chunks, documents, terms, offset of the term table
+_SEGMENT_HEADER = struct.Struct('>8sIIIQ')
+_CHUNK_NAME_LENGTH = struct.Struct('>H')
+## chunk number, offset, length, doc_id, epoch_ticks
+_DOC_RECORD = struct.Struct('>IQI16si')
+## hash, offset of postings, length of postings, document frequency,
+## highest term frequency
+_TERM_RECORD = struct.Struct('>iQIII')
+
+LOCK_NAME = '.lock'
+CHUNKS_DIR = 'chunks'
+
+
+def _open_mmap(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _write_atomically(path, write):
+    '''call `write` with a file object open on a temporary name next
+    to `path`, and rename it to `path` if that succeeds'''
+    dir_path, name = os.path.split(os.path.abspath(path))
+    tmp_path = os.path.join(dir_path, '.%s.tmp-%s' % (name, uuid.uuid4().hex))
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _bisect(count, key_at, key):
+    '''index of the first of `count` sorted records whose key, from
+    `key_at(i)`, is not less than `key`'''
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key_at(mid) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _encode_varint(n, out):
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+
+
+def _decode_varints(data):
+    n = 0
+    shift = 0
+    for c in data:
+        b = ord(c)
+        n |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            yield n
+            n = 0
+            shift = 0
+
+
+def scan_chunk_offsets(path, message=streamcorpus.StreamItem_v0_3_0):
+    '''Read the stream items in an uncompressed chunk file with their
+    locations.
+
+    :param str path: chunk file
+    :return: generator of triples of stream item, byte offset and
+      byte length
+
+    '''
+    data = _open_mmap(path)
+    transport = TTransport.TMemoryBuffer(data)
+    i_protocol = protocol(transport)
+    while True:
+        offset = transport._buffer.tell()
+        si = message()
+        try:
+            si.read(i_protocol)
+        except EOFError:
+            break
+        yield si, offset, transport._buffer.tell() - offset
+
+
+def offset_index_path(chunk_path):
+    '''Name of the sidecar offset index for `chunk_path`.'''
+    return chunk_path + '.offsets'
+
+
+def write_offset_index(chunk_path, message=streamcorpus.StreamItem_v0_3_0):
+    '''Write the sidecar offset index for an uncompressed chunk file.
+
+    :param str chunk_path: chunk file to index
+    :return: path to the offset index
+
+    '''
+    records = sorted((key_for_stream_item(si), offset, length)
+                     for (si, offset, length)
+                     in scan_chunk_offsets(chunk_path, message))
+
+    def write(f):
+        f.write(_OFFSETS_HEADER.pack(OFFSETS_MAGIC, len(records)))
+        for ((doc_id, epoch_ticks), offset, length) in records:
+            f.write(_OFFSETS_RECORD.pack(doc_id, epoch_ticks, offset, length))
+    path = offset_index_path(chunk_path)
+    _write_atomically(path, write)
+    return path
+
+
+class OffsetIndex(object):
+    '''Reader for a sidecar offset index written by
+    :func:`write_offset_index`.
+
+    :param str path: path to the offset index
+    :raise exceptions.ValueError: if `path` is not an offset index
+
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._data = _open_mmap(path)
+        if len(self._data) < _OFFSETS_HEADER.size:
+            raise ValueError('{0!r} is not an offset index'.format(path))
+        magic, self._count = _OFFSETS_HEADER.unpack_from(self._data, 0)
+        if magic != OFFSETS_MAGIC:
+            raise ValueError('{0!r} is not an offset index'.format(path))
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, i):
+        return _OFFSETS_RECORD.unpack_from(
+            self._data, _OFFSETS_HEADER.size + i * _OFFSETS_RECORD.size)
+
+    def find(self, stream_id):
+        '''Locate a stream item.
+
+        :param str stream_id: stream ID to look for
+        :return: list of pairs of byte offset and length of the stream
+          items with `stream_id`, usually one or none
+
+        '''
+        key = stream_id_to_kvlayer_key(stream_id)
+        i = _bisect(self._count, lambda i: tuple(self._record(i)[:2]), key)
+        found = []
+        while i < self._count:
+            doc_id, epoch_ticks, offset, length = self._record(i)
+            if (doc_id, epoch_ticks) != key:
+                break
+            found.append((offset, length))
+            i += 1
+        return found
+
+    def close(self):
+        if hasattr(self._data, 'close'):
+            self._data.close()
+
+
+def read_stream_item(fh, offset, length,
+                     message=streamcorpus.StreamItem_v0_3_0):
+    '''Read the stream item at `offset` in an open chunk file.'''
+    fh.seek(offset)
+    return streamcorpus.deserialize(fh.read(length), message=message)
+
+
+def write_segment(path, chunk_names, docs, terms):
+    '''Write an index segment.
+
+    :param str path: file to write
+    :param list chunk_names: names of chunk files under
+      :file:`chunks/`
+    :param list docs: tuples of key, index in `chunk_names`, byte
+      offset and byte length, sorted by key
+    :param terms: iterable of pairs of hash and list of pairs of
+      document number and term frequency, sorted by hash and then
+      by document number
+
+    '''
+    def write(f):
+        f.write(_SEGMENT_HEADER.pack(SEGMENT_MAGIC, 0, 0, 0, 0))
+        for name in chunk_names:
+            f.write(_CHUNK_NAME_LENGTH.pack(len(name)))
+            f.write(name)
+        for ((doc_id, epoch_ticks), chunk, offset, length) in docs:
+            f.write(_DOC_RECORD.pack(chunk, offset, length,
+                                     doc_id, epoch_ticks))
+        term_records = []
+        for (h, postings) in terms:
+            out = []
+            last = 0
+            for (docno, tf) in postings:
+                _encode_varint(docno - last, out)
+                _encode_varint(tf, out)
+                last = docno
+            data = ''.join(out)
+            term_records.append((h, f.tell(), len(data), len(postings),
+                                 max(tf for (_, tf) in postings)))
+            f.write(data)
+        term_table = f.tell()
+        for record in term_records:
+            f.write(_TERM_RECORD.pack(*record))
+        f.seek(0)
+        f.write(_SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(chunk_names),
+                                     len(docs), len(term_records),
+                                     term_table))
+    _write_atomically(path, write)
+
+
+class Segment(object):
+    '''Reader for one index segment, through :mod:`mmap`.'''
+    def __init__(self, path):
+        self.path = path
+        self._data = _open_mmap(path)
+        if len(self._data) < _SEGMENT_HEADER.size:
+            raise ValueError('{0!r} is not an index segment'.format(path))
+        (magic, num_chunks, self.num_docs, self.num_terms,
+         self._term_table) = _SEGMENT_HEADER.unpack_from(self._data, 0)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError('{0!r} is not an index segment'.format(path))
+        pos = _SEGMENT_HEADER.size
+        self.chunk_names = []
+        for _ in xrange(num_chunks):
+            (size,) = _CHUNK_NAME_LENGTH.unpack_from(self._data, pos)
+            pos += _CHUNK_NAME_LENGTH.size
+            self.chunk_names.append(self._data[pos:pos + size])
+            pos += size
+        self._doc_table = pos
+
+    def document(self, docno):
+        '''Get the key, chunk number in :attr:`chunk_names`, byte
+        offset and byte length of a document.'''
+        chunk, offset, length, doc_id, epoch_ticks = _DOC_RECORD.unpack_from(
+            self._data, self._doc_table + docno * _DOC_RECORD.size)
+        return (doc_id, epoch_ticks), chunk, offset, length
+
+    def find_document(self, key):
+        '''Get the number of the document with `key`, or
+        :const:`None`.'''
+        docno = _bisect(self.num_docs, lambda i: self.document(i)[0], key)
+        if docno < self.num_docs and self.document(docno)[0] == key:
+            return docno
+        return None
+
+    def _term(self, i):
+        return _TERM_RECORD.unpack_from(
+            self._data, self._term_table + i * _TERM_RECORD.size)
+
+    def hashes(self):
+        '''Iterate over the hashes of all terms, in order.'''
+        for i in xrange(self.num_terms):
+            yield self._term(i)[0]
+
+    def _find_term(self, h):
+        i = _bisect(self.num_terms, lambda i: self._term(i)[0], h)
+        if i < self.num_terms:
+            record = self._term(i)
+            if record[0] == h:
+                return record
+        return None
+
+    def document_frequency(self, h):
+        record = self._find_term(h)
+        return record[3] if record is not None else 0
+
+    def max_term_frequency(self, h):
+        '''Get the highest term frequency of hash `h` in any document,
+        or 0 if no document has it.'''
+        record = self._find_term(h)
+        return record[4] if record is not None else 0
+
+    def postings(self, h):
+        '''Iterate over pairs of document number and term frequency
+        for hash `h`, in document order.'''
+        record = self._find_term(h)
+        if record is None:
+            return
+        _, offset, size, _, _ = record
+        numbers = _decode_varints(self._data[offset:offset + size])
+        docno = 0
+        for delta in numbers:
+            docno += delta
+            yield docno, next(numbers)
+
+    def close(self):
+        if hasattr(self._data, 'close'):
+            self._data.close()
+
+
+def merge_segments(paths, out_path):
+    '''Merge the index segments at `paths` into one at `out_path`.'''
+    segments = [Segment(path) for path in paths]
+    try:
+        chunk_names = []
+        docs = []
+        for s, segment in enumerate(segments):
+            base = len(chunk_names)
+            chunk_names.extend(segment.chunk_names)
+            for docno in xrange(segment.num_docs):
+                key, chunk, offset, length = segment.document(docno)
+                docs.append((key, base + chunk, offset, length, s, docno))
+        docs.sort()
+        renumber = [[0] * segment.num_docs for segment in segments]
+        for new_docno, doc in enumerate(docs):
+            renumber[doc[4]][doc[5]] = new_docno
+
+        def terms():
+            all_hashes = heapq.merge(*[segment.hashes()
+                                       for segment in segments])
+            for h, _ in itertools.groupby(all_hashes):
+                postings = []
+                for s, segment in enumerate(segments):
+                    postings.extend((renumber[s][docno], tf)
+                                    for (docno, tf) in segment.postings(h))
+                postings.sort()
+                yield h, postings
+        write_segment(out_path, chunk_names,
+                      [doc[:4] for doc in docs], terms())
+    finally:
+        for segment in segments:
+            segment.close()
+
+
+def segment_paths(index_path):
+    return sorted(glob.glob(os.path.join(index_path, '*.seg')))
+
+
+def _tier(num_docs, merge_factor):
+    '''tier of a segment of `num_docs` documents: 0 below
+    `merge_factor`, 1 below its square, and so on'''
+    tier = 0
+    while num_docs >= merge_factor:
+        num_docs //= merge_factor
+        tier += 1
+    return tier
+
+
+class to_local_index(Configured):
+    '''Writer that adds chunks to a local keyword index.
+
+    Each chunk is copied, uncompressed, into the index directory, and
+    its tokens are indexed as
+    :class:`~streamcorpus_pipeline._kvlayer.to_kvlayer` indexes them
+    with its ``keywords`` index, so stream items need tokens from a
+    tagger.  Search the index with :class:`LocalIndex`.
+
+    .. code-block:: yaml
+
+        to_local_index:
+          index_path: /data/index
+          merge_factor: 8
+          keyword_tagger_ids: [nltk_tokenizer]
+          keyword_size_limit: 128
+
+    `index_path` is required.  When there are `merge_factor`
+    segments of about the same number of documents they are merged
+    into one.  `keyword_tagger_ids` and
+    `keyword_size_limit` are as for
+    :class:`~streamcorpus_pipeline._kvlayer.to_kvlayer`.
+
+    This stage does not move the intermediate chunk file, so it must
+    be listed before a writer that does, such as
+    :class:`~streamcorpus_pipeline._local_storage.to_local_chunks`.
+
+    '''
+    config_name = 'to_local_index'
+    default_config = {
+        'merge_factor': 8,
+        'keyword_size_limit': 128,
+    }
+
+    @staticmethod
+    def check_config(config, name):
+        if not config.get('index_path'):
+            raise yakonfig.ConfigurationError(
+                '{0} requires index_path'.format(name))
+        if isinstance(keyword_indexer, basestring):
+            raise yakonfig.ConfigurationError(
+                'cannot configure {0}: {1}'.format(name, keyword_indexer))
+
+    def __init__(self, *args, **kwargs):
+        super(to_local_index, self).__init__(*args, **kwargs)
+        self.index_path = self.config['index_path']
+        self.indexer = keyword_indexer(
+            None, keyword_tagger_ids=self.config.get('keyword_tagger_ids'),
+            keyword_size_limit=self.config.get('keyword_size_limit'))
+
+    def _term_counts(self, si):
+        '''map of hash to term frequency for `si`, as
+        :meth:`keyword_indexer.index` counts them'''
+        counts = defaultdict(int)
+        if si.body is None or not si.body.clean_visible:
+            return counts
+        for tok, count in self.indexer.collect_words(si).iteritems():
+            counts[self.indexer.make_hash(tok)] += count
+        return counts
+
+    def __call__(self, t_path, name_info, i_str):
+        name_info.update(get_name_info(t_path, i_str=i_str))
+        if name_info['num'] == 0:
+            return None
+
+        chunks_dir = os.path.join(self.index_path, CHUNKS_DIR)
+        if not os.path.exists(chunks_dir):
+            os.makedirs(chunks_dir)
+        name = '%d-%s' % (time.time(), uuid.uuid4().hex)
+        chunk_name = name + '.sc'
+        chunk_path = os.path.join(chunks_dir, chunk_name)
+        tmp_path = os.path.join(chunks_dir, '.%s.tmp' % chunk_name)
+        try:
+            copy_file(t_path, tmp_path)
+            os.rename(tmp_path, chunk_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        records = []
+        for si, offset, length in scan_chunk_offsets(chunk_path):
+            records.append((key_for_stream_item(si), offset, length,
+                            self._term_counts(si)))
+        records.sort(key=lambda record: record[0])
+        write_offset_index(chunk_path)
+
+        postings = defaultdict(list)
+        for docno, (_, _, _, counts) in enumerate(records):
+            for h, tf in counts.iteritems():
+                postings[h].append((docno, tf))
+        o_path = os.path.join(self.index_path, name + '.seg')
+        write_segment(o_path, [chunk_name],
+                      [(key, 0, offset, length)
+                       for (key, offset, length, _) in records],
+                      sorted(postings.iteritems()))
+        logger.info('indexed %d documents and %d terms from %r into %r',
+                    len(records), len(postings), i_str, o_path)
+
+        merged = self.merge()
+        return [merged or o_path]
+
+    def _merge_candidates(self):
+        '''paths of the segments in the lowest tier that has
+        `merge_factor` of them, or :const:`None`'''
+        merge_factor = max(2, self.config['merge_factor'])
+        tiers = defaultdict(list)
+        for path in segment_paths(self.index_path):
+            segment = Segment(path)
+            tiers[_tier(segment.num_docs, merge_factor)].append(path)
+            segment.close()
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= merge_factor:
+                return tiers[tier]
+        return None
+
+    def _merge(self, paths):
+        start = time.time()
+        o_path = os.path.join(self.index_path, '%d-%s.seg' % (
+            time.time(), uuid.uuid4().hex))
+        merge_segments(paths, o_path)
+        for path in paths:
+            os.remove(path)
+        logger.info('merged %d index segments into %r in %.1f seconds',
+                    len(paths), o_path, time.time() - start)
+        return o_path
+
+    def merge(self, force=False):
+        '''Merge segments of about the same size, while some tier has
+        `merge_factor` of them, or every segment into one if `force`
+        is set, unless another process is merging.
+
+        :return: path to the last merged segment, or :const:`None`
+
+        '''
+        with open(os.path.join(self.index_path, LOCK_NAME), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, exc:
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return None
+            if force:
+                paths = segment_paths(self.index_path)
+                if len(paths) < 2:
+                    return None
+                return self._merge(paths)
+            o_path = None
+            while True:
+                paths = self._merge_candidates()
+                if paths is None:
+                    return o_path
+                o_path = self._merge(paths)
+
+
+class LocalIndex(object):
+    '''Search an index written by :class:`to_local_index`.
+
+    Queries are normalized and scored exactly as by
+    :meth:`~streamcorpus_pipeline._kvlayer_keyword_search.keyword_indexer.search`.
+
+    :param str index_path: index directory
+    :param int keyword_size_limit: as configured for the writer
+
+    '''
+    def __init__(self, index_path, keyword_size_limit=128):
+        if isinstance(keyword_indexer, basestring):
+            raise ImportError(keyword_indexer)
+        self.index_path = index_path
+        self.indexer = keyword_indexer(None,
+                                       keyword_size_limit=keyword_size_limit)
+        self.segments = []
+        for path in segment_paths(index_path):
+            try:
+                self.segments.append(Segment(path))
+            except IOError, exc:
+                ## merged away since it was listed
+                if exc.errno != errno.ENOENT:
+                    raise
+        self._chunk_files = {}
+
+    @property
+    def num_docs(self):
+        return sum(segment.num_docs for segment in self.segments)
+
+    def document_frequencies(self, hashes):
+        '''Get a map of hash to the number of documents with it.'''
+        return dict((h, sum(segment.document_frequency(h)
+                            for segment in self.segments))
+                    for h in hashes)
+
+    def _matches(self, segment, hashes, require_all):
+        '''yield the numbers of the documents in `segment` with any
+        (or all) of `hashes`, in order, with a map of hash to term
+        frequency'''
+        def tagged(h):
+            for (docno, tf) in segment.postings(h):
+                yield docno, h, tf
+        postings = [tagged(h) for h in hashes]
+        if not require_all:
+            for docno, group in itertools.groupby(heapq.merge(*postings),
+                                                  lambda p: p[0]):
+                yield docno, dict((h, tf) for (_, h, tf) in group)
+            return
+        ## leapfrog through the postings, stopping when any runs out
+        current = [next(p, None) for p in postings]
+        while None not in current:
+            target = max(c[0] for c in current)
+            for i, p in enumerate(postings):
+                while current[i] is not None and current[i][0] < target:
+                    current[i] = next(p, None)
+            if None in current:
+                return
+            if all(c[0] == target for c in current):
+                yield target, dict((h, tf) for (_, h, tf) in current)
+                current = [next(p, None) for p in postings]
+
+    def _search(self, query, require_all, limit):
+        hashes = self.indexer.query_hashes(query)
+        if not hashes:
+            return []
+        n_docs = self.num_docs
+        dfs = self.document_frequencies(hashes)
+        if require_all and not all(dfs.values()):
+            return []
+        idf = dict((h, math.log(1 + n_docs / df) if df else 0.0)
+                   for (h, df) in dfs.iteritems())
+
+        if limit is not None and not require_all:
+            return self._top(hashes, idf, limit)
+
+        def scored():
+            for s, segment in enumerate(self.segments):
+                for docno, tfs in self._matches(segment, hashes,
+                                                require_all):
+                    yield (sum(tf * idf[h] for (h, tf) in tfs.iteritems()),
+                           segment.document(docno)[0], s, docno)
+        if limit is not None:
+            return heapq.nlargest(limit, scored())
+        return sorted(scored(), reverse=True)
+
+    def _top(self, hashes, idf, limit):
+        '''the best `limit` documents with any of `hashes`, as
+        :meth:`_search` returns them
+
+        This is max-score pruning.  Each segment's terms are ordered
+        by the most they can add to a score, their highest term
+        frequency times their weight.  Once `limit` documents are
+        kept, the cheapest terms whose bounds together cannot reach
+        the lowest kept score no longer propose documents; they are
+        only checked for documents that another term proposed, and
+        only while they could still lift it into the results.  The
+        search of a segment ends when the remaining terms' postings
+        run out.
+
+        '''
+        heap = []
+        if limit <= 0:
+            return heap
+        for s, segment in enumerate(self.segments):
+            terms = sorted((segment.max_term_frequency(h) * idf[h], h)
+                           for h in hashes if segment.max_term_frequency(h))
+            ## bounds[i] is the most terms[:i + 1] add to any score
+            bounds = []
+            total = 0.0
+            for (bound, _) in terms:
+                total += bound
+                bounds.append(total)
+            postings = [segment.postings(h) for (_, h) in terms]
+            current = [next(p, None) for p in postings]
+            essential = 0
+            while True:
+                threshold = heap[0][0] if len(heap) == limit else None
+                ## a document with only terms[:essential] cannot be
+                ## kept, and the threshold never falls
+                while (threshold is not None and essential < len(terms)
+                       and bounds[essential] < threshold):
+                    essential += 1
+                docnos = [c[0] for c in current[essential:] if c is not None]
+                if not docnos:
+                    break
+                docno = min(docnos)
+                tfs = {}
+                score = 0.0
+                for i in xrange(essential, len(terms)):
+                    if current[i] is not None and current[i][0] == docno:
+                        h = terms[i][1]
+                        tfs[h] = current[i][1]
+                        score += tfs[h] * idf[h]
+                        current[i] = next(postings[i], None)
+                for i in xrange(essential - 1, -1, -1):
+                    if score + bounds[i] < threshold:
+                        break
+                    while current[i] is not None and current[i][0] < docno:
+                        current[i] = next(postings[i], None)
+                    if current[i] is not None and current[i][0] == docno:
+                        h = terms[i][1]
+                        tfs[h] = current[i][1]
+                        score += tfs[h] * idf[h]
+                if threshold is not None and score < threshold:
+                    continue
+                entry = (sum(tf * idf[h] for (h, tf) in tfs.iteritems()),
+                         segment.document(docno)[0], s, docno)
+                if len(heap) < limit:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+        return sorted(heap, reverse=True)
+
+    def search(self, query, require_all=False, limit=None):
+        '''Find documents containing query terms, best first.
+
+        :param query: query string, or list of query words
+        :param bool require_all: only return documents with every
+          term, rather than any term
+        :param int limit: most documents to return, or :const:`None`
+          for all of them; with a `limit`, documents that cannot
+          score high enough are skipped without being scored
+        :return: list of pairs of stream ID and score, highest score
+          first
+
+        '''
+        return [(kvlayer_key_to_stream_id(key), score)
+                for (score, key, _, _)
+                in self._search(query, require_all, limit)]
+
+    def search_stream_items(self, query, require_all=False, limit=None):
+        '''Like :meth:`search`, but yield pairs of
+        :class:`streamcorpus.StreamItem` and score.'''
+        for (score, _, s, docno) in self._search(query, require_all, limit):
+            yield self._read(self.segments[s], docno), score
+
+    def _read(self, segment, docno):
+        _, chunk, offset, length = segment.document(docno)
+        chunk_name = segment.chunk_names[chunk]
+        fh = self._chunk_files.get(chunk_name)
+        if fh is None:
+            fh = open(os.path.join(self.index_path, CHUNKS_DIR, chunk_name),
+                      'rb')
+            self._chunk_files[chunk_name] = fh
+        return read_stream_item(fh, offset, length)
+
+    def get_stream_item(self, stream_id):
+        '''Get one stream item from the index.
+
+        :raise exceptions.KeyError: if `stream_id` is not indexed
+
+        '''
+        key = stream_id_to_kvlayer_key(stream_id)
+        for segment in self.segments:
+            docno = segment.find_document(key)
+            if docno is not None:
+                return self._read(segment, docno)
+        raise KeyError(stream_id)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        for fh in self._chunk_files.itervalues():
+            fh.close()
+        self._chunk_files = {}
@@ -14,7 +14,15 @@ import shutil
 import time
 
 import streamcorpus
+from streamcorpus_pipeline._bloom import check_key, writer_bloom_filter
+from streamcorpus_pipeline._compression import compress_file, \
+    CompressionStats, decompress_file, open_chunk, parse_file_extensions
+from streamcorpus_pipeline._file_copy import move_file
 from streamcorpus_pipeline._get_name_info import get_name_info
+from streamcorpus_pipeline._local_index import OffsetIndex, \
+    offset_index_path, read_stream_item, scan_chunk_offsets, \
+    write_offset_index
+from streamcorpus_pipeline._prefetch import Prefetcher
 from streamcorpus_pipeline.stages import Configured
 from streamcorpus_pipeline._tarball_export import tarball_export
 from yakonfig import ConfigurationError
@@ -40,18 +48,108 @@ class from_local_chunks(Configured):
     may use config['max_retries'] (default 1)
     may use config['max_backoff'] (seconds, default 300)
     may use config['streamcorpus_version'] (default 'v0_3_0')
+
+    may use config['prefetch'] (default 0)
+    may use config['prefetch_dir_path'] (default None)
+
+    Chunk files are decompressed according to their file extension,
+    which may be any scheme known to
+    :mod:`streamcorpus_pipeline._compression`.
+
+    If `prefetch` is set and the pipeline is run over several inputs,
+    that many of the files after the current one are decompressed in
+    the background into a spool directory under `prefetch_dir_path`
+    (the system temporary directory by default), which helps when the
+    inputs are on slow or networked storage.
+
+    An input of the form ``path#stream_id,stream_id`` that is not
+    itself a file name reads only the listed stream items from the
+    uncompressed chunk file `path`.  If the chunk has a sidecar offset
+    index, as written by :class:`to_local_chunks` with `offset_index`
+    or by :class:`~streamcorpus_pipeline._local_index.to_local_index`,
+    each one is read with a single seek; otherwise the whole chunk is
+    scanned for them.  A stream ID not in the chunk raises
+    :exc:`KeyError`.
     '''
     config_name = 'from_local_chunks'
     default_config = {
         'max_backoff': 300,
         'streamcorpus_version': 'v0_3_0',
+        'prefetch': 0,
+        'prefetch_dir_path': None,
     }
 
     @staticmethod
     def check_config(config, name):
         _check_version(config, name)
 
+    def __init__(self, config):
+        super(from_local_chunks, self).__init__(config)
+        self.prefetch_depth = self.config.get('prefetch') or 0
+        self._prefetcher = None
+        if self.prefetch_depth:
+            self._prefetcher = Prefetcher(
+                self._fetch_input, self.prefetch_depth,
+                spool_dir_path=self.config.get('prefetch_dir_path'))
+
+    def prefetch(self, i_strs):
+        '''start fetching the inputs after the first of `i_strs`'''
+        if self._prefetcher is not None:
+            self._prefetcher.hint(i_strs)
+
+    def _fetch_input(self, i_str, path, tmp_dir):
+        decompress_file(i_str, path, parse_file_extensions(i_str)[1] or '')
+
+    def _spooled(self, path):
+        '''generate the stream items in spool file `path`, then
+        remove it'''
+        message = _message_versions[self.config['streamcorpus_version']]
+        try:
+            for si in streamcorpus.Chunk(path=path, mode='rb',
+                                         message=message):
+                yield si
+        finally:
+            os.remove(path)
+
+    def _fetch_stream_items(self, path, stream_ids):
+        '''generate the stream items with `stream_ids` in the chunk
+        file `path`, in the order asked for'''
+        message = _message_versions[self.config['streamcorpus_version']]
+        sidecar = offset_index_path(path)
+        if not os.path.exists(sidecar):
+            logger.warning('no offset index for %r, scanning it for %d '
+                           'stream items', path, len(stream_ids))
+            found = {}
+            wanted = set(stream_ids)
+            for si, _, _ in scan_chunk_offsets(path, message):
+                if si.stream_id in wanted:
+                    found[si.stream_id] = si
+            for stream_id in stream_ids:
+                if stream_id not in found:
+                    raise KeyError(stream_id)
+                yield found[stream_id]
+            return
+        index = OffsetIndex(sidecar)
+        try:
+            with open(path, 'rb') as fh:
+                for stream_id in stream_ids:
+                    locations = index.find(stream_id)
+                    if not locations:
+                        raise KeyError(stream_id)
+                    for offset, length in locations:
+                        yield read_stream_item(fh, offset, length, message)
+        finally:
+            index.close()
+
     def __call__(self, i_str):
+        if '#' in i_str and not os.path.exists(i_str):
+            path, stream_ids = i_str.rsplit('#', 1)
+            return self._fetch_stream_items(
+                path, [s for s in stream_ids.split(',') if s])
+        if self._prefetcher is not None:
+            path = self._prefetcher.take(i_str)
+            if path is not None:
+                return self._spooled(path)
         backoff = 0.1
         start_time = time.time()
         tries = 0
@@ -61,7 +159,7 @@ class from_local_chunks(Configured):
             try:
                 message = _message_versions[self.config['streamcorpus_version']]
                 logger.debug('reading from %r' % i_str)
-                chunk = streamcorpus.Chunk(path=i_str, mode='rb', message=message)
+                chunk = open_chunk(i_str, message=message)
                 return chunk
             except IOError, exc:
                 if exc.errno == errno.ENOENT:
@@ -88,36 +186,49 @@ class from_local_chunks(Configured):
 
 
 def patient_move(path1, path2, max_tries=30):
+    '''Move `path1` to `path2` on another file system.
+
+    The data is copied in the kernel where possible and renamed into
+    place once it is on disk (see
+    :func:`streamcorpus_pipeline._file_copy.move_file`).  If `path1`
+    seems to be missing, as can happen briefly on network file
+    systems, this retries with exponential backoff.
+
+    '''
     backoff = 0.1
     tries = 0
-    while tries < max_tries:
+    while True:
         try:
-            shutil.copy2(path1, path2)
-        except IOError, exc:
-            if exc.errno == 2:
-                tries += 1
-                if tries > max_tries:
-                    logger.critical('%d tries failed copying %r to %r', tries, path1, path2, exc_info=True)
-                    raise
-                logger.critical('attempting retry on shutil.copy2(%r, %r)', path1, path2)
-                backoff *= 2
-                time.sleep(backoff)
-                continue
-            else:
-                logger.critical('failed copy %r -> %r', path1, path2, exc_info=True)
+            move_file(path1, path2)
+            return
+        except (IOError, OSError), exc:
+            if exc.errno != errno.ENOENT:
+                logger.critical('failed copy %r -> %r', path1, path2,
+                                exc_info=True)
                 raise
-
-        try:
-            os.remove(path1)
-        except Exception, exc:
-            logger.critical('ignoring failure to os.remove(%r)', path1)
-            pass
-
-        ## if we get here, we succeeded
-        return
-
-    # should never get here
-    raise Exception('weird error inside patient_move(%r, %r)' % (path1, path2))
+            tries += 1
+            if tries >= max_tries:
+                logger.critical('%d tries failed copying %r to %r',
+                                tries, path1, path2, exc_info=True)
+                raise
+            logger.critical('attempting retry on moving %r to %r',
+                            path1, path2)
+            backoff *= 2
+            time.sleep(backoff)
+
+
+def move_into_place(t_path, o_path):
+    '''Atomically rename `t_path` to `o_path`, falling back to
+    :func:`patient_move` across file systems.'''
+    try:
+        logger.debug('attemping os.rename(%r, %r)', t_path, o_path)
+        os.rename(t_path, o_path)
+    except OSError, exc:
+        if exc.errno != errno.EXDEV:
+            logger.error('failed os.rename(%r, %r)', t_path, o_path,
+                         exc_info=True)
+            raise
+        patient_move(t_path, o_path)
 
 
 class from_local_files(Configured):
@@ -257,8 +368,27 @@ class to_local_chunks(Configured):
 
         compress: true
 
-    If specified, append ``.xz`` to the output file name and
-    LZMA-compress the output file.  Defaults to false.
+    If specified, compress the output file and append the compression
+    scheme's extension to the output file name.  Defaults to false.
+    The chunk is compressed within this process in a single pass,
+    writing directly to the output directory.
+
+    .. code-block:: yaml
+
+        compression: xz
+        compression_level: 6
+
+    The compression scheme used with `compress`: ``xz`` (the
+    default), ``gz``, ``sz``, ``zst`` or ``lz4``; and the scheme's
+    compression level, which defaults to the scheme's usual default.
+    The compression ratio and speed are logged after each chunk.
+
+    .. code-block:: yaml
+
+        compression_threads: 4
+
+    Compress ``xz`` and ``zst`` output on this many threads.  Defaults
+    to 1.
 
     .. code-block:: yaml
 
@@ -268,17 +398,54 @@ class to_local_chunks(Configured):
     it away), enabling later writer stages to be run.  Defaults to
     true.
 
+    .. code-block:: yaml
+
+        offset_index: true
+
+    Also write a sidecar offset index, :file:`{output}.offsets`, next
+    to an uncompressed output file, so that :class:`from_local_chunks`
+    can read single stream items out of it.  Defaults to false, and
+    ignored with `compress`.
+
+    .. code-block:: yaml
+
+        bloom_filter_path: /data/stored.bloom
+        bloom_key: stream_id
+        bloom_capacity: 10000000
+        bloom_error_rate: 0.001
+
+    Add the `bloom_key` (``stream_id`` or ``doc_id``) of every item
+    written to a :class:`~streamcorpus_pipeline._bloom.BloomFilter`,
+    as :class:`~streamcorpus_pipeline._kvlayer.to_kvlayer` does.
+
     '''
     config_name = 'to_local_chunks'
     default_config = {
         'cleanup_tmp_files': True,
         'compress': False,
+        'compression': 'xz',
+        'compression_level': None,
+        'compression_threads': 1,
+        'offset_index': False,
     }
 
+    @staticmethod
+    def check_config(config, name):
+        check_key(config, name, 'bloom_key')
+
+    def __init__(self, config):
+        super(to_local_chunks, self).__init__(config)
+        self.compression_stats = CompressionStats()
+        self.bloom = writer_bloom_filter(self.config)
+
     def __call__(self, t_path, name_info, i_str):
         o_type = self.config['output_type']
 
-        name_info.update(get_name_info(t_path, i_str=i_str))
+        ## collect the bloom filter keys in the same pass
+        name_info.update(get_name_info(
+            t_path, i_str=i_str,
+            key_attr=self.bloom.key if self.bloom is not None else None))
+        bloom_keys = name_info.pop('keys', None)
 
         if name_info['num'] == 0:
             return None
@@ -288,28 +455,31 @@ class to_local_chunks(Configured):
             i_fname = i_str.split('/')[-1]
             if i_fname.endswith('.gpg'):
                 i_fname = i_fname[:-4]
-            if i_fname.endswith('.xz'):
-                i_fname = i_fname[:-3]
+            i_compression = parse_file_extensions(i_fname)[1]
+            if i_compression:
+                i_fname = i_fname[:-len(i_compression) - 1]
             if i_fname.endswith('.sc'):
                 i_fname = i_fname[:-3]
             name_info['input_fname'] = i_fname
 
         # prepare to compress the output
-        compress = self.config.get('compress', None)
+        compression = self.config.get('compression') or ''
+        compress = self.config.get('compress', None) and compression
 
         if o_type == 'samedir':
             # assume that i_str was a local path
             assert i_str[-3:] == '.sc', repr(i_str[-3:])
             o_path = i_str[:-3] + '-%s.sc' % self.config['output_name']
             if compress:
-                o_path += '.xz'
+                o_path += '.' + compression
             # print 'creating %s' % o_path
 
         elif o_type == 'inplace':
             # replace the input chunks with the newly created
             o_path = i_str
-            if o_path.endswith('.xz'):
-                compress = True
+            compress = parse_file_extensions(o_path)[1]
+            if compress:
+                compression = compress
 
         elif o_type == 'otherdir':
             if not self.config['output_path'].startswith('/'):
@@ -323,7 +493,7 @@ class to_local_chunks(Configured):
             o_fname = self.config['output_name'] % name_info
             o_path = os.path.join(o_dir, o_fname + '.sc')
             if compress:
-                o_path += '.xz'
+                o_path += '.' + compression
         elif o_type == 'pathfmt':
             # uses output_name, but in a totally different way, to
             # make 'input' checking above work.
@@ -342,59 +512,31 @@ class to_local_chunks(Configured):
             os.makedirs(dirname)
 
         if compress:
-            assert o_path.endswith('.xz'), o_path
-            logger.info('compress_and_encrypt_path(%r, tmp_dir=%r)',
-                        t_path, self.config['tmp_dir_path'])
-
-            errors, t_path2 = streamcorpus.compress_and_encrypt_path(
-                t_path, tmp_dir=self.config['tmp_dir_path'])
-            assert not errors, errors
-
+            assert o_path.endswith('.' + compression), o_path
+            # the intermediate chunk is left in place either way; it
+            # is in tmp_dir_path
+            logger.info('compressing %r to %r with %s', t_path, o_path,
+                        compression)
+            compress_file(t_path, o_path, compression,
+                          level=self.config.get('compression_level'),
+                          stats=self.compression_stats,
+                          threads=self.config.get('compression_threads'))
+            logger.info('to_local_chunks compression: %s',
+                        self.compression_stats)
+        else:
             if self.config['cleanup_tmp_files']:
-                # default action, move tmp file to output position
-                try:
-                    logger.debug('attempting renamed(%r, %r)', t_path2, o_path)
-                    os.rename(t_path2, o_path)
-                    logger.debug('renamed(%r, %r)', t_path2, o_path)
-                except OSError, exc:
-                    if exc.errno == errno.EXDEV:
-                        logger.debug('resorting to patient_move(%r, %r)',
-                                     t_path2, o_path, exc_info=True)
-                        patient_move(t_path2, o_path)
-                        logger.debug('patient_move succeeded')
-                    else:
-                        logger.error('rename failed (%r -> %r)',
-                                     t_path2, o_path, exc_info=True)
-                        raise
-                return [o_path]
+                move_into_place(t_path, o_path)
             else:
-                # for debugging, leave temp file, copy to output
-                shutil.copy(t_path2, o_path)
-                logger.info('copied %r -> %r', t_path2, o_path)
-                return [o_path]
+                # for debugging, leave the tmp file, copy to output position
+                shutil.copy(t_path, o_path)
+                logger.info('copied %r -> %r', t_path, o_path)
 
-        if self.config['cleanup_tmp_files']:
-            # do an atomic renaming
-            try:
-                logger.debug('attemping os.rename(%r, %r)', t_path, o_path)
-                os.rename(t_path, o_path)
-            except OSError, exc:
-                if exc.errno == errno.EXDEV:
-                    patient_move(t_path, o_path)
-                else:
-                    logger.error(
-                        'failed shutil.copy2(%r, %r) and/or '
-                        'os.remove(t_path)',
-                        t_path, o_path, exc_info=True)
-                    raise
-            except Exception, exc:
-                logger.error('failed os.rename(%r, %r)', t_path, o_path,
-                             exc_info=True)
-                raise
-        else:
-            # for debugging, leave the tmp file, copy to output position
-            shutil.copy(t_path, o_path)
-            logger.info('copied %r -> %r', t_path, o_path)
+            if self.config.get('offset_index'):
+                write_offset_index(o_path)
+
+        if self.bloom is not None:
+            ## only once the chunk is in place
+            self.bloom.add(bloom_keys)
 
         # return the final output path
         return [o_path]
@@ -420,22 +562,7 @@ class to_local_tarballs(Configured):
 
         t_path2 = tarball_export(self.config, t_path, name_info)
 
-        # do an atomic renaming
-        try:
-            logger.debug('attemping os.rename(%r, %r)' % (t_path2, o_path))
-            os.rename(t_path2, o_path)
-        except OSError, exc:
-            if exc.errno == errno.EXDEV:
-                patient_move(t_path2, o_path)
-            else:
-                logger.error('failed shutil.copy2(%r, %r) and/or '
-                             'os.remove(t_path)',
-                             t_path2, o_path, exc_info=True)
-                raise
-        except Exception, exc:
-            logger.error('failed os.rename(%r, %r)',
-                         t_path, o_path, exc_info=True)
-            raise
+        move_into_place(t_path2, o_path)
 
         try:
             os.remove(t_path)
@@ -433,6 +433,7 @@ class Pipeline(object):
     .. automethod:: __init__
     .. automethod:: run
     .. automethod:: _process_task
+    .. automethod:: prefetch
 
     '''
     def __init__(self, rate_log_interval, input_item_limit,
@@ -493,6 +494,30 @@ class Pipeline(object):
             )
         self.work_unit = None
 
+    @property
+    def prefetch_depth(self):
+        '''Number of upcoming inputs the reader can prefetch.
+
+        This is the reader's `prefetch_depth`, or 0 if the reader
+        does not prefetch.
+
+        '''
+        return getattr(self.reader, 'prefetch_depth', 0)
+
+    def prefetch(self, i_strs):
+        '''Tell the reader which inputs are coming.
+
+        `i_strs` starts with the input about to be passed to
+        :meth:`run`, followed by those after it, in order.  A reader
+        with a non-zero `prefetch_depth` starts fetching the next few
+        of them in the background.  An empty list means there are no
+        more inputs and lets the reader release anything it holds.
+        This does nothing if the reader does not prefetch.
+
+        '''
+        if self.prefetch_depth:
+            self.reader.prefetch(i_strs)
+
     def _process_task(self, work_unit):
         '''Process a :class:`coordinate.WorkUnit`.
 
@@ -522,6 +547,10 @@ class Pipeline(object):
         :param int start_count: index of the first stream item
         :param int start_chunk_time: timestamp for the first stream item
 
+        When the input is done, successfully or not, the batch
+        transforms are shut down, and so are the reader and writers
+        that have a ``shutdown`` method.
+
         '''
         try:
             if not os.path.exists(self.tmp_dir_path):
@@ -646,6 +675,12 @@ class Pipeline(object):
                 self.t_chunk.close()
             for transform in self.batch_transforms:
                 transform.shutdown()
+            ## readers and writers may keep worker processes between
+            ## their calls
+            for stage in [self.reader] + list(self.writers):
+                shutdown = getattr(stage, 'shutdown', None)
+                if shutdown is not None:
+                    shutdown()
             if self.cleanup_tmp_files:
                 rmtree(self.tmp_dir_path)
 
@@ -0,0 +1,154 @@
+'''Background prefetch of upcoming reader inputs.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2016 Diffeo, Inc.
+
+When the pipeline is run over a sequence of inputs, a reader can
+fetch the next few of them while the current one is processed, so
+that each input does not start with a cold download.  Readers that
+support this have a `prefetch` configuration value, the number of
+upcoming inputs to hold, exposed as a `prefetch_depth` attribute, and
+a ``prefetch(i_strs)`` method that
+:meth:`streamcorpus_pipeline.Pipeline.prefetch` calls with the
+current and coming inputs.
+
+.. autoclass:: Prefetcher
+
+'''
+from __future__ import absolute_import
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    '''Bounded spool of local copies of upcoming inputs.
+
+    `fetch` is a function ``fetch(i_str, path, tmp_dir)`` that writes
+    the local form of input `i_str` to `path`, using `tmp_dir` for
+    any scratch files.  At most `depth` inputs are held or in flight
+    at once; :meth:`hint` names the ones wanted and :meth:`take`
+    claims one.
+
+    Spool files live in a private directory under `spool_dir_path`
+    (the system temporary directory if :const:`None`), not under the
+    pipeline's ``tmp_dir_path``, since the pipeline removes that after
+    every input.
+
+    '''
+    def __init__(self, fetch, depth, spool_dir_path=None, threads=1):
+        self.fetch = fetch
+        self.depth = depth
+        self.spool_dir_path = spool_dir_path
+        self.threads = threads
+        self._dir = None
+        self._pool = None
+        self._count = 0
+        ## i_str -> (local path, AsyncResult)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _path(self):
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix='streamcorpus-prefetch-',
+                                         dir=self.spool_dir_path)
+            self._pool = ThreadPool(self.threads)
+        self._count += 1
+        ## no extension, so nothing guesses a compression scheme
+        return os.path.join(self._dir, 'input-%d' % self._count)
+
+    def _run(self, i_str, path):
+        tmp_dir = path + '.tmp'
+        os.mkdir(tmp_dir)
+        try:
+            self.fetch(i_str, path, tmp_dir)
+        except Exception:
+            logger.warn('prefetch of %r failed', i_str, exc_info=True)
+            _remove(path)
+            raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        with self._lock:
+            entry = self._entries.get(i_str)
+            if entry is None or entry[0] != path:
+                ## no longer wanted
+                _remove(path)
+
+    def hint(self, i_strs):
+        '''Say that `i_strs` are the coming inputs, in order.
+
+        The first of them is the input about to be read, which is
+        kept if it is already spooled but not fetched otherwise.  The
+        `depth` inputs after it are fetched in the background, and
+        anything spooled that is not among these is dropped.  An empty
+        list releases the spool entirely.
+
+        '''
+        i_strs = list(i_strs)
+        if not i_strs:
+            self.close()
+            return
+        wanted = i_strs[:self.depth + 1]
+        with self._lock:
+            for i_str in self._entries.keys():
+                if i_str not in wanted:
+                    self._drop(i_str)
+            for i_str in wanted[1:]:
+                if i_str not in self._entries:
+                    path = self._path()
+                    self._entries[i_str] = (path, self._pool.apply_async(
+                        self._run, (i_str, path)))
+
+    def _drop(self, i_str):
+        path, result = self._entries.pop(i_str)
+        if result.ready():
+            _remove(path)
+        ## otherwise _run removes it when the fetch finishes
+
+    def take(self, i_str):
+        '''Claim the spooled copy of `i_str`.
+
+        Waits for the fetch if it is still in flight.  Returns the path
+        of the local copy, which the caller must remove, or
+        :const:`None` if `i_str` was not prefetched or its fetch
+        failed, in which case the caller should fetch it itself.
+
+        '''
+        with self._lock:
+            entry = self._entries.get(i_str)
+        if entry is None:
+            return None
+        path, result = entry
+        try:
+            result.get()
+        except Exception:
+            path = None
+        with self._lock:
+            self._entries.pop(i_str, None)
+        if path is not None:
+            logger.debug('using prefetched %r', i_str)
+        return path
+
+    def close(self):
+        '''Stop fetching and remove the spool.'''
+        with self._lock:
+            self._entries.clear()
+            pool, self._pool = self._pool, None
+            spool, self._dir = self._dir, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if spool is not None:
+            shutil.rmtree(spool, ignore_errors=True)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
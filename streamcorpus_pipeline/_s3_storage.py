@@ -7,14 +7,19 @@ putting them out into local storage.
    Copyright 2012-2016 Diffeo, Inc.
 '''
 from __future__ import absolute_import, division, print_function
+import collections
 from cStringIO import StringIO
 from functools import partial
 import gzip
 import hashlib
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import random
 import re
+import shutil
 import sys
+import threading
 import time
 
 import requests
@@ -25,12 +30,17 @@ except ImportError:
     FCChunk = None
 
 import streamcorpus
-from streamcorpus import decrypt_and_uncompress, \
-    parse_file_extensions, known_compression_schemes, \
-    compress_and_encrypt_path, Chunk
+from streamcorpus_pipeline._chunk_cache import ChunkCache
+from streamcorpus_pipeline._compression import compress_file, \
+    CompressionStats, get_codec, parse_file_extensions, BLOCK_SIZE, \
+    CompressedFile
+from streamcorpus import Chunk
 from streamcorpus_pipeline._exceptions import FailedExtraction, \
     FailedVerification, ConfigurationError
 from streamcorpus_pipeline._get_name_info import get_name_info
+from streamcorpus_pipeline._gpg import EncryptedFile, encode_file, \
+    open_decoded
+from streamcorpus_pipeline._prefetch import Prefetcher
 from streamcorpus_pipeline._spinn3r_feed_storage import _generate_stream_items
 from streamcorpus_pipeline.stages import Configured
 from streamcorpus_pipeline._tarball_export import tarball_export
@@ -45,8 +55,9 @@ _message_versions = {
 
 import boto
 from boto.s3.key import Key
-from boto.s3.connection import S3Connection
-## stop Boto's built-in retries, so we can do our own
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+## stop Boto's built-in retries, so we can do our own; connections
+## are pooled (see S3ConnectionPool), so a retry need not reconnect
 if not boto.config.has_section('Boto'):
     boto.config.add_section('Boto')
 boto.config.set('Boto', 'num_retries', '0')
@@ -122,6 +133,179 @@ def verify_md5(md5_expected, data, other_errors=None):
     return True
 
 
+def _connection_args(config):
+    '''get positional and keyword arguments for :class:`S3Connection`
+    from `config`'''
+    # get AWS credentials. first, from config; else, from env vars.
+    # (boto will read environment variables and other normal places.)
+    aws_access_key_id_path = config.get('aws_access_key_id_path')
+    aws_secret_access_key_path = config.get('aws_secret_access_key_path')
+
+    params = ()
+    if aws_access_key_id_path and aws_secret_access_key_path:
+        try:
+            access = open(aws_access_key_id_path).read().strip()
+            secret = open(aws_secret_access_key_path).read().strip()
+            params = (access, secret)
+        except:
+            logger.error('failed reading aws credentials from configured file', exc_info=True)
+            raise
+
+    kwargs = {}
+    if config.get('s3_host'):
+        kwargs = dict(host=config['s3_host'], port=config.get('s3_port'),
+                      is_secure=config.get('s3_is_secure', True),
+                      calling_format=OrdinaryCallingFormat())
+    return params, kwargs
+
+
+class _PooledS3Connection(S3Connection):
+    '''S3 connection that counts its HTTP connections for
+    :class:`S3ConnectionPool` and keeps at most ``pool.size`` idle
+    ones per host.'''
+    def __init__(self, pool, *args, **kwargs):
+        self.connection_pool = pool
+        super(_PooledS3Connection, self).__init__(*args, **kwargs)
+
+    def get_http_connection(self, host, port, is_secure):
+        self.connection_pool._count('http_requests')
+        return super(_PooledS3Connection, self).get_http_connection(
+            host, port, is_secure)
+
+    def new_http_connection(self, host, port, is_secure):
+        self.connection_pool._count('http_connections')
+        return super(_PooledS3Connection, self).new_http_connection(
+            host, port, is_secure)
+
+    def put_http_connection(self, host, port, is_secure, connection):
+        ## boto's ConnectionPool has no public way to count idle
+        ## connections; without these internals, keep boto's own limit
+        mutex = getattr(self._pool, 'mutex', None)
+        host_to_pool = getattr(self._pool, 'host_to_pool', None)
+        if mutex is None or host_to_pool is None:
+            return super(_PooledS3Connection, self).put_http_connection(
+                host, port, is_secure, connection)
+        with mutex:
+            idle = host_to_pool.get((host, port, is_secure))
+            full = idle is not None and idle.size() >= \
+                self.connection_pool.size
+        if full:
+            connection.close()
+        else:
+            super(_PooledS3Connection, self).put_http_connection(
+                host, port, is_secure, connection)
+
+
+class S3ConnectionPool(object):
+    '''Process-wide cache of S3 connections and buckets.
+
+    :func:`get_bucket` normally goes through the module-level
+    :data:`connection_pool`, so that every S3 stage in the process,
+    and every retry, shares one :class:`boto.s3.connection.S3Connection`
+    per set of credentials and endpoint, and one
+    :class:`boto.s3.bucket.Bucket` per bucket name.  Each connection
+    keeps finished HTTP connections open for reuse, up to `size` idle
+    ones per host; this matters with several threads, each of which
+    holds its own HTTP connection during a request.
+
+    A process forked from one that used the pool, such as a
+    :mod:`coordinate` worker, starts afresh rather than sharing its
+    parent's open sockets.
+
+    .. attribute:: stats
+
+       :class:`collections.Counter` of ``connections`` and
+       ``buckets`` created, ``connection_reuses`` and
+       ``bucket_reuses``, ``http_connections`` opened and
+       ``http_requests`` made.  :meth:`report` adds
+       ``http_reuses``.
+
+    '''
+    def __init__(self, size=10):
+        self.size = size
+        self.stats = collections.Counter()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._connections = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _check_pid(self):
+        '''forget the parent's connections in a forked child, without
+        closing the sockets the parent is still using'''
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def _endpoint(config):
+        return (config.get('aws_access_key_id_path'),
+                config.get('aws_secret_access_key_path'),
+                config.get('s3_host'), config.get('s3_port'),
+                config.get('s3_is_secure', True))
+
+    def get_connection(self, config):
+        '''get the shared connection for the credentials and endpoint in
+        `config`'''
+        self._check_pid()
+        endpoint = self._endpoint(config)
+        with self._lock:
+            conn = self._connections.get(endpoint)
+            if conn is not None:
+                self.stats['connection_reuses'] += 1
+                return conn
+        params, kwargs = _connection_args(config)
+        conn = _PooledS3Connection(self, *params, **kwargs)
+        with self._lock:
+            ## another thread may have got here first
+            conn = self._connections.setdefault(endpoint, conn)
+            self.stats['connections'] += 1
+        return conn
+
+    def get_bucket(self, config, bucket_name):
+        '''get the shared bucket `bucket_name`, on the connection for
+        `config`'''
+        conn = self.get_connection(config)
+        key = (self._endpoint(config), bucket_name)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                self.stats['bucket_reuses'] += 1
+                return bucket
+        bucket = conn.get_bucket(bucket_name)
+        with self._lock:
+            bucket = self._buckets.setdefault(key, bucket)
+            self.stats['buckets'] += 1
+        return bucket
+
+    def report(self):
+        '''get a copy of :attr:`stats` with ``http_reuses`` added'''
+        with self._lock:
+            stats = dict(self.stats)
+        stats['http_reuses'] = (stats.get('http_requests', 0) -
+                                stats.get('http_connections', 0))
+        return stats
+
+    def clear(self):
+        '''close and forget every connection and bucket'''
+        self._check_pid()
+        with self._lock:
+            connections = self._connections.values()
+            self._connections.clear()
+            self._buckets.clear()
+        for conn in connections:
+            conn.close()
+
+
+#: the :class:`S3ConnectionPool` used by :func:`get_bucket`
+connection_pool = S3ConnectionPool()
+
+
 def get_bucket(config, bucket_name=None):
     '''This function is mostly about managing configuration, and then
     finally returns a boto.Bucket object.
@@ -134,6 +318,17 @@ def get_bucket(config, bucket_name=None):
     are not set in the config then behavior is the same as other AWS-based
     command-line tools.
 
+    To use an S3-compatible service other than Amazon's, set
+    ``s3_host``, and optionally ``s3_port`` and ``s3_is_secure``
+    (default true); buckets are then addressed by path rather than by
+    host name.
+
+    Connections and buckets come from :data:`connection_pool` and are
+    shared across the process, unless ``s3_keep_alive`` is false, in
+    which case every call makes a new connection.  If
+    ``s3_connection_pool_size`` is set, it becomes the number of idle
+    HTTP connections the pool keeps per host.
+
     '''
     if not bucket_name:
         if 'bucket' not in config:
@@ -141,24 +336,266 @@ def get_bucket(config, bucket_name=None):
                 'The "bucket" parameter is required for the s3 stages.')
         bucket_name = config['bucket']
 
-    # get AWS credentials. first, from config; else, from env vars.
-    # (boto will read environment variables and other normal places.)
-    aws_access_key_id_path = config.get('aws_access_key_id_path')
-    aws_secret_access_key_path = config.get('aws_secret_access_key_path')
+    if not config.get('s3_keep_alive', True):
+        params, kwargs = _connection_args(config)
+        conn = S3Connection(*params, **kwargs)
+        return conn.get_bucket(bucket_name)
 
-    params = ()
-    if aws_access_key_id_path and aws_secret_access_key_path:
+    if config.get('s3_connection_pool_size'):
+        connection_pool.size = config['s3_connection_pool_size']
+    return connection_pool.get_bucket(config, bucket_name)
+
+
+#: default size of each HTTP range request made by
+#: :class:`RangedKeyReader`
+DOWNLOAD_PART_SIZE = 2 ** 23
+
+
+class RangedKeyReader(object):
+    '''Read-only file object over an S3 key that downloads it with
+    several concurrent HTTP range requests.
+
+    Parts are fetched in order, at most two per thread ahead of the
+    reader, so memory use is bounded no matter how large the key is.
+    A failed range request is retried on its own, up to `tries` times
+    in all.
+
+    :param key: :class:`boto.s3.key.Key` whose size is known, as
+      returned by :meth:`boto.s3.bucket.Bucket.get_key`
+    :param int part_size: bytes per range request
+    :param int threads: number of concurrent range requests
+    :param int tries: attempts per range request
+
+    '''
+    mode = 'rb'
+
+    def __init__(self, key, part_size=DOWNLOAD_PART_SIZE, threads=4,
+                 tries=1):
+        self.key = key
+        self.size = key.size
+        self.part_size = part_size
+        self.tries = tries
+        self._starts = iter(xrange(0, self.size, part_size))
+        self._pool = ThreadPool(threads)
+        self._max_pending = 2 * threads
+        self._pending = collections.deque()
+        self._buffer = ''
+        self._schedule()
+
+    def _schedule(self):
+        while len(self._pending) < self._max_pending:
+            start = next(self._starts, None)
+            if start is None:
+                break
+            self._pending.append(self._pool.apply_async(self._fetch,
+                                                        (start,)))
+
+    def _fetch(self, start):
+        last = min(start + self.part_size, self.size) - 1
+        headers = {'Range': 'bytes=%d-%d' % (start, last)}
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                ## a Key holds the state of its current request, so
+                ## each request gets its own
+                key = Key(self.key.bucket, self.key.name)
+                data = key.get_contents_as_string(headers=headers)
+                if len(data) != last - start + 1:
+                    raise IOError('got %d bytes for bytes %d-%d of %s'
+                                  % (len(data), start, last, self.key.name))
+                return data
+            except Exception:
+                if tries >= self.tries:
+                    raise
+                logger.warn('retrying bytes %d-%d of %s (%d left)',
+                            start, last, self.key.name, self.tries - tries,
+                            exc_info=True)
+                time.sleep(tries)
+
+    def read(self, size=-1):
+        parts = [self._buffer]
+        have = len(self._buffer)
+        while self._pending and (size < 0 or have < size):
+            data = self._pending.popleft().get()
+            self._schedule()
+            parts.append(data)
+            have += len(data)
+        data = ''.join(parts)
+        if size < 0:
+            self._buffer = ''
+        else:
+            data, self._buffer = data[:size], data[size:]
+        return data
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+#: default size of each part of a multipart upload made by
+#: :class:`MultipartKeyWriter`; S3 requires every part but the last
+#: to be at least 5 MiB
+UPLOAD_PART_SIZE = 2 ** 23
+
+
+class MultipartKeyWriter(object):
+    '''Write-only file object that uploads to an S3 key in parts.
+
+    Whatever is written is cut into parts of `part_size` bytes, which
+    are uploaded as an S3 multipart upload on `threads` concurrent
+    connections.  At most two parts per thread are held in memory, so
+    writing blocks while uploads catch up.  A failed part is retried
+    on its own, up to `tries` times in all.  :meth:`close` uploads
+    the last part and completes the upload.  If everything written
+    fits in one part, it is sent as a single ordinary PUT instead.
+
+    If writing fails part way, call :meth:`abort` rather than
+    :meth:`close`, so that S3 discards the parts.
+
+    :param bucket: :class:`boto.s3.bucket.Bucket` to write to
+    :param str key_name: name of the key to write
+
+    .. attribute:: bytes_written
+
+       Number of bytes written so far.
+
+    .. attribute:: etag
+
+       After :meth:`close`, the ETag S3 should report for the key,
+       computed from the data sent: the md5 of the data for a single
+       PUT, or the md5 of the part md5s followed by ``-`` and the
+       number of parts for a multipart upload.  Each request also
+       carries a Content-MD5 that S3 checks against what it received.
+
+    '''
+    mode = 'wb'
+
+    def __init__(self, bucket, key_name, part_size=UPLOAD_PART_SIZE,
+                 threads=4, tries=1):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.part_size = part_size
+        self.threads = threads
+        self.tries = tries
+        self.bytes_written = 0
+        self.etag = None
+        self.closed = False
+        self._buffer = []
+        self._buffered = 0
+        self._upload = None
+        self._pool = None
+        self._pending = collections.deque()
+        self._etags = []
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.bytes_written += len(data)
+        if self._buffered >= self.part_size:
+            data = ''.join(self._buffer)
+            start = 0
+            while len(data) - start >= self.part_size:
+                self._submit(data[start:start + self.part_size])
+                start += self.part_size
+            self._buffer = [data[start:]]
+            self._buffered = len(data) - start
+
+    def flush(self):
+        pass
+
+    def _submit(self, data):
+        if self._upload is None:
+            self._upload = self.bucket.initiate_multipart_upload(
+                self.key_name)
+            self._pool = ThreadPool(self.threads)
+        part_num = len(self._etags) + len(self._pending) + 1
+        self._pending.append(
+            self._pool.apply_async(self._put_part, (part_num, data)))
+        while len(self._pending) > 2 * self.threads:
+            self._etags.append(self._pending.popleft().get())
+
+    def _put_part(self, part_num, data):
+        digest = hashlib.md5(data)
+        md5 = (digest.hexdigest(), digest.digest().encode('base64').strip())
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                ## boto raises if the ETag returned does not match
+                self._upload.upload_part_from_file(
+                    StringIO(data), part_num, size=len(data), md5=md5)
+                return md5[0]
+            except Exception:
+                if tries >= self.tries:
+                    raise
+                logger.warn('retrying part %d of %s (%d left)', part_num,
+                            self.key_name, self.tries - tries, exc_info=True)
+                time.sleep(tries)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        data = ''.join(self._buffer)
+        self._buffer = []
+        if self._upload is None:
+            Key(self.bucket, self.key_name).set_contents_from_string(data)
+            self.etag = hashlib.md5(data).hexdigest()
+            return
         try:
-            access = open(aws_access_key_id_path).read().strip()
-            secret = open(aws_secret_access_key_path).read().strip()
-            params = (access, secret)
+            if data:
+                self._submit(data)
+            while self._pending:
+                self._etags.append(self._pending.popleft().get())
+            parts = ''.join('<Part><PartNumber>%d</PartNumber>'
+                            '<ETag>"%s"</ETag></Part>' % (part_num, etag)
+                            for part_num, etag in enumerate(self._etags, 1))
+            self.bucket.complete_multipart_upload(
+                self.key_name, self._upload.id,
+                '<CompleteMultipartUpload>%s</CompleteMultipartUpload>'
+                % parts)
+            self.etag = '%s-%d' % (
+                hashlib.md5(''.join(etag.decode('hex')
+                                    for etag in self._etags)).hexdigest(),
+                len(self._etags))
         except:
-            logger.error('failed reading aws credentials from configured file', exc_info=True)
+            self.abort()
             raise
+        finally:
+            self._close_pool()
+
+    def abort(self):
+        '''Give up on the upload, discarding any parts sent.'''
+        self.closed = True
+        self._close_pool()
+        if self._upload is not None:
+            try:
+                self._upload.cancel_upload()
+            except Exception:
+                logger.warn('failed to cancel upload of %s', self.key_name,
+                            exc_info=True)
+            self._upload = None
+
+    def _close_pool(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
 
-    conn = S3Connection(*params)
-    bucket = conn.get_bucket(bucket_name)
-    return bucket
+
+class _md5_reader(object):
+    '''file object that computes the md5 of what is read through it'''
+    mode = 'rb'
+
+    def __init__(self, fh):
+        self._fh = fh
+        self.md5 = hashlib.md5()
+
+    def read(self, *args):
+        data = self._fh.read(*args)
+        self.md5.update(data)
+        return data
 
 
 class from_s3_chunks(Configured):
@@ -197,6 +634,14 @@ class from_s3_chunks(Configured):
           aws_secret_access_key_path: keys/aws_secret_access_key
 
           # Optional parameters.
+
+          # Connections and buckets are shared by all of the S3
+          # stages in the process and reused across retries, keeping
+          # up to s3_connection_pool_size idle HTTP connections open
+          # per host (default 10).  Set s3_keep_alive to false to
+          # connect afresh for every chunk.
+          s3_keep_alive: true
+          s3_connection_pool_size: 10
           
           # The number of times to try reading from s3. A value of
           # `1` means the download is tried exactly once.
@@ -229,6 +674,34 @@ class from_s3_chunks(Configured):
           # Uses your system's default tmp directory (usually `/tmp`)
           # by default.
           tmp_dir_path: /tmp
+
+          # When set, unencrypted StreamItem chunks are downloaded
+          # with several concurrent HTTP range requests, decompressed
+          # and md5-verified as the bytes arrive, and stream items are
+          # produced before the download finishes, instead of holding
+          # the whole chunk in memory first.  An md5 mismatch is then
+          # raised after the last stream item.  Each range request is
+          # tried up to `tries` times.  Disabled by default.
+          streaming_download: true
+          download_part_size: 8388608
+          download_threads: 4
+
+          # When the pipeline is run over several inputs, download,
+          # decrypt, decompress and verify this many of the inputs
+          # after the current one in the background, into a spool
+          # directory under prefetch_dir_path (default: the system
+          # temporary directory).  0, the default, disables this.
+          prefetch: 2
+          prefetch_dir_path: /tmp
+
+          # Keep the decrypted, decompressed contents of chunks read
+          # in a cache directory shared by all pipelines on this host,
+          # and read them from there instead of S3 when the object's
+          # ETag is unchanged.  The least recently used chunks are
+          # removed when the cache grows past chunk_cache_max_bytes.
+          # Disabled by default.
+          chunk_cache_path: /data/chunk-cache
+          chunk_cache_max_bytes: 8589934592
     '''
     config_name = 'from_s3_chunks'
     default_config = {
@@ -239,17 +712,33 @@ class from_s3_chunks(Configured):
         'gpg_decryption_key_path': None,
         'input_format': 'StreamItem',
         'streamcorpus_version': 'v0_3_0',
+        'streaming_download': False,
+        'download_part_size': DOWNLOAD_PART_SIZE,
+        'download_threads': 4,
+        'prefetch': 0,
+        'prefetch_dir_path': None,
+        'chunk_cache_path': None,
+        'chunk_cache_max_bytes': None,
     }
 
     def __init__(self, config):
         super(from_s3_chunks, self).__init__(config)
         self.gpg_decryption_key_path = config.get('gpg_decryption_key_path')
-
-    def __call__(self, i_str):
-        '''
-        Takes a path suffix as a string over stdin and generates chunks from
-        s3://<bucket><s3_prefix_path>/{i_str}.
-        '''
+        self.chunk_cache = ChunkCache.from_config(config)
+        self.prefetch_depth = config.get('prefetch') or 0
+        self._prefetcher = None
+        if self.prefetch_depth:
+            self._prefetcher = Prefetcher(
+                self._fetch_input, self.prefetch_depth,
+                spool_dir_path=config.get('prefetch_dir_path'))
+
+    def prefetch(self, i_strs):
+        '''start fetching the inputs after the first of `i_strs`'''
+        if self._prefetcher is not None:
+            self._prefetcher.hint(i_strs)
+
+    def _split_input(self, i_str):
+        '''get (bucket name or None, key path) for `i_str`'''
         if i_str.startswith('s3://'):
             # full path including bucket name
             bucket_name, kpath = i_str[5:].split('/', 1)
@@ -259,9 +748,40 @@ class from_s3_chunks(Configured):
             bucket_name = None
             kpath = os.path.join(self.config['s3_path_prefix'].strip(),
                                  i_str.strip())
+        return bucket_name, kpath
+
+    def __call__(self, i_str):
+        '''
+        Takes a path suffix as a string over stdin and generates chunks from
+        s3://<bucket><s3_prefix_path>/{i_str}.
+        '''
+        bucket_name, kpath = self._split_input(i_str)
         logger.info('from_s3_chunks: %s / %r', bucket_name, kpath)
+        logger.debug('s3 connection pool: %r', connection_pool.report())
+        if self._prefetcher is not None:
+            path = self._prefetcher.take(i_str)
+            if path is not None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.remove(path)
+                return self._decode(data)
         return self.get_chunk(bucket_name, kpath)
 
+    def _fetch_input(self, i_str, path, tmp_dir):
+        '''write the decrypted, decompressed contents of `i_str` to
+        `path`, for :class:`~streamcorpus_pipeline._prefetch.Prefetcher`'''
+        bucket_name, kpath = self._split_input(i_str)
+        if not self._fetch(bucket_name, kpath, path, tmp_dir):
+            raise FailedVerification('could not prefetch %r' % i_str)
+
+    @_retry
+    def _fetch(self, bucket_name, key_path, path, tmp_dir):
+        data = self._cached_data(self._get_key(bucket_name, key_path),
+                                 tmp_dir)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return True
+
     def _decode(self, data):
         '''
         Given the raw data from s3, return a generator for the items
@@ -277,15 +797,7 @@ class from_s3_chunks(Configured):
         if informat == 'spinn3r':
             return _generate_stream_items(data)
         elif informat == 'streamitem':
-            ver = self.config['streamcorpus_version']
-            if ver not in _message_versions:
-                raise ConfigurationError(
-                    'Not a valid streamcorpus version: %s '
-                    '(choose from: %s)'
-                    % (ver, ', '.join(_message_versions.keys())))
-
-            message = _message_versions[ver]
-            return streamcorpus.Chunk(data=data, message=message)
+            return streamcorpus.Chunk(data=data, message=self._message())
         elif informat == 'featurecollection' and FCChunk is not None:
             return FCChunk(data=data)
         else:
@@ -293,62 +805,154 @@ class from_s3_chunks(Configured):
                 'from_s3_chunks unknown input_format = %r'
                 % informat)
 
-    @_retry
-    def get_chunk(self, bucket_name, key_path):
-        '''return Chunk object full of records
-        bucket_name may be None'''
+    def _message(self):
+        ver = self.config['streamcorpus_version']
+        if ver not in _message_versions:
+            raise ConfigurationError(
+                'Not a valid streamcorpus version: %s '
+                '(choose from: %s)'
+                % (ver, ', '.join(_message_versions.keys())))
+        return _message_versions[ver]
+
+    def _expected_md5(self, key):
+        '''md5 from the name of `key`, or :const:`None` if not
+        checking'''
+        if not self.config['compare_md5_in_file_name']:
+            logger.warn('not checking md5 in file name, consider setting '
+                        'from_s3_chunks:compare_md5_in_file_name')
+            return None
+        logger.info('Verifying md5 for "%s"...' % key.key)
+
+        # The regex hammer.
+        m = re.search('([a-z0-9]{32})(?:\.|$)', key.key)
+        if m is None:
+            raise FailedExtraction(
+                'Could not extract md5 from key "%s". '
+                'Perhaps you should disable compare_md5_in_file_name?'
+                % key.key)
+        return m.group(1)
+
+    def _gpg_private(self, key, encryption):
+        '''private key to decrypt `key` with, or :const:`None` if it
+        is not encrypted'''
+        if encryption != 'gpg':
+            return None
+        if not self.gpg_decryption_key_path:
+            raise FailedExtraction(
+                '%s ends with ".gpg" but gpg_decryption_key_path=%s'
+                % (key.key, self.gpg_decryption_key_path))
+        return self.gpg_decryption_key_path
+
+    def _stream_chunk(self, key, compression, encryption):
+        '''generate stream items from `key` as it downloads'''
+        i_content_md5 = self._expected_md5(key)
+        reader = RangedKeyReader(
+            key, part_size=self.config['download_part_size'],
+            threads=self.config['download_threads'],
+            tries=self.config['tries'])
+        decoded = open_decoded(reader, compression,
+                               self._gpg_private(key, encryption),
+                               tmp_dir=self.config.get('tmp_dir_path'))
+        try:
+            fh = _md5_reader(decoded)
+            for si in streamcorpus.Chunk(file_obj=fh, mode='rb',
+                                         message=self._message()):
+                yield si
+            if i_content_md5 is not None:
+                ## anything after the last message still counts
+                fh.read()
+                md5_recv = fh.md5.hexdigest()
+                if md5_recv != i_content_md5:
+                    raise FailedVerification(
+                        'original md5 = %r != %r = received md5'
+                        % (i_content_md5, md5_recv))
+        finally:
+            decoded.close()
+
+    def _get_key(self, bucket_name, key_path):
         bucket = get_bucket(self.config, bucket_name=bucket_name)
         key = bucket.get_key(key_path)
         if key is None:
             raise FailedExtraction('Key "%s" does not exist.' % key_path)
+        return key
 
-        fh = StringIO()
-        key.get_contents_to_file(fh)
-        data = fh.getvalue()
-        if not data:
+    @_retry
+    def get_chunk(self, bucket_name, key_path):
+        '''return Chunk object full of records
+        bucket_name may be None'''
+        key = self._get_key(bucket_name, key_path)
+        chunk_type, compression, encryption = parse_file_extensions(key_path)
+        if self.chunk_cache is not None:
+            data = self._cache_get(key)
+            if data is not None:
+                return self._decode(data)
+        if (self.config['streaming_download'] and
+                self.config['input_format'].lower() == 'streamitem'):
+            if not key.size:
+                raise FailedExtraction('%s: no data (does the key exist?)'
+                                       % key.key)
+            ## retries from here on are per range request, since
+            ## stream items may already have gone down the pipeline
+            return self._stream_chunk(key, compression, encryption)
+        data = self._get_data(key, self.config.get('tmp_dir_path'))
+        self._cache_put(key, data)
+        return self._decode(data)
+
+    def _cache_key(self, key):
+        '''chunk cache key for `key`, or :const:`None` if it has no
+        ETag'''
+        if not key.etag:
+            return None
+        return self.chunk_cache.key(key.bucket.name, key.key, key.etag)
+
+    def _cache_get(self, key):
+        cache_key = self._cache_key(key)
+        if cache_key is None:
+            return None
+        data = self.chunk_cache.get(cache_key)
+        self.chunk_cache.log_stats(logging.DEBUG)
+        return data
+
+    def _cache_put(self, key, data):
+        if self.chunk_cache is None:
+            return
+        cache_key = self._cache_key(key)
+        if cache_key is not None:
+            self.chunk_cache.put(cache_key, data)
+
+    def _cached_data(self, key, tmp_dir):
+        '''like :meth:`_get_data`, but going through the chunk cache
+        if there is one'''
+        if self.chunk_cache is not None:
+            data = self._cache_get(key)
+            if data is not None:
+                return data
+        data = self._get_data(key, tmp_dir)
+        self._cache_put(key, data)
+        return data
+
+    def _get_data(self, key, tmp_dir):
+        '''download `key`, and return its decrypted, decompressed and
+        verified contents'''
+        chunk_type, compression, encryption = parse_file_extensions(key.key)
+        if not key.size:
             raise FailedExtraction('%s: no data (does the key exist?)'
                                    % key.key)
+        ## gpg and the decompressor work on the download as it arrives
+        with open_decoded(key, compression,
+                          self._gpg_private(key, encryption),
+                          tmp_dir=tmp_dir) as fh:
+            data = fh.read()
+        if not data:
+            msg = 'decrypt and decompress got no data for {0!r}, from {1} ' \
+                  'bytes downloaded'.format(key.key, key.size)
+            logger.error(msg)
+            raise FailedExtraction(msg)
 
-        chunk_type, compression, encryption = parse_file_extensions(key_path)
-        if encryption == 'gpg':
-            if not self.gpg_decryption_key_path:
-                raise FailedExtraction('%s ends with ".gpg" but gpg_decryption_key_path=%s'
-                                       % (key.key, self.gpg_decryption_key_path))
-
-        _errors = []
-        if compression or encryption:
-            _errors, data = decrypt_and_uncompress(
-                data, 
-                self.gpg_decryption_key_path,
-                tmp_dir=self.config.get('tmp_dir_path'),
-                compression=compression,
-                )
-            if not data:
-                msg = 'decrypt_and_uncompress got no data for {0!r}, from {1} bytes' \
-                    + ' downloaded, errors: {2}' \
-                        .format(key_path, len(data), '\n'.join(_errors))
-                logger.error(msg)
-                raise FailedExtraction(msg)
-            logger.info( '\n'.join(_errors) )
-
-        if not self.config['compare_md5_in_file_name']:
-            logger.warn('not checking md5 in file name, consider setting '
-                        'from_s3_chunks:compare_md5_in_file_name')
-        else:
-            logger.info('Verifying md5 for "%s"...' % key.key)
-
-            # The regex hammer.
-            m = re.search('([a-z0-9]{32})(?:\.|$)', key.key)
-            if m is None:
-                raise FailedExtraction(
-                    'Could not extract md5 from key "%s". '
-                    'Perhaps you should disable compare_md5_in_file_name?'
-                    % key.key)
-
-            i_content_md5 = m.group(1)
-            #import pdb; pdb.set_trace()
-            verify_md5(i_content_md5, data, other_errors=_errors)
-        return self._decode(data)
+        i_content_md5 = self._expected_md5(key)
+        if i_content_md5 is not None:
+            verify_md5(i_content_md5, data)
+        return data
 
 
 class to_s3_chunks(Configured):
@@ -387,6 +991,10 @@ class to_s3_chunks(Configured):
 
           # Optional parameters.
 
+          # Shared, pooled connections, as for from_s3_chunks.
+          s3_keep_alive: true
+          s3_connection_pool_size: 10
+
           # The number of times to try writing to s3. A value of
           # `1` means the upload is tried exactly once.
           # The default value is `10`.
@@ -405,6 +1013,16 @@ class to_s3_chunks(Configured):
           # Default: true
           verify: true
 
+          # How to verify.  "download" re-downloads as described
+          # above.  "etag" instead asks S3 for the object's ETag and
+          # size and compares them with digests of the bytes sent
+          # (S3 also checks each request's Content-MD5 on receipt),
+          # and does the full download check on a random
+          # verify_sample_rate fraction of uploads.
+          # Default: download
+          verify_mode: etag
+          verify_sample_rate: 0.01
+
           # If verification fails `tries` times, then the default
           # behavior is to exit, which can cause a coordinate
           # fork_worker parent to retry the whole job.
@@ -440,10 +1058,34 @@ class to_s3_chunks(Configured):
           # compression of archival content (S3 charges by the byte).
           # xz is also the slowest, so other options can make more
           # sense in some applications.  Snappy (.sz) is the fastest
-          # and still much better than no compression at all.  Choices
-          # are "xz", "sz", "gz", ""
+          # and still much better than no compression at all.  zstd
+          # (.zst) and lz4 (.lz4) are also fast, and need the
+          # zstandard and lz4 packages respectively.  Choices
+          # are "xz", "zst", "lz4", "sz", "gz", ""
           compression: xz
 
+          # Compression level for the scheme above; the default is
+          # the scheme's usual default.  Chunks are compressed, and
+          # piped through gpg if encrypting, within this process in
+          # one pass, and the compression ratio and speed are logged.
+          compression_level: 6
+
+          # Compress xz and zst output on this many threads; xz output
+          # is then a series of independently compressed blocks.
+          compression_threads: 1
+
+          # Upload with S3 multipart uploads of upload_part_size bytes
+          # (at least 5 MiB for S3; default 8 MiB), sending parts on
+          # upload_threads connections at once and retrying each part
+          # up to `tries` times.  The chunk is compressed and
+          # encrypted straight into the upload, with no compressed
+          # copy on disk.  Chunks no bigger than one part are sent in
+          # a single request.  Default: false, which compresses and
+          # encrypts to a file first and uploads that in one request.
+          multipart_upload: true
+          upload_part_size: 8388608
+          upload_threads: 4
+
     '''
     config_name = 'to_s3_chunks'
     default_config = {
@@ -453,12 +1095,19 @@ class to_s3_chunks(Configured):
         'gpg_decryption_key_path': None,
         'gpg_recipient': 'trec-kba',
         'verify': True,
+        'verify_mode': 'download',
+        'verify_sample_rate': 0.0,
         'suppress_failures': False,
         'is_private': False,
         'output_format': 'StreamItem',
         'tmp_dir_path': '/tmp',
         'cleanup_tmp_files': True,
         'compression': 'xz',
+        'compression_level': None,
+        'compression_threads': 1,
+        'multipart_upload': False,
+        'upload_part_size': UPLOAD_PART_SIZE,
+        'upload_threads': 4,
         # require: bucket, output_name, aws_access_key_id_path,
         #          aws_secret_access_key_path
     }
@@ -467,9 +1116,12 @@ class to_s3_chunks(Configured):
         super(to_s3_chunks, self).__init__(config)
 
         ## TODO: use something like verify_config
-        if self.compression not in known_compression_schemes:
-            raise Exception('to_s3_chunks "compression: %r" not in %r' % (
-                self.compression, known_compression_schemes))
+        get_codec(self.compression)
+        if self.config.get('verify_mode', 'download') not in \
+                ('download', 'etag'):
+            raise ConfigurationError(
+                'Invalid verify_mode: "%s".  Choose one of download or etag.'
+                % self.config['verify_mode'])
 
         logger.critical('compression: %s' % self.config.get('compression'))
 
@@ -482,6 +1134,7 @@ class to_s3_chunks(Configured):
                 logger.warning('Nonsensical config "verify_via_http=true" and '
                                '"is_private=true". Will verify with boto.')
         self.bucket = get_bucket(self.config)
+        self.compression_stats = CompressionStats()
 
     def __call__(self, t_path, name_info, i_str):
         '''
@@ -508,18 +1161,31 @@ class to_s3_chunks(Configured):
         logger.info('%s: \n\t%r\n\tfrom: %r\n\tby way of %r',
                     self.__class__.__name__, o_path, i_str, t_path)
 
-        t_path2 = self.prepare_on_disk(t_path)
-        data_len = os.path.getsize(t_path2)
-        if data_len == 0:
-            logger.critical('data is now zero bytes!')
-        logger.debug('prepared %s bytes of %r', data_len, t_path2)
-        self.put_data(o_path, t_path2, self.name_info['md5'], data_len)
-
-        self.cleanup(t_path, t_path2)
+        if self.compress_while_uploading:
+            self.put_data(o_path, t_path, self.name_info['md5'],
+                          os.path.getsize(t_path),
+                          compression=self.compression)
+            self.cleanup(t_path)
+        else:
+            t_path2 = self.prepare_on_disk(t_path)
+            data_len = os.path.getsize(t_path2)
+            if data_len == 0:
+                logger.critical('data is now zero bytes!')
+            logger.debug('prepared %s bytes of %r', data_len, t_path2)
+            self.put_data(o_path, t_path2, self.name_info['md5'], data_len)
+            self.cleanup(t_path, t_path2)
         logger.info('%s finished:\n\t input: %s\n\toutput: %s',
                     self.__class__.__name__, i_str, o_path)
+        logger.debug('s3 connection pool: %r', connection_pool.report())
         return [o_path]
 
+    @property
+    def compress_while_uploading(self):
+        '''whether :meth:`put` compresses and encrypts the chunk
+        itself, rather than uploading a file from
+        :meth:`prepare_on_disk`'''
+        return self.config.get('multipart_upload', False)
+
     @property
     def outfmt(self):
         return self.config['output_format'].lower()
@@ -555,42 +1221,132 @@ class to_s3_chunks(Configured):
         return o_path
 
     def prepare_on_disk(self, t_path):
-        logger.debug('gpg_encryption_key_path: %r', self.config.get('gpg_encryption_key_path'))
-        _errors, t_path2 = compress_and_encrypt_path(
-            t_path, 
-            self.config.get('gpg_encryption_key_path'),
-            gpg_recipient=self.config['gpg_recipient'],
-            tmp_dir=self.config.get('tmp_dir_path'),
-            compression=self.config.get('compression'),
-        )
-        if len(_errors) > 0:
-            logger.error('compress and encrypt errors: %r', _errors)
+        gpg_public = self.config.get('gpg_encryption_key_path')
+        logger.debug('gpg_encryption_key_path: %r', gpg_public)
+        compression = self.compression
+        if not compression and gpg_public is None:
+            return t_path
+        t_path2 = t_path
+        if compression:
+            t_path2 += '.' + compression
+        if gpg_public is None:
+            compress_file(t_path, t_path2, compression,
+                          level=self.config.get('compression_level'),
+                          stats=self.compression_stats,
+                          threads=self.config.get('compression_threads'))
+        else:
+            t_path2 += '.gpg'
+            start_time = time.time()
+            bytes_in, bytes_out = encode_file(
+                t_path, t_path2, compression, gpg_public,
+                gpg_recipient=self.config['gpg_recipient'],
+                level=self.config.get('compression_level'),
+                threads=self.config.get('compression_threads') or 1,
+                tmp_dir=self.config.get('tmp_dir_path'))
+            self.compression_stats.add(bytes_in, bytes_out,
+                                       time.time() - start_time)
+        logger.info('to_s3_chunks compression: %s', self.compression_stats)
         return t_path2
 
     def cleanup(self, *files):
         if not self.config['cleanup_tmp_files']:
             return
-        for f in files:
+        for f in set(files):
             try:
                 os.remove(f)
             except Exception as exc:
                 logger.info('%s --> failed to remove %s' % (exc, f))
 
     @_retry
-    def put_data(self, key_path, t_path, md5, data_len=None):
-        timedop('s3 put', data_len, lambda: self.put(key_path, t_path))
+    def put_data(self, key_path, t_path, md5, data_len=None,
+                 compression=''):
+        etag, size = timedop('s3 put', data_len,
+                             lambda: self.put(key_path, t_path, compression))
         if self.config['verify']:
-            ok = timedop('s3 verify', data_len, lambda: self.verify(key_path, md5))
+            if self.config.get('verify_mode', 'download') == 'etag':
+                ok = self.verify_etag(key_path, etag, size)
+                if ok and random.random() < self.config.get(
+                        'verify_sample_rate', 0):
+                    logger.info('sampled full verify of %s', key_path)
+                    ok = timedop('s3 verify', data_len,
+                                 lambda: self.verify(key_path, md5))
+            else:
+                ok = timedop('s3 verify', data_len, lambda: self.verify(key_path, md5))
             if not ok:
                 raise Exception('verify failed putting {0!r}'.format(key_path))
 
-    def put(self, o_path, t_path):
+    def put(self, o_path, t_path, compression=''):
+        '''Upload the file `t_path` to `o_path`, compressing it with
+        `compression` on the way if that is set.
+
+        Returns a pair of the ETag S3 should report for the uploaded
+        object, computed locally, and its size.
+
+        '''
         key = Key(self.bucket, o_path)
-        key.set_contents_from_filename(t_path)
+        if self.config.get('multipart_upload', False):
+            etag, size = self.put_multipart(o_path, t_path, compression)
+        else:
+            assert not compression
+            key.set_contents_from_filename(t_path)
+            etag, size = key.md5, os.path.getsize(t_path)
 
         if not self.config.get('is_private', False):
             # Makes the file have a public URL.
             key.set_acl('public-read')
+        return etag, size
+
+    def verify_etag(self, o_path, etag, size):
+        '''Check that S3 reports `etag` and `size` for `o_path`,
+        without downloading it.'''
+        key = self.bucket.get_key(o_path)
+        if key is None:
+            logger.error('verify found no key %s', o_path)
+            return False
+        got = key.etag.strip('"')
+        if got != etag or key.size != size:
+            logger.error('verify of %s expected ETag %s and %d bytes, '
+                         'got ETag %s and %d bytes',
+                         o_path, etag, size, got, key.size)
+            return False
+        logger.info('verified ETag %s of %s', etag, o_path)
+        return True
+
+    def put_multipart(self, o_path, t_path, compression=''):
+        start_time = time.time()
+        gpg_public = None
+        if self.compress_while_uploading:
+            gpg_public = self.config.get('gpg_encryption_key_path')
+        writer = MultipartKeyWriter(
+            self.bucket, o_path, part_size=self.config['upload_part_size'],
+            threads=self.config['upload_threads'],
+            tries=self.config['tries'])
+        encrypted = None
+        try:
+            fo = writer
+            if gpg_public is not None:
+                fo = encrypted = EncryptedFile(
+                    writer, gpg_public, self.config['gpg_recipient'],
+                    tmp_dir=self.config.get('tmp_dir_path'))
+            if compression:
+                fo = CompressedFile(
+                    fo, compression,
+                    level=self.config.get('compression_level'),
+                    threads=self.config.get('compression_threads') or 1)
+            with open(t_path, 'rb') as fi:
+                shutil.copyfileobj(fi, fo, BLOCK_SIZE)
+            fo.close()
+        except:
+            if encrypted is not None:
+                encrypted.abort()
+            writer.abort()
+            raise
+        if compression:
+            self.compression_stats.add(fo.bytes_in, fo.bytes_out,
+                                       time.time() - start_time)
+            logger.info('to_s3_chunks compression: %s',
+                        self.compression_stats)
+        return writer.etag, writer.bytes_written
 
     @_retry
     def verify(self, o_path, md5):
@@ -603,21 +1359,26 @@ class to_s3_chunks(Configured):
                 '"gpg_decryption_key_path" must also be set.')
 
         if self.config.get('is_private', False):
-            rawdata = self.private_data(o_path)
+            fh = self.private_file(o_path)
         else:
-            rawdata = self.public_data(o_path)
-
-        if not rawdata:
-            logger.error('got no data out of reading the data')
+            fh = self.public_file(o_path)
 
-        errors, data = decrypt_and_uncompress(
-            rawdata,
-            self.config.get('gpg_decryption_key_path'),
-            tmp_dir=self.config.get('tmp_dir_path'),
-            compression=compression,
-        )
-        if not data:
-            logger.error('got no data back from decrypt_and_uncompress %r, (size=%r), errors: %r', o_path, len(rawdata), errors)
+        gpg_private = None
+        if encryption == 'gpg':
+            gpg_private = self.config.get('gpg_decryption_key_path')
+        md5_recv = hashlib.md5()
+        size = 0
+        with open_decoded(fh, compression, gpg_private,
+                          tmp_dir=self.config.get('tmp_dir_path')) as fi:
+            while True:
+                data = fi.read(BLOCK_SIZE)
+                if not data:
+                    break
+                md5_recv.update(data)
+                size += len(data)
+        if not size:
+            logger.error('got no data back from decrypting and '
+                         'decompressing %r', o_path)
             return False
 
         ### Let's not use both belt and suspenders.  md5 is enough.
@@ -641,7 +1402,27 @@ class to_s3_chunks(Configured):
         #    logger.critical('\n\n********\n\nfailure on %r\n\n********\n\n', o_path, exc_info=True)
         #logger.info('attempting verify of %r %r in %r', count, chunk_format, o_path)
         logger.info('attempting verify of %r in %r', chunk_format, o_path)
-        return verify_md5(md5, data, other_errors=errors)
+        md5_recv = md5_recv.hexdigest()
+        if md5 != md5_recv:
+            raise FailedVerification('original md5 = %r != %r = received md5'
+                                     % (md5, md5_recv))
+        return True
+
+    def public_file(self, o_path):
+        '''open the public URL of `o_path` for streaming'''
+        url = 'http://s3.amazonaws.com/%(bucket)s/%(o_path)s' % {
+            'bucket': self.config['bucket'],
+            'o_path': o_path,
+        }
+        logger.info('public fetching %r', url)
+        return requests.get(url, stream=True).raw
+
+    def private_file(self, o_path):
+        '''open `o_path` in the bucket for streaming'''
+        key = self.bucket.get_key(o_path)
+        if key is None:
+            raise FailedVerification('verify found no key %s' % o_path)
+        return key
 
     def public_data(self, o_path):
         url = 'http://s3.amazonaws.com/%(bucket)s/%(o_path)s' % {
@@ -668,6 +1449,9 @@ class to_s3_tarballs(to_s3_chunks):
     '''
     config_name = 'to_s3_tarballs'
 
+    ## the tarball is built on disk by prepare_on_disk
+    compress_while_uploading = False
+
     def __init__(self, config):
         super(to_s3_tarballs, self).__init__(config)
         if self.config['output_format'].lower() != 'streamitem':
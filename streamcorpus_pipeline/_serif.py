@@ -6,25 +6,37 @@
 
 '''
 from __future__ import absolute_import
+import errno
+import fcntl
 import gc
 import logging
 import os
 import shutil
 import subprocess
+import threading
 import time
 import traceback
 import uuid
 
 from yakonfig import ConfigurationError
 
+from streamcorpus import Chunk
+
 from streamcorpus_pipeline.stages import BatchTransform
-from streamcorpus_pipeline._taggers import make_memory_info_msg, align_labels
+from streamcorpus_pipeline._tagger_cache import TaggerCache
+from streamcorpus_pipeline._taggers import make_memory_info_msg, \
+    AlignmentStrategies
 from streamcorpus_pipeline._exceptions import PipelineOutOfMemory, \
     PipelineBaseException
 
 logger = logging.getLogger(__name__)
 
 
+def _set_blocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+
+
 class serif(BatchTransform):
     '''Batch transform to parse and tag documents with Serif.
 
@@ -77,6 +89,20 @@ class serif(BatchTransform):
     `cleanup_tmp_files` (default: true)
       Delete the intermediate files used by Serif
 
+    `streaming` (default: false)
+      Connect Serif's input and output chunk files to this process
+      with named pipes, so that documents are never written to or
+      read back from disk on their way through Serif.  The policy
+      files are written once per stage whether or not this is set.
+
+    `tagger_cache_path`, `tagger_cache_max_bytes`
+      Cache Serif output on disk, keyed by the document's
+      ``clean_html``, ``clean_visible`` and language, so that only
+      new documents are sent to Serif; see
+      :mod:`streamcorpus_pipeline._tagger_cache`.  Not used with
+      ``streamcorpus_read_serifxml``, whose input is the stored
+      SerifXML.
+
     The two "align" options control how ratings on the document
     are associated with tokens generated by Serif.
 
@@ -90,6 +116,7 @@ class serif(BatchTransform):
         'par_additions': {},
         'cleanup_tmp_files': True,
         'serif_exe': 'bin/x86_64/Serif',
+        'streaming': False,
     }
 
     @staticmethod
@@ -229,12 +256,19 @@ OVERRIDE kba_write_serifxml_to_chunk:         true
         self.tagger_root_path = os.path.join(self.config['third_dir_path'],
                                              self.config['path_in_third'])
         self._child = None
+        self._par_dir = None
+        self._par_path = None
+        self._cache = None
+        if self.config['par'] != 'streamcorpus_read_serifxml':
+            self._cache = TaggerCache.from_config(
+                self.tagger_id, self.config,
+                extra=getattr(self, self.config['par'], None),
+                fields=('clean_html', 'clean_visible', 'language'))
 
     def _write_config_par(self, tmp_dir, par_file):
         if par_file == 'streamcorpus_generate_serifxml':
             # streamcorpus_generate_serifxml INCLUDEs streamcorpus_one_step
-            self._write_config_par(tmp_dir, 'streamcorpus_one_step',
-                                   self.tagger_root_path)
+            self._write_config_par(tmp_dir, 'streamcorpus_one_step')
         par_data = getattr(self, par_file)
         for line in self.config.get('par_additions', {}).get(par_file, []):
             par_data += '\n'
@@ -251,30 +285,73 @@ OVERRIDE kba_write_serifxml_to_chunk:         true
                      fpath)
         return fpath
 
+    def _config_par_path(self):
+        '''render the policy files on first use and reuse them for
+        every later chunk'''
+        if self._par_path is None or not os.path.exists(self._par_path):
+            self._par_dir = os.path.join(self.config['tmp_dir_path'],
+                                         'serif-par-' + str(uuid.uuid4()))
+            os.makedirs(self._par_dir)
+            self._par_path = self._write_config_par(self._par_dir,
+                                                    self.config['par'])
+        return self._par_path
+
     def process_path(self, chunk_path):
+        start_time = time.time()
+        par_path = self._config_par_path()
         tmp_dir = os.path.join(self.config['tmp_dir_path'], str(uuid.uuid4()))
         os.mkdir(tmp_dir)
-        par_file = self.config['par']
-        par_path = self._write_config_par(tmp_dir, par_file)
 
-        tmp_chunk_path = os.path.join(tmp_dir, 'output',
-                                      os.path.basename(chunk_path))
+        # send only the documents without cached output to serif
+        cached, cache_keys = {}, {}
+        if self._cache:
+            cached, cache_keys = self._cache.lookup_chunk(
+                Chunk(path=chunk_path, mode='rb'))
+
+        if self.config.get('streaming'):
+            tagged = self._stream_serif(par_path, tmp_dir, chunk_path, cached)
+        else:
+            tagged = self._serif_output(par_path, tmp_dir, chunk_path, cached)
+
+        # the cached and newly tagged documents are merged and aligned
+        # with the ratings in one pass
+        tmp_chunk_path = os.path.join(tmp_dir, os.path.basename(chunk_path))
+        self._write_tagged(chunk_path, tagged, tmp_chunk_path,
+                           cached, cache_keys)
+        if self._cache:
+            self._cache.log_stats()
+
+        if self.config.get('cleanup_tmp_files', True):
+            # default: cleanup tmp directory
+            os.rename(tmp_chunk_path, chunk_path)
+            shutil.rmtree(tmp_dir)
+        else:
+            # for development, no cleanup, leave tmp_file
+            chunk_path_save = ('{0}_pre_serif_{1}'
+                               .format(chunk_path,
+                                       os.path.getmtime(chunk_path)))
+            os.rename(chunk_path, chunk_path_save)
+            shutil.copy(tmp_chunk_path, chunk_path)
+
+        elapsed = time.time() - start_time
+        logger.info('finished tagging in %.1f seconds' % elapsed)
+        return elapsed
 
-        cmd = [
+    def _serif_cmd(self, par_path, tmp_dir, chunk_path):
+        return [
             os.path.join(self.tagger_root_path, self.config['serif_exe']),
             par_path,
             '-o', tmp_dir,
             chunk_path,
         ]
 
+    def _start_serif(self, cmd, **kwargs):
         logger.info('serif cmd: %r', cmd)
 
-        start_time = time.time()
         # make sure we are using as little memory as possible
         gc.collect()
         try:
-            self._child = subprocess.Popen(cmd, stderr=subprocess.PIPE,
-                                           shell=False)
+            self._child = subprocess.Popen(cmd, shell=False, **kwargs)
         except OSError, exc:
             logger.error('error running serif cmd %r', cmd, exc_info=True)
             msg = traceback.format_exc(exc)
@@ -282,8 +359,7 @@ OVERRIDE kba_write_serifxml_to_chunk:         true
             logger.critical(msg)
             raise
 
-        s_out, errors = self._child.communicate()
-
+    def _check_serif(self, errors):
         if not self._child.returncode == 0:
             if self._child.returncode == 137:
                 msg = 'tagger returncode = 137\n' + errors
@@ -298,29 +374,184 @@ OVERRIDE kba_write_serifxml_to_chunk:         true
                 raise PipelineBaseException('tagger exited with %r' %
                                             self._child.returncode)
 
-        # generated new tokens, so align labels with them
-        align_labels(tmp_chunk_path, self.config)
+    def _write_uncached(self, chunk_path, cached, fh=None, path=None):
+        '''write the documents of `chunk_path` that are not in `cached`
+        and return how many there were'''
+        o_chunk = Chunk(path=path, file_obj=fh, mode='wb')
+        num_uncached = 0
+        for pos, si in enumerate(Chunk(path=chunk_path, mode='rb')):
+            if pos not in cached:
+                o_chunk.add(si)
+                num_uncached += 1
+        o_chunk.close()
+        return num_uncached
+
+    def _serif_output(self, par_path, tmp_dir, chunk_path, cached):
+        '''run serif on the uncached documents in `chunk_path` and
+        return an iterator over its output'''
+        serif_input_path = chunk_path
+        if cached:
+            serif_input_path = os.path.join(
+                tmp_dir, 'uncached-' + os.path.basename(chunk_path))
+            if not self._write_uncached(chunk_path, cached,
+                                        path=serif_input_path):
+                logger.info('all serif output for %r was cached', chunk_path)
+                return iter(())
+
+        cmd = self._serif_cmd(par_path, tmp_dir, serif_input_path)
+        self._start_serif(cmd, stderr=subprocess.PIPE)
+        s_out, errors = self._child.communicate()
+        self._check_serif(errors)
 
-        if self.config.get('cleanup_tmp_files', True):
-            # default: cleanup tmp directory
-            os.rename(tmp_chunk_path, chunk_path)
-            shutil.rmtree(tmp_dir)
-        else:
-            # for development, no cleanup, leave tmp_file
-            chunk_path_save = ('{0}_pre_serif_{1}'
-                               .format(chunk_path,
-                                       os.path.getmtime(chunk_path)))
-            os.rename(chunk_path, chunk_path_save)
-            shutil.copy(tmp_chunk_path, chunk_path)
+        return iter(Chunk(path=os.path.join(
+            tmp_dir, 'output', os.path.basename(serif_input_path)),
+            mode='rb'))
 
-        elapsed = time.time() - start_time
-        logger.info('finished tagging in %.1f seconds' % elapsed)
-        return elapsed
+    def _stream_serif(self, par_path, tmp_dir, chunk_path, cached):
+        '''Run serif with named pipes in place of its input and output
+        chunk files, and yield its output documents as they arrive.
+
+        A thread feeds the uncached documents into the input pipe once
+        serif opens it.  This process holds a spare writer on the
+        output pipe until serif exits, so that this generator does not
+        wait forever on a pipe that serif never opened.
+
+        '''
+        num_uncached = sum(1 for pos, _ in enumerate(
+            Chunk(path=chunk_path, mode='rb')) if pos not in cached)
+        if not num_uncached:
+            logger.info('all serif output for %r was cached', chunk_path)
+            return
+
+        in_fifo = os.path.join(tmp_dir,
+                               'input-' + os.path.basename(chunk_path))
+        out_fifo = os.path.join(tmp_dir, 'output',
+                                os.path.basename(in_fifo))
+        os.mkdir(os.path.dirname(out_fifo))
+        os.mkfifo(in_fifo)
+        os.mkfifo(out_fifo)
+        stderr_path = os.path.join(tmp_dir, 'serif-stderr')
+
+        out_fd = os.open(out_fifo, os.O_RDONLY | os.O_NONBLOCK)
+        spare_fd = os.open(out_fifo, os.O_WRONLY)
+        _set_blocking(out_fd)
+
+        exited = threading.Event()
+        feed_errors = []
+
+        def feed():
+            try:
+                while True:
+                    try:
+                        fd = os.open(in_fifo, os.O_WRONLY | os.O_NONBLOCK)
+                        break
+                    except OSError, exc:
+                        ## ENXIO: serif has not opened its input yet
+                        if exc.errno != errno.ENXIO:
+                            raise
+                    if exited.wait(0.01):
+                        return
+                _set_blocking(fd)
+                with os.fdopen(fd, 'wb') as fh:
+                    self._write_uncached(chunk_path, cached, fh=fh)
+            except Exception, exc:
+                ## EPIPE if serif exits without reading everything
+                feed_errors.append(exc)
+
+        def reap():
+            self._child.wait()
+            exited.set()
+            os.close(spare_fd)
+
+        cmd = self._serif_cmd(par_path, tmp_dir, in_fifo)
+        try:
+            with open(stderr_path, 'wb') as stderr:
+                self._start_serif(cmd, stderr=stderr, close_fds=True)
+        except OSError:
+            os.close(spare_fd)
+            os.close(out_fd)
+            raise
+        reaper = threading.Thread(target=reap)
+        reaper.daemon = True
+        reaper.start()
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        num_tagged = 0
+        with os.fdopen(out_fd, 'rb') as fh:
+            for si in Chunk(file_obj=fh, mode='rb'):
+                num_tagged += 1
+                yield si
+        reaper.join()
+        feeder.join()
+
+        with open(stderr_path, 'rb') as stderr:
+            errors = stderr.read()
+        self._check_serif(errors)
+        if feed_errors:
+            raise feed_errors[0]
+        if num_tagged != num_uncached:
+            raise PipelineBaseException(
+                'serif returned %d of %d documents'
+                % (num_tagged, num_uncached))
+
+    def _write_tagged(self, chunk_path, tagged, o_path, cached, cache_keys):
+        '''Write `o_path` with the documents of `chunk_path` in order,
+        taking cached output where there is some and the next document
+        from `tagged` otherwise, caching the newly tagged documents and
+        aligning labels with the serif tokens as they go by.'''
+        aligner = None
+        if self.config.get('align_labels_by'):
+            assert 'aligner_data' in self.config, \
+                'config missing "aligner_data"'
+            aligner = AlignmentStrategies[self.config['align_labels_by']]
+
+        if cached or cache_keys:
+            items = self._merge_cached(chunk_path, tagged, cached, cache_keys)
+        else:
+            items = tagged
+
+        o_chunk = Chunk(path=o_path, mode='wb')
+        for si in items:
+            if aligner is not None:
+                aligner(si, self.config['aligner_data'])
+            o_chunk.add(si)
+        o_chunk.close()
+
+    def _merge_cached(self, chunk_path, tagged, cached, cache_keys):
+        for pos, si in enumerate(Chunk(path=chunk_path, mode='rb')):
+            if pos in cached:
+                self._cache.apply(cached[pos], si)
+            else:
+                tagged_si = next(tagged, None)
+                if tagged_si is None:
+                    raise PipelineBaseException(
+                        'serif returned too few documents for %r'
+                        % chunk_path)
+                assert tagged_si.stream_id == si.stream_id, \
+                    'out of sync: %s != %s' % (tagged_si.stream_id,
+                                               si.stream_id)
+                si = tagged_si
+                if pos in cache_keys:
+                    # before alignment modifies the tokens
+                    self._cache.put(cache_keys[pos], si)
+            yield si
+        ## run `tagged` to its end, so that a streaming serif is
+        ## reaped and its errors and document count are checked
+        num_extra = sum(1 for _ in tagged)
+        if num_extra:
+            raise PipelineBaseException(
+                'serif returned %d more documents than %r has uncached'
+                % (num_extra, chunk_path))
 
     def shutdown(self):
         '''
         send SIGTERM to the tagger child process
         '''
+        if self._par_dir and self.config.get('cleanup_tmp_files', True):
+            shutil.rmtree(self._par_dir, ignore_errors=True)
+            self._par_dir = self._par_path = None
         if self._child:
             try:
                 self._child.terminate()
@@ -0,0 +1,187 @@
+'''On-disk cache of tagger output keyed by the text the tagger reads.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+Rebuilding a corpus usually re-runs the same taggers on documents
+whose ``clean_visible`` has not changed.  :class:`TaggerCache` stores
+the ``taggings``, ``sentences``, ``relations`` and ``attributes`` a
+tagger produced for a document, so that
+:class:`~streamcorpus_pipeline._taggers.TaggerBatchTransform` and
+:class:`~streamcorpus_pipeline._serif.serif` only send the documents
+they have not seen before to the tagger child process.
+
+Entries are addressed by a namespace, derived from the tagger id and
+the parts of the stage configuration that affect tagger output, and a
+digest of the document text.  Each entry is a small file holding a
+serialized :class:`streamcorpus.ContentItem`.  All namespaces share
+one :class:`~streamcorpus_pipeline._disk_cache.DiskCache` directory,
+which several pipelines may use at once, and its size cap.
+
+The cache is enabled for a tagger stage by setting
+``tagger_cache_path``:
+
+.. code-block:: yaml
+
+    lingpipe:
+      tagger_cache_path: /data/tagger-cache
+      tagger_cache_max_bytes: 10000000000
+
+'''
+from __future__ import absolute_import
+import hashlib
+import json
+import logging
+import os
+
+import streamcorpus
+from streamcorpus import ContentItem
+from streamcorpus_pipeline._disk_cache import DiskCache
+
+logger = logging.getLogger(__name__)
+
+#: stage configuration keys that do not change what a tagger produces
+VOLATILE_CONFIG_KEYS = frozenset([
+    'tmp_dir_path', 'cleanup_tmp_files', 'java_heap_size',
+    'align_labels_by', 'aligner_data',
+    'tagger_cache_path', 'tagger_cache_max_bytes',
+])
+
+#: default cap on the total size of a cache directory
+DEFAULT_MAX_BYTES = 2 ** 30
+
+
+def config_namespace(tagger_id, config, extra=None):
+    '''Compute the cache namespace for a tagger and its configuration.
+
+    Every configuration key not in :data:`VOLATILE_CONFIG_KEYS`
+    contributes, so changing a model path, a policy file, or adding
+    an explicit ``tagger_version`` key starts a fresh namespace.
+
+    :param str tagger_id: tagger id, e.g. ``lingpipe``
+    :param dict config: stage configuration
+    :param extra: any additional JSON-able value to fold in, such as
+      a command template
+    :return: hex digest string
+    '''
+    relevant = dict((k, v) for k, v in config.iteritems()
+                    if k not in VOLATILE_CONFIG_KEYS)
+    blob = json.dumps([tagger_id, relevant, extra], sort_keys=True,
+                      default=repr)
+    return hashlib.sha1(blob).hexdigest()
+
+
+class TaggerCache(DiskCache):
+    '''Size-capped on-disk store of per-document tagger output.
+
+    :param str path: root directory of the cache, shared by all
+      namespaces
+    :param str tagger_id: tagger id whose output is stored
+    :param str namespace: from :func:`config_namespace`
+    :param int max_bytes: total size of `path` above which the least
+      recently used entries are evicted
+    :param fields: names of :class:`streamcorpus.ContentItem` fields
+      whose contents determine the tagger output
+
+    .. attribute:: hits
+    .. attribute:: misses
+    .. attribute:: evictions
+
+       Counters since this object was created.
+
+    '''
+    kind = 'tagger cache'
+
+    def __init__(self, path, tagger_id, namespace,
+                 max_bytes=DEFAULT_MAX_BYTES, fields=('clean_visible',)):
+        super(TaggerCache, self).__init__(path, max_bytes)
+        self.tagger_id = tagger_id
+        self.namespace = namespace
+        self.fields = fields
+
+    @classmethod
+    def from_config(cls, tagger_id, config, extra=None, **kwargs):
+        '''Build a cache from stage configuration, or return
+        :const:`None` if ``tagger_cache_path`` is not set.'''
+        path = config.get('tagger_cache_path')
+        if not path:
+            return None
+        return cls(path, tagger_id, config_namespace(tagger_id, config, extra),
+                   max_bytes=int(config.get('tagger_cache_max_bytes',
+                                            DEFAULT_MAX_BYTES)),
+                   **kwargs)
+
+    def key(self, stream_item):
+        '''Digest of the text that the tagger reads from `stream_item`,
+        or :const:`None` if there is no text and so nothing to cache.'''
+        body = stream_item.body
+        if not body or not body.clean_visible:
+            return None
+        digest = hashlib.sha1()
+        for field in self.fields:
+            value = getattr(body, field) or ''
+            if isinstance(value, unicode):
+                value = value.encode('utf8')
+            elif not isinstance(value, str):
+                ## thrift structs such as body.language
+                value = repr(value)
+            digest.update('%s:%d:' % (field, len(value)))
+            digest.update(value)
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, self.namespace, key[:2], key)
+
+    def put(self, key, stream_item):
+        '''Store the output of this cache's tagger in `stream_item`.
+
+        Call this before label alignment, which modifies the tokens.
+        '''
+        tid = self.tagger_id
+        body = stream_item.body
+        content = ContentItem(
+            taggings=dict((k, v) for k, v in body.taggings.iteritems()
+                          if k == tid),
+            sentences={tid: body.sentences.get(tid, [])},
+            relations={tid: body.relations.get(tid, [])},
+            attributes={tid: body.attributes.get(tid, [])},
+        )
+        super(TaggerCache, self).put(key, streamcorpus.serialize(content))
+
+    def lookup_chunk(self, chunk):
+        '''Look up every document in `chunk`.
+
+        Returns a pair of dictionaries keyed by position in `chunk`:
+        the first maps to serialized output for cached documents, the
+        second to the cache key for the uncached documents that can be
+        stored with :meth:`put` once they are tagged.
+        '''
+        cached = {}
+        cache_keys = {}
+        for pos, si in enumerate(chunk):
+            if si.stream_id is None:
+                continue
+            key = self.key(si)
+            if key is None:
+                continue
+            blob = self.get(key)
+            if blob is None:
+                cache_keys[pos] = key
+            else:
+                cached[pos] = blob
+        return cached, cache_keys
+
+    def apply(self, blob, stream_item):
+        '''Copy serialized tagger output from :meth:`get` into
+        `stream_item`.'''
+        content = streamcorpus.deserialize(blob, message=ContentItem)
+        body = stream_item.body
+        body.taggings.update(content.taggings)
+        body.sentences.update(content.sentences)
+        body.relations.update(content.relations)
+        body.attributes.update(content.attributes)
+
+    def log_stats(self):
+        logger.info('tagger cache %s for %s: %d hits, %d misses, '
+                    '%d evictions', self.path, self.tagger_id,
+                    self.hits, self.misses, self.evictions)
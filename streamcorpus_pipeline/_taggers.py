@@ -7,11 +7,13 @@ This software is released under an MIT/X11 open source license.
 Copyright 2012-2013 Diffeo, Inc.
 '''
 from __future__ import absolute_import
+import bisect
 import collections
 import exceptions
 import gc
 import itertools
 import logging
+import operator
 import os
 import shutil
 import subprocess
@@ -25,12 +27,13 @@ import xml.dom.minidom
 
 import streamcorpus
 from streamcorpus import Chunk, Tagging, Label, OffsetType, add_annotation
+from streamcorpus_pipeline._aho_corasick import AhoCorasick
 from streamcorpus_pipeline._clean_visible import make_clean_visible_file, \
     cleanse
-from sortedcollection import SortedCollection
 from streamcorpus_pipeline._exceptions import PipelineOutOfMemory, \
     PipelineBaseException, InvalidStreamItem
 import streamcorpus_pipeline._memory as _memory
+from streamcorpus_pipeline._tagger_cache import TaggerCache
 import streamcorpus_pipeline.stages
 from yakonfig import ConfigurationError
 
@@ -75,6 +78,24 @@ def make_chains_with_names(sentences):
 
     return equiv_ids
 
+## compiled automata are memoized by their pattern tuples, so that the
+## repeated mention lists found across the documents of a chunk are
+## compiled only once
+_AUTOMATON_CACHE_SIZE = 1024
+_automaton_cache = {}
+
+def _cached(key, build):
+    matcher = _automaton_cache.get(key)
+    if matcher is None:
+        if len(_automaton_cache) >= _AUTOMATON_CACHE_SIZE:
+            _automaton_cache.clear()
+        matcher = _automaton_cache[key] = build()
+    return matcher
+
+def _substring_automaton(names):
+    names = tuple(names)
+    return _cached(('substring', names), lambda: AhoCorasick(names))
+
 def ALL_mentions(target_mentions, chain_mentions):
     '''
     For each name string in the target_mentions list, searches through
@@ -88,17 +109,24 @@ def ALL_mentions(target_mentions, chain_mentions):
 
     :returns bool:
     '''
-    found_all = True
-    for name in target_mentions:
-        found_one = False
-        for chain_ment in chain_mentions:
-            if name in chain_ment:
-                found_one = True
-                break
-        if not found_one:
-            found_all = False
+    if not target_mentions:
+        return True
+    automaton = _substring_automaton(target_mentions)
+    return len(_found_names(automaton, chain_mentions)) == len(automaton)
+
+
+def _found_names(automaton, chain_mentions, wanted=None):
+    '''Return the set of pattern indexes in `automaton` that occur in
+    any of `chain_mentions`, stopping early once every pattern (or the
+    predicate `wanted`, if given) is satisfied.'''
+    found = set()
+    for chain_ment in chain_mentions:
+        found.update(automaton.empty)
+        for _, _, idx in automaton.iter_matches(chain_ment):
+            found.add(idx)
+        if len(found) == len(automaton) or (wanted and wanted(found)):
             break
-    return found_all
+    return found
 
 
 def ANY_MULTI_TOKEN_mentions(multi_token_target_mentions, chain_mentions):
@@ -114,10 +142,22 @@ def ANY_MULTI_TOKEN_mentions(multi_token_target_mentions, chain_mentions):
 
     :returns bool:
     '''
+    ## one automaton over the parts of every name; each name is then
+    ## the set of part indexes that must all be found
+    groups = []
+    parts = []
     for multi_token_name in multi_token_target_mentions:
-        if ALL_mentions(multi_token_name.split(), chain_mentions):
+        name_parts = multi_token_name.split()
+        if not name_parts:
             return True
-    return False
+        groups.append(range(len(parts), len(parts) + len(name_parts)))
+        parts.extend(name_parts)
+    if not groups:
+        return False
+    automaton = _substring_automaton(parts)
+    def satisfied(found):
+        return any(all(idx in found for idx in group) for group in groups)
+    return satisfied(_found_names(automaton, chain_mentions, satisfied))
 
 
 def ANY_mentions(target_mentions, chain_mentions):
@@ -133,10 +173,12 @@ def ANY_mentions(target_mentions, chain_mentions):
 
     :returns bool:
     '''
-    for name in target_mentions:
-        for chain_ment in chain_mentions:
-            if name in chain_ment:
-                return True
+    if not target_mentions:
+        return False
+    automaton = _substring_automaton(target_mentions)
+    for chain_ment in chain_mentions:
+        if automaton.empty or automaton.search(chain_ment):
+            return True
     return False
 
 _CHAIN_SELECTORS = dict(
@@ -208,6 +250,38 @@ def _get_tagger_id(stream_item, aligner_data):
     return tagger_id
 
 
+class TokenOffsetIndex(object):
+    '''Index of a document's tokens by the start of one offset type.
+
+    Built once per document, the index answers each label's lookup
+    with two binary searches instead of a pass over every token, so
+    aligning thousands of labels, as produced by
+    :mod:`~streamcorpus_pipeline._hyperlink_labels`, stays cheap.
+
+    :param sentences: list of :class:`streamcorpus.Sentence`
+    :param offset_type: :class:`streamcorpus.OffsetType` value that
+      every token must have
+    '''
+    def __init__(self, sentences, offset_type):
+        ## sort stably so tokens sharing a start stay in document order
+        decorated = sorted(
+            ((tok.offsets[offset_type].first, pos, tok)
+             for pos, tok in enumerate(itertools.chain(
+                     *[sent.tokens for sent in sentences]))),
+            key=operator.itemgetter(0, 1))
+        self._starts = [first for first, _, _ in decorated]
+        self._tokens = [tok for _, _, tok in decorated]
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def find_range(self, first, end):
+        '''Return the tokens whose offsets start in [first, end).'''
+        lo = bisect.bisect_left(self._starts, first)
+        hi = bisect.bisect_left(self._starts, end, lo)
+        return self._tokens[lo:hi]
+
+
 def line_offset_labels(stream_item, aligner_data):
     ## get a set of tokens -- must have OffsetType.LINES in them.
     tagger_id = _get_tagger_id(stream_item, aligner_data)
@@ -215,6 +289,8 @@ def line_offset_labels(stream_item, aligner_data):
 
     required_annotator_id = aligner_data.get('annotator_id')
 
+    token_index = None
+
     ## if labels on ContentItem, then make labels on Tokens
     for annotator_id in stream_item.body.labels:
         if (required_annotator_id is not None) and (annotator_id != required_annotator_id):
@@ -230,15 +306,13 @@ def line_offset_labels(stream_item, aligner_data):
             #    '\n'.join(hope_original.split('\n')[label_off.first:
             #         label_off.first+label_off.length]))
 
-            ## These next few steps are probably the most
-            ## memory intensive, because they fully
-            ## instantiate all the tokens.
-            token_collection = SortedCollection(
-                itertools.chain(*[sent.tokens for sent in sentences]),
-                key=lambda tok: tok.offsets[OffsetType.LINES].first
-                )
+            ## This is probably the most memory intensive step,
+            ## because it fully instantiates all the tokens; do it
+            ## only once, and only if there is a label to align.
+            if token_index is None:
+                token_index = TokenOffsetIndex(sentences, OffsetType.LINES)
 
-            toks = token_collection.find_range(
+            toks = token_index.find_range(
                     label_off.first, label_off.first + label_off.length)
 
             for tok in toks:
@@ -271,10 +345,7 @@ def _offset_labels(stream_item, aligner_data, offset_type='BYTES'):
     ## memory intensive, because they fully
     ## instantiate all the tokens.
 
-    token_collection = SortedCollection(
-        itertools.chain(*[sent.tokens for sent in sentences]),
-        key=lambda tok: tok.offsets[offset_type].first
-        )
+    token_index = TokenOffsetIndex(sentences, offset_type)
 
     required_annotator_id = aligner_data.get('annotator_id')
 
@@ -313,15 +384,11 @@ def _offset_labels(stream_item, aligner_data, offset_type='BYTES'):
             #print 'L: %d\t%r\t%r' % (label_off.first, label_off.value,
             #                         '\n'.join(hope_original.split('\n')[label_off.first:label_off.first+label_off.length]))
 
-            #print 'tc %d %r' % (len(token_collection), token_collection._keys)
             #print 'label_off.first=%d, length=%d, value=%r' % (label_off.first, label_off.length, label_off.value)
 
-            toks = token_collection.find_range(
+            toks = token_index.find_range(
                     label_off.first, label_off.first + label_off.length)
 
-            #print "find_le: ", token_collection.find_le(label_off.first)
-
-            toks = list(toks)
             #print 'aligned tokens', toks
 
             for tok in toks:
@@ -345,6 +412,119 @@ def _offset_labels(stream_item, aligner_data, offset_type='BYTES'):
                 '''
 
 
+## a cleansed mention word containing none of these is matched by
+## plain string equality rather than as a regex
+_REGEX_METACHARS = frozenset(u'.^$*+?{}[]\\|()')
+
+def _compile_mention(mention):
+    '''Convert one Rating.mentions string into the list of patterns
+    that consecutive non-empty cleansed token strings must match.
+
+    Returns ``(True, [word, ...])`` when every pattern is a plain
+    cleansed word, or ``(False, [regex, ...])`` when some part of the
+    mention is an explicit ``ur"^...$"`` regex or contains regex
+    syntax; the latter is matched by :func:`_regex_look_ahead_match`.
+    '''
+    patterns = []
+    literal = True
+    mpatterns = mention.decode('utf8').split(' ')
+    for mpat in mpatterns:
+        if mpat.startswith('ur"^') and mpat.endswith('$"'): # is not regex
+            ## chop out the meat of the regex so we can reconstitute it below
+            mpat = mpat[4:-2]
+            literal = False
+        else:
+            mpat = cleanse(mpat)
+            if _REGEX_METACHARS.intersection(mpat):
+                literal = False
+        if mpat:
+            patterns.append(mpat)
+    if literal:
+        return True, patterns
+    regexes = []
+    for mpat in patterns:
+        ## make a unicode raw string
+        ## https://docs.python.org/2/reference/lexical_analysis.html#string-literals
+        mpat = ur'^%s$' % mpat
+        logger.debug('look_ahead_match compiling regex: %s', mpat)
+        regexes.append(re.compile(mpat, re.UNICODE | re.IGNORECASE))
+    return False, regexes
+
+
+class MentionMatcher(object):
+    '''Matches the mentions of many ratings against cleansed tokens.
+
+    All of the plain-word mentions from all of the ratings are compiled
+    into one :class:`~streamcorpus_pipeline._aho_corasick.AhoCorasick`
+    automaton over cleansed words, so a document's tokens are scanned
+    once regardless of how many surface forms are being looked for.
+    Mentions that use regexes fall back to a per-mention scan.
+
+    `mention_lists` has one list of mention strings per rating.
+    '''
+    def __init__(self, mention_lists):
+        self.num_ratings = len(mention_lists)
+        words = []
+        self._word_rating = []
+        self._regexes = []
+        for rating_idx, mentions in enumerate(mention_lists):
+            for m in mentions:
+                literal, patterns = _compile_mention(m)
+                if not patterns:
+                    logger.warn('got empty cleansed mention: %r', m)
+                elif literal:
+                    ## the regexes this replaces were case-insensitive
+                    words.append([word.lower() for word in patterns])
+                    self._word_rating.append(rating_idx)
+                else:
+                    self._regexes.append((rating_idx, patterns))
+        self._automaton = AhoCorasick(words)
+
+    def match(self, tokens):
+        '''Find the tokens matched by each rating.
+
+        `tokens` is a list of tuples, where the first part of each
+        tuple is a list of cleansed strings and the second part is
+        the Token object from which it came.  A match must begin at
+        the first cleansed string of a token and may then span any
+        number of tokens, skipping strings left empty by cleansing.
+
+        Returns a list with one list per rating; each holds the
+        matched tokens, once per match that covered them.
+        '''
+        matched = [[] for _ in xrange(self.num_ratings)]
+
+        ## flatten to the non-empty cleansed strings, remembering the
+        ## token each came from and whether it began that token
+        words = []
+        word_token = []
+        word_starts = []
+        for tok_idx, (strs, _) in enumerate(tokens):
+            for j, word in enumerate(strs):
+                if word:
+                    words.append(word.lower())
+                    word_token.append(tok_idx)
+                    word_starts.append(j == 0)
+
+        for start, end, idx in self._automaton.iter_matches(words):
+            if not word_starts[start]:
+                continue
+            toks = matched[self._word_rating[idx]]
+            for tok_idx in xrange(word_token[start], word_token[end] + 1):
+                toks.append(tokens[tok_idx][1])
+
+        for rating_idx, mregexes in self._regexes:
+            matched[rating_idx].extend(
+                _regex_look_ahead_match([mregexes], tokens))
+
+        return matched
+
+
+def _mention_matcher(mention_lists):
+    key = tuple(tuple(mentions or ()) for mentions in mention_lists)
+    return _cached(('tokens', key), lambda: MentionMatcher(key))
+
+
 def look_ahead_match(rating, tokens):
     '''iterate through all tokens looking for matches of cleansed tokens
     or token regexes, skipping tokens left empty by cleansing and
@@ -352,30 +532,13 @@ def look_ahead_match(rating, tokens):
     strings when cleansed.  Yields tokens that match.
 
     '''
-    ## this ensures that all cleansed tokens are non-zero length
-    all_mregexes = []
-    for m in rating.mentions:
-        mregexes = []
-        mpatterns = m.decode('utf8').split(' ')
-        for mpat in mpatterns:
-            if mpat.startswith('ur"^') and mpat.endswith('$"'): # is not regex
-                ## chop out the meat of the regex so we can reconstitute it below
-                mpat = mpat[4:-2]
-            else:
-                mpat = cleanse(mpat)
-            if mpat:
-                ## make a unicode raw string
-                ## https://docs.python.org/2/reference/lexical_analysis.html#string-literals
-                mpat = ur'^%s$' % mpat
-                logger.debug('look_ahead_match compiling regex: %s', mpat)
-                mregexes.append(re.compile(mpat, re.UNICODE | re.IGNORECASE))
-
-        if not mregexes:
-            logger.warn('got empty cleansed mention: %r\nrating=%r' % (m, rating))
+    for tok in _mention_matcher([rating.mentions]).match(tokens)[0]:
+        yield tok
 
-        all_mregexes.append(mregexes)
 
-    ## now that we have all_mregexes, go through all the tokens
+def _regex_look_ahead_match(all_mregexes, tokens):
+    '''the general form of :func:`look_ahead_match`, taking a list
+    of lists of compiled regexes, one list per mention'''
     for i in range(len(tokens)):
         for mregexes in all_mregexes:
             if mregexes[0].match(tokens[i][0][0]):
@@ -427,30 +590,36 @@ def multi_token_match(stream_item, aligner_data):
     tokens = map(lambda tok: (cleanse(tok.token.decode('utf8')).split(' '), tok), 
                  itertools.chain(*[sent.tokens for sent in sentences]))    
     required_annotator_id = aligner_data['annotator_id']
-    for annotator_id, ratings in stream_item.ratings.items():
-        if (required_annotator_id is None) or (annotator_id == required_annotator_id):
-            for rating in ratings:
-                label = Label(annotator=rating.annotator,
-                              target=rating.target)
-                
-                num_tokens_matched = 0
-                for tok in look_ahead_match(rating, tokens):
-                    if aligner_data.get('update_labels'):
-                        tok.labels.pop(annotator_id, None)
-                    add_annotation(tok, label)
-                    num_tokens_matched += 1
-
-                if num_tokens_matched == 0:
-                    logger.warning('multi_token_match didn\'t actually match '
-                                   'entity %r in stream_id %r',
-                                   rating.target.target_id,
-                                   stream_item.stream_id)
-                else:
-                    logger.debug('matched %d tokens for %r in %r',
-                                 num_tokens_matched, rating.target.target_id,
-                                 stream_item.stream_id)
+    ratings = [(annotator_id, rating)
+               for annotator_id, ratings in stream_item.ratings.items()
+               if (required_annotator_id is None) or
+                  (annotator_id == required_annotator_id)
+               for rating in ratings]
+    ## match every rating's mentions in a single pass over the tokens
+    matcher = _mention_matcher([rating.mentions for _, rating in ratings])
+    all_matched = matcher.match(tokens)
+    for (annotator_id, rating), matched in zip(ratings, all_matched):
+        label = Label(annotator=rating.annotator,
+                      target=rating.target)
+
+        num_tokens_matched = 0
+        for tok in matched:
+            if aligner_data.get('update_labels'):
+                tok.labels.pop(annotator_id, None)
+            add_annotation(tok, label)
+            num_tokens_matched += 1
+
+        if num_tokens_matched == 0:
+            logger.warning('multi_token_match didn\'t actually match '
+                           'entity %r in stream_id %r',
+                           rating.target.target_id,
+                           stream_item.stream_id)
+        else:
+            logger.debug('matched %d tokens for %r in %r',
+                         num_tokens_matched, rating.target.target_id,
+                         stream_item.stream_id)
 
-                ## stream_item passed by reference, so nothing to return
+        ## stream_item passed by reference, so nothing to return
 
 
 def make_memory_info_msg(clean_visible_path=None, ner_xml_path=None):
@@ -572,6 +741,10 @@ class TaggerBatchTransform(streamcorpus_pipeline.stages.BatchTransform):
     streamcorpus.pipeline.TaggerBatchTransform provides a structure for
     aligning a taggers output with labels and generating
     stream_item.sentences[tagger_id] = [Sentence]
+
+    If config['tagger_cache_path'] is set, tagger output is cached
+    there by :class:`~streamcorpus_pipeline._tagger_cache.TaggerCache`
+    and only documents with new clean_visible are sent to the tagger.
     '''
     template = None
 
@@ -581,21 +754,37 @@ class TaggerBatchTransform(streamcorpus_pipeline.stages.BatchTransform):
         self.config['tagger_root_path'] = \
             os.path.join(self.config['third_dir_path'], 
                          self.config['path_in_third'])
+        self._cache = TaggerCache.from_config(
+            getattr(self, 'tagger_id', None), self.config,
+            extra=self.template)
 
     def process_path(self, chunk_path):
         ## make temporary file paths based on chunk_path
         clean_visible_path = chunk_path + '-clean_visible.xml'
         ner_xml_path       = chunk_path + '-ner.xml'
 
+        ## find documents whose tagger output is already cached
+        cached, cache_keys = {}, {}
+        if self._cache:
+            cached, cache_keys = self._cache.lookup_chunk(
+                Chunk(path=chunk_path, mode='rb'))
+
         ## process the chunk's clean_visible data into xml
         i_chunk = Chunk(path=chunk_path, mode='rb')
-        make_clean_visible_file(i_chunk, clean_visible_path)
+        if cached:
+            i_chunk = (si for pos, si in enumerate(i_chunk)
+                       if pos not in cached)
+        num_tagged = make_clean_visible_file(i_chunk, clean_visible_path)
 
         ## make sure holding nothing that consumes memory
         i_chunk = None
 
         ## generate an output file from the tagger
-        self.make_ner_file(clean_visible_path, ner_xml_path)
+        if cached and not num_tagged:
+            logger.info('all tagger output for %r was cached', chunk_path)
+            ner_xml_path = None
+        else:
+            self.make_ner_file(clean_visible_path, ner_xml_path)
 
         ## make a new output chunk at a temporary path
         tmp_chunk_path     = chunk_path + '_'
@@ -605,16 +794,21 @@ class TaggerBatchTransform(streamcorpus_pipeline.stages.BatchTransform):
         i_chunk = Chunk(path=chunk_path, mode='rb')
 
         ## fuse the output file with i_chunk to make o_chunk
-        self.align_chunk_with_ner(ner_xml_path, i_chunk, o_chunk)
+        self.align_chunk_with_ner(ner_xml_path, i_chunk, o_chunk,
+                                  cached=cached, cache_keys=cache_keys)
 
         ## clean up temp files
         if self.config['cleanup_tmp_files']:
             os.remove(clean_visible_path)
-            os.remove(ner_xml_path)
+            if ner_xml_path:
+                os.remove(ner_xml_path)
 
         ## atomic rename new chunk file into place
         os.rename(tmp_chunk_path, chunk_path)
 
+        if self._cache:
+            self._cache.log_stats()
+
     ## gets called by self.__call__
     def make_ner_file(self, clean_visible_path, ner_xml_path):
         '''run tagger a child process to get XML output'''
@@ -666,69 +860,40 @@ the output path to create.
         #print '%.1f sec --> %.1f StreamItems/second' % (elapsed, rate)
 
     ## gets called by self.__call__
-    def align_chunk_with_ner(self, ner_xml_path, i_chunk, o_chunk):
-        ''' iterate through ner_xml_path to fuse with i_chunk into o_chunk '''
-        ## prepare to iterate over the input chunk
-        input_iter = i_chunk.__iter__()
+    def align_chunk_with_ner(self, ner_xml_path, i_chunk, o_chunk,
+                             cached=None, cache_keys=None):
+        ''' iterate through ner_xml_path to fuse with i_chunk into o_chunk
+
+        `cached` maps positions in `i_chunk` to serialized tagger
+        output from the cache; those documents were left out of
+        `ner_xml_path`, which may be :const:`None` if all of them
+        were.  `cache_keys` maps positions to the cache keys under
+        which newly tagged documents are stored.
+        '''
+        cached = cached or {}
+        cache_keys = cache_keys or {}
 
-        all_ner = xml.dom.minidom.parse(open(ner_xml_path))
+        if ner_xml_path:
+            all_ner = xml.dom.minidom.parse(open(ner_xml_path))
+            ner_doms = iter(all_ner.getElementsByTagName('FILENAME'))
+        else:
+            ner_doms = iter(())
 
         ## this converts our UTF-8 data into unicode strings, so when
         ## we want to compute byte offsets or construct tokens, we
         ## must .encode('utf8')
-        for ner_dom in all_ner.getElementsByTagName('FILENAME'):
-        #for stream_id, raw_ner in files(open(ner_xml_path).read().decode('utf8')):
-
-            stream_item = input_iter.next()
-
-            ## get stream_id out of the XML
-            stream_id = ner_dom.attributes.get('stream_id').value
-            if stream_item.stream_id is None:
-                assert not stream_id, 'out of sync: None != %r' % stream_id
-                logger.critical('si.stream_id is None... ignoring')
-                continue
-            assert stream_id and stream_id == stream_item.stream_id, \
-                '%s != %s' % (stream_id, stream_item.stream_id)
-
-            if not stream_item.body:
-                ## the XML better have had an empty clean_visible too...
-                #assert not ner_dom....something
-                continue
-
-            tagging = Tagging()
-            tagging.tagger_id = self.tagger_id  # pylint: disable=E1101
-
-            '''
-            ## get this one file out of its FILENAME tags
-            tagged_doc_parts = list(files(ner_dom.toxml()))
-            if not tagged_doc_parts:
-                continue
-
-            tagged_doc = tagged_doc_parts[0][1]
-
-            ## hack
-            hope_original = make_clean_visible(tagged_doc, '')
-            open(ner_xml_path + '-clean', 'wb').write(hope_original.encode('utf-8'))
-            print ner_xml_path + '-clean'
-            '''
-
-            #tagging.raw_tagging = tagged_doc
-            tagging.generation_time = streamcorpus.make_stream_time()
-            stream_item.body.taggings[self.tagger_id] = tagging       # pylint: disable=E1101
-
-            ## could consume lots of memory here by instantiating everything
-            sentences, relations, attributes = self.get_sentences(ner_dom)
-            stream_item.body.sentences[self.tagger_id] = sentences    # pylint: disable=E1101
-            stream_item.body.relations[self.tagger_id] = relations    # pylint: disable=E1101
-            stream_item.body.attributes[self.tagger_id] = attributes  # pylint: disable=E1101
-
-            logger.debug('finished aligning tokens %s' % stream_item.stream_id)
-
-            '''
-            for num, sent in enumerate(sentences):
-                for tok in sent.tokens:
-                    print '%d\t%d\t%s' % (num, tok.offsets[OffsetType.LINES].first, repr(tok.token))
-            '''
+        for pos, stream_item in enumerate(i_chunk):
+            if pos in cached:
+                self._cache.apply(cached[pos], stream_item)
+            else:
+                ner_dom = next(ner_doms, None)
+                if ner_dom is None:
+                    break
+                if not self._add_tagging(stream_item, ner_dom):
+                    continue
+                if pos in cache_keys:
+                    ## store before aligning, which modifies the tokens
+                    self._cache.put(cache_keys[pos], stream_item)
 
             if 'align_labels_by' in self.config and self.config['align_labels_by']:
                 assert 'aligner_data' in self.config, 'config missing "aligner_data"'
@@ -756,6 +921,59 @@ the output path to create.
             logger.critical(msg)
             raise PipelineOutOfMemory(msg)
 
+    def _add_tagging(self, stream_item, ner_dom):
+        '''put the tagger output in `ner_dom` into `stream_item`;
+        returns False if the item should be dropped'''
+        ## get stream_id out of the XML
+        stream_id = ner_dom.attributes.get('stream_id').value
+        if stream_item.stream_id is None:
+            assert not stream_id, 'out of sync: None != %r' % stream_id
+            logger.critical('si.stream_id is None... ignoring')
+            return False
+        assert stream_id and stream_id == stream_item.stream_id, \
+            '%s != %s' % (stream_id, stream_item.stream_id)
+
+        if not stream_item.body:
+            ## the XML better have had an empty clean_visible too...
+            #assert not ner_dom....something
+            return False
+
+        tagging = Tagging()
+        tagging.tagger_id = self.tagger_id  # pylint: disable=E1101
+
+        '''
+        ## get this one file out of its FILENAME tags
+        tagged_doc_parts = list(files(ner_dom.toxml()))
+        if not tagged_doc_parts:
+            continue
+
+        tagged_doc = tagged_doc_parts[0][1]
+
+        ## hack
+        hope_original = make_clean_visible(tagged_doc, '')
+        open(ner_xml_path + '-clean', 'wb').write(hope_original.encode('utf-8'))
+        print ner_xml_path + '-clean'
+        '''
+
+        #tagging.raw_tagging = tagged_doc
+        tagging.generation_time = streamcorpus.make_stream_time()
+        stream_item.body.taggings[self.tagger_id] = tagging       # pylint: disable=E1101
+
+        ## could consume lots of memory here by instantiating everything
+        sentences, relations, attributes = self.get_sentences(ner_dom)
+        stream_item.body.sentences[self.tagger_id] = sentences    # pylint: disable=E1101
+        stream_item.body.relations[self.tagger_id] = relations    # pylint: disable=E1101
+        stream_item.body.attributes[self.tagger_id] = attributes  # pylint: disable=E1101
+
+        logger.debug('finished aligning tokens %s' % stream_item.stream_id)
+
+        '''
+        for num, sent in enumerate(sentences):
+            for tok in sent.tokens:
+                print '%d\t%d\t%s' % (num, tok.offsets[OffsetType.LINES].first, repr(tok.token))
+        '''
+        return True
+
     def get_sentences(self, ner_dom):
         '''parse the sentences and tokens out of the XML'''
         raise exceptions.NotImplementedError
@@ -4,22 +4,152 @@
    Copyright 2012-2015 Diffeo, Inc.
 
 .. autoclass:: nltk_tokenizer
+.. autoclass:: nltk_tokenizer_batch
 
 '''
 from __future__ import absolute_import
+import bisect
+import cPickle as pickle
 import logging
+import multiprocessing
+import os
 
 from nltk.tokenize import WhitespaceTokenizer
 from nltk.tokenize.punkt import PunktSentenceTokenizer
 
-from sortedcollection import SortedCollection
 import streamcorpus
-from streamcorpus import Token, Sentence, Offset, OffsetType
-from streamcorpus_pipeline.stages import IncrementalTransform
+from streamcorpus import Chunk, Token, Sentence, Offset, OffsetType
+from streamcorpus_pipeline.stages import BatchTransform, IncrementalTransform
 
 logger = logging.getLogger(__name__)
 
 
+def load_sentence_tokenizer(punkt_model_path=None):
+    '''Get a Punkt sentence tokenizer.
+
+    If `punkt_model_path` is given, it names a pickled, trained
+    :class:`~nltk.tokenize.punkt.PunktSentenceTokenizer` such as
+    ``tokenizers/punkt/english.pickle`` from the :mod:`nltk` data
+    distribution; otherwise an untrained tokenizer is returned.
+
+    '''
+    if punkt_model_path is None:
+        return PunktSentenceTokenizer()
+    with open(punkt_model_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def label_spans(stream_item, annotator_id):
+    '''Get the labels from `annotator_id` that have character offsets.
+
+    Returns a pair of a list of :class:`streamcorpus.Label` sorted by
+    their first character, and a parallel list of ``(first, end)``
+    character ranges suitable for :func:`tokenize`.
+
+    '''
+    labels = stream_item.body.labels.get(annotator_id) or []
+    labels = sorted((l for l in labels if OffsetType.CHARS in l.offsets),
+                    key=lambda label: label.offsets[OffsetType.CHARS].first)
+    spans = []
+    for label in labels:
+        off = label.offsets[OffsetType.CHARS]
+        spans.append((off.first, off.first + off.length))
+    return labels, spans
+
+
+def tokenize(sentence_tokenizer, word_tokenizer, clean_visible, spans=()):
+    '''Split `clean_visible` into sentences and tokens.
+
+    Sentence boundaries are moved so that no sentence splits one of
+    the character ranges in `spans`, which must be sorted by first
+    character.  The result is a list of sentences, each a list of
+    tuples ``(token, char_first, char_length, byte_first, byte_length,
+    span)``, where `token` is UTF-8 and `span` is the index in `spans`
+    of the range covering the token, or -1.  Byte offsets are counted
+    in a single pass that encodes each stretch of text once.
+
+    '''
+    text = clean_visible.decode('utf8')
+    firsts = [first for first, _ in spans]
+    sentences = []
+    char_pos = 0
+    byte_pos = 0
+    previous_end = 0
+    for start, end in sentence_tokenizer.span_tokenize(text):
+        # no need to check start, because the first byte of text
+        # is always first byte of first sentence, and we will
+        # have already made the previous sentence longer on the
+        # end if there was an overlap.
+        if start < previous_end:
+            start = previous_end
+            if start > end:
+                # skip this sentence... because it was eaten by
+                # an earlier sentence with a label
+                continue
+        span = bisect.bisect_right(firsts, end) - 1
+        if span >= 0:
+            ## avoid splitting a label
+            end = max(spans[span][1], end)
+        previous_end = end
+        sent_str = text[start:end]
+        tokens = []
+        for tok_start, tok_end in word_tokenizer.span_tokenize(sent_str):
+            first = start + tok_start
+            token_str = sent_str[tok_start:tok_end].encode('utf8')
+            byte_pos += len(text[char_pos:first].encode('utf8'))
+            char_pos = first
+            # whitespace tokenizer will never get a token
+            # boundary in the middle of an 'author' label
+            span = bisect.bisect_right(firsts, first) - 1
+            if span >= 0 and spans[span][1] <= first:
+                span = -1
+            tokens.append((token_str, first, tok_end - tok_start,
+                           byte_pos, len(token_str), span))
+        sentences.append(tokens)
+    return sentences
+
+
+def make_sentences(compact, labels=()):
+    '''Build :class:`streamcorpus.Sentence` objects from the output of
+    :func:`tokenize`, attaching `labels`, parallel to the `spans`
+    passed to :func:`tokenize`, to the tokens they cover.'''
+    sentences = []
+    token_num = 0
+    label_to_mention_id = {}
+    for tokens in compact:
+        sent = Sentence()
+        for sentence_pos, (token_str, char_first, char_length,
+                           byte_first, byte_length, span) \
+                in enumerate(tokens):
+            tok = Token(
+                token_num=token_num,
+                token=token_str,
+                sentence_pos=sentence_pos,
+            )
+            tok.offsets[OffsetType.CHARS] = Offset(
+                type=OffsetType.CHARS,
+                first=char_first,
+                length=char_length,
+            )
+            tok.offsets[OffsetType.BYTES] = Offset(
+                type=OffsetType.BYTES,
+                first=byte_first,
+                length=byte_length,
+            )
+            if span >= 0:
+                label = labels[span]
+                streamcorpus.add_annotation(tok, label)
+                logger.debug('adding label to tok: %r has %r',
+                             tok.token, label.target.target_id)
+                if span not in label_to_mention_id:
+                    label_to_mention_id[span] = len(label_to_mention_id)
+                tok.mention_id = label_to_mention_id[span]
+            token_num += 1
+            sent.tokens.append(tok)
+        sentences.append(sent)
+    return sentences
+
+
 class nltk_tokenizer(IncrementalTransform):
     '''Minimal tokenizer using :mod:`nltk`.
 
@@ -32,117 +162,131 @@ class nltk_tokenizer(IncrementalTransform):
     Python package.  However, the tokens that it creates are
     extremely minimal, with no part-of-speech details or other
     information.  The tokens only contain the `token` property and
-    character-offset information.
+    character- and byte-offset information.
 
     If there are labels with character offsets attached to the stream
     item body, and this stage is configured with an `annotator_id`,
     then this stage attempts to attach those labels to tokens.
 
+    If `punkt_model_path` is configured, it is the path to a pickled,
+    trained Punkt sentence tokenizer to use in place of an untrained
+    one.
+
     '''
     config_name = 'nltk_tokenizer'
     tagger_id = 'nltk_tokenizer'
 
     def __init__(self, config):
         super(nltk_tokenizer, self).__init__(config)
-        self.sentence_tokenizer = PunktSentenceTokenizer()
+        self.sentence_tokenizer = load_sentence_tokenizer(
+            self.config.get('punkt_model_path'))
         self.word_tokenizer = WhitespaceTokenizer()  # PunktWordTokenizer()
         self.annotator_id = self.config.get('annotator_id', None)
 
-    def _sentences(self, clean_visible):
-        'generate strings identified as sentences'
-        previous_end = 0
-        clean_visible = clean_visible.decode('utf8')
-        for start, end in self.sentence_tokenizer.span_tokenize(clean_visible):
-            # no need to check start, because the first byte of text
-            # is always first byte of first sentence, and we will
-            # have already made the previous sentence longer on the
-            # end if there was an overlap.
-            if start < previous_end:
-                start = previous_end
-                if start > end:
-                    # skip this sentence... because it was eaten by
-                    # an earlier sentence with a label
-                    continue
-            try:
-                label = self.label_index.find_le(end)
-            except ValueError:
-                label = None
-            if label:
-                ## avoid splitting a label
-                off = label.offsets[OffsetType.CHARS]
-                end = max(off.first + off.length, end)
-            previous_end = end
-            sent_str = clean_visible[start:end]
-            yield start, end, sent_str
-
-    def make_label_index(self, stream_item):
-        'make a sortedcollection on body.labels'
-        labels = stream_item.body.labels.get(self.annotator_id)
-        if not labels:
-            labels = []
-
-        self.label_index = SortedCollection(
-            [l for l in labels if OffsetType.CHARS in l.offsets],
-            key=lambda label: label.offsets[OffsetType.CHARS].first)
-
     def make_sentences(self, stream_item):
         'assemble Sentence and Token objects'
-        self.make_label_index(stream_item)
-        sentences = []
-        token_num = 0
-        new_mention_id = 0
-        for sent_start, sent_end, sent_str in self._sentences(
-                stream_item.body.clean_visible):
-            assert isinstance(sent_str, unicode)
-            sent = Sentence()
-            sentence_pos = 0
-            for start, end in self.word_tokenizer.span_tokenize(sent_str):
-                token_str = sent_str[start:end].encode('utf8')
-                tok = Token(
-                    token_num=token_num,
-                    token=token_str,
-                    sentence_pos=sentence_pos,
-                )
-                tok.offsets[OffsetType.CHARS] = Offset(
-                    type=OffsetType.CHARS,
-                    first=sent_start + start,
-                    length=end - start,
-                )
-                # whitespace tokenizer will never get a token
-                # boundary in the middle of an 'author' label
-                try:
-                    label = self.label_index.find_le(sent_start + start)
-                except ValueError:
-                    label = None
-                if label:
-                    off = label.offsets[OffsetType.CHARS]
-                    if off.first + off.length > sent_start + start:
-                        streamcorpus.add_annotation(tok, label)
-                        logger.debug('adding label to tok: %r has %r',
-                                     tok.token, label.target.target_id)
-
-                        if label in self.label_to_mention_id:
-                            mention_id = self.label_to_mention_id[label]
-                        else:
-                            mention_id = new_mention_id
-                            new_mention_id += 1
-                            self.label_to_mention_id[label] = mention_id
-
-                        tok.mention_id = mention_id
-
-                token_num += 1
-                sentence_pos += 1
-                sent.tokens.append(tok)
-            sentences.append(sent)
-        return sentences
+        labels, spans = label_spans(stream_item, self.annotator_id)
+        compact = tokenize(self.sentence_tokenizer, self.word_tokenizer,
+                           stream_item.body.clean_visible, spans)
+        return make_sentences(compact, labels)
 
     def process_item(self, stream_item, context=None):
         if not stream_item.body.clean_visible:
             return stream_item
 
-        self.label_index = None
-        self.label_to_mention_id = dict()
         sentences = self.make_sentences(stream_item)
         stream_item.body.sentences[self.tagger_id] = sentences
 
         return stream_item
+
+
+## per-process tokenizers for nltk_tokenizer_batch workers
+_worker_tokenizers = None
+
+
+def _init_worker(punkt_model_path):
+    global _worker_tokenizers
+    _worker_tokenizers = (load_sentence_tokenizer(punkt_model_path),
+                          WhitespaceTokenizer())
+
+
+def _tokenize_in_worker(args):
+    clean_visible, spans = args
+    sentence_tokenizer, word_tokenizer = _worker_tokenizers
+    return tokenize(sentence_tokenizer, word_tokenizer, clean_visible, spans)
+
+
+class nltk_tokenizer_batch(BatchTransform):
+    '''Batch version of :class:`nltk_tokenizer` that uses several
+    processes.
+
+    This produces the same sentences and tokens as
+    :class:`nltk_tokenizer`, tagged with ``nltk_tokenizer``, and takes
+    the same `annotator_id` and `punkt_model_path` options.  The
+    documents in each chunk are tokenized in a pool of worker
+    processes, each of which loads the Punkt model once.  Workers send
+    back plain tuples, which are turned into
+    :class:`streamcorpus.Token` objects as the chunk is rewritten.
+
+    .. code-block:: yaml
+
+        nltk_tokenizer_batch:
+          annotator_id: author
+          num_workers: 4
+          batch_size: 16
+
+    `num_workers` defaults to the number of CPUs; with 1, documents
+    are tokenized in the pipeline process.  `batch_size` is the number
+    of documents sent to a worker at a time.
+
+    '''
+    config_name = 'nltk_tokenizer_batch'
+    tagger_id = 'nltk_tokenizer'
+    default_config = {
+        'num_workers': None,
+        'batch_size': 16,
+    }
+
+    def __init__(self, config):
+        super(nltk_tokenizer_batch, self).__init__(config)
+        self.annotator_id = self.config.get('annotator_id', None)
+        self.num_workers = (self.config.get('num_workers') or
+                            multiprocessing.cpu_count())
+        self.batch_size = self.config.get('batch_size') or 16
+        self._pool = None
+
+    def _tokenized(self, chunk_path):
+        'yield compact tokens for each document in `chunk_path`'
+        work = ((si.body.clean_visible,
+                 label_spans(si, self.annotator_id)[1])
+                for si in Chunk(path=chunk_path, mode='rb')
+                if si.body and si.body.clean_visible)
+        punkt_model_path = self.config.get('punkt_model_path')
+        if self.num_workers <= 1:
+            _init_worker(punkt_model_path)
+            return (_tokenize_in_worker(args) for args in work)
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(
+                self.num_workers, _init_worker, (punkt_model_path,))
+        return self._pool.imap(_tokenize_in_worker, work, self.batch_size)
+
+    def process_path(self, chunk_path):
+        tokenized = self._tokenized(chunk_path)
+        tmp_path = os.path.join(self.config['tmp_dir_path'],
+                                'nltk-tokenizer-' +
+                                os.path.basename(chunk_path))
+        o_chunk = Chunk(path=tmp_path, mode='wb')
+        for si in Chunk(path=chunk_path, mode='rb'):
+            if si.body and si.body.clean_visible:
+                labels = label_spans(si, self.annotator_id)[0]
+                si.body.sentences[self.tagger_id] = \
+                    make_sentences(next(tokenized), labels)
+            o_chunk.add(si)
+        o_chunk.close()
+        os.rename(tmp_path, chunk_path)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
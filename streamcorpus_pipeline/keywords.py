@@ -4,7 +4,8 @@
    Copyright 2012-2014 Diffeo, Inc.
 '''
 from __future__ import absolute_import
-from streamcorpus_pipeline._kvlayer_table_names import STREAM_ITEM_TABLE_DEFS
+from streamcorpus_pipeline._kvlayer_table_names import STREAM_ITEM_TABLE_DEFS, \
+    STREAM_ITEM_VALUE_DEFS
 from streamcorpus_pipeline._kvlayer_keyword_search import keyword_indexer
 import kvlayer
 import yakonfig
@@ -12,19 +13,21 @@ import yakonfig
 def main():
     import streamcorpus_pipeline
     import argparse
-    parser = argparse.ArgumentParser(description='basic command-line tool for checking indexes built by streamcorpus_pipeline._to_kvlayer.  Accepts a query string as input and print stream_ids of documents that match *any* of the terms')
+    parser = argparse.ArgumentParser(description='basic command-line tool for checking indexes built by streamcorpus_pipeline._to_kvlayer.  Accepts a query string as input and prints the stream_ids and TF-IDF scores of documents that match *any* of the terms, best first')
     parser.add_argument('query_string', nargs='+', help='enter one or more query words; will be combined with OR')
+    parser.add_argument('--all', action='store_true', dest='require_all', help='only match documents with *all* of the terms')
+    parser.add_argument('-n', '--limit', type=int, help='print at most this many results')
 
     modules = [yakonfig, kvlayer]
     args = yakonfig.parse_args(parser, modules)
     config = yakonfig.get_global_config()
 
     kvl = kvlayer.client()
-    kvl.setup_namespace(STREAM_ITEM_TABLE_DEFS)
+    kvl.setup_namespace(STREAM_ITEM_TABLE_DEFS, STREAM_ITEM_VALUE_DEFS)
 
     indexer = keyword_indexer(kvl)
 
-    for si in indexer.search(' '.join(args.query_string)):
-        print si.stream_id
-
-
+    for stream_id, score in indexer.search(' '.join(args.query_string),
+                                           require_all=args.require_all,
+                                           limit=args.limit):
+        print stream_id, score
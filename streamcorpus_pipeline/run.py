@@ -31,8 +31,16 @@ following additional options:
    Runs the pipeline once for each file matching the shell :mod:`glob`
    `pattern`.
 
+When the pipeline runs over several inputs and the reader is
+configured to prefetch, as with the `prefetch` setting of
+:class:`~streamcorpus_pipeline._s3_storage.from_s3_chunks`, the reader
+fetches the next inputs in the background while the current one is
+processed.  It then reads that many inputs ahead, so it will wait for
+more lines from standard input before starting on the current one.
+
 '''
 from __future__ import absolute_import
+import collections
 import copy
 import glob
 import importlib
@@ -207,7 +215,14 @@ def main():
     if args.file_of_paths:
         input_paths = itertools.chain(input_paths, pathfile_iter(args.file_of_paths))
 
-    scp_config = config['streamcorpus_pipeline']
+    pipeline = make_pipeline(config['streamcorpus_pipeline'])
+    process_inputs(pipeline, input_paths, start_count=args.skip)
+
+
+def make_pipeline(scp_config):
+    '''Create a :class:`~streamcorpus_pipeline.Pipeline` from the
+    `streamcorpus_pipeline` configuration block, loading any external
+    stages it names.'''
     stages = PipelineStages()
     if 'external_stages_path' in scp_config:
         stages.load_external_stages(scp_config['external_stages_path'])
@@ -215,14 +230,34 @@ def main():
         for mod in scp_config['external_stages_modules']:
             stages.load_module_stages(mod)
     factory = PipelineFactory(stages)
-    pipeline = factory(scp_config)
-
-    for i_str in input_paths:
-        logger.info('input path %r', i_str)
-        work_unit = SimpleWorkUnit(i_str.strip())
-        work_unit.data['start_chunk_time'] = time.time()
-        work_unit.data['start_count'] = args.skip
-        pipeline._process_task(work_unit)
+    return factory(scp_config)
+
+
+def process_inputs(pipeline, input_paths, start_count=0):
+    '''Run `pipeline` on each of `input_paths` in turn.
+
+    Before each input is run, the pipeline is told about it and the
+    inputs after it, up to the reader's prefetch depth, so that the
+    reader can fetch them in the background.
+
+    '''
+    input_paths = (i_str.strip() for i_str in input_paths)
+    depth = pipeline.prefetch_depth
+    upcoming = collections.deque(itertools.islice(input_paths, depth + 1))
+    try:
+        while upcoming:
+            i_str = upcoming[0]
+            pipeline.prefetch(list(upcoming))
+            logger.info('input path %r', i_str)
+            work_unit = SimpleWorkUnit(i_str)
+            work_unit.data['start_chunk_time'] = time.time()
+            work_unit.data['start_count'] = start_count
+            pipeline._process_task(work_unit)
+            upcoming.popleft()
+            upcoming.extend(itertools.islice(input_paths, 1))
+    finally:
+        pipeline.prefetch([])
+
 
 class SimpleWorkUnit(object):
     '''partially duck-typed coordinate.WorkUnit that wraps strings from
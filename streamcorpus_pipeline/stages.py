@@ -36,6 +36,7 @@ Incremental transforms
 .. autoclass:: streamcorpus_pipeline._filters.filter_domains_substrings
 .. autoclass:: streamcorpus_pipeline._fix_text.fix_text
 .. autoclass:: streamcorpus_pipeline._dedup.dedup
+.. autoclass:: streamcorpus_pipeline._bloom.bloom_dedup
 .. autoclass:: streamcorpus_pipeline._dump_label_stats.dump_label_stats
 .. autoclass:: streamcorpus_pipeline._filters.id_filter
 .. autofunction:: streamcorpus_pipeline._guess_media_type.file_type_stats
@@ -64,11 +65,13 @@ Batch transforms
 .. autoclass:: streamcorpus_pipeline._taggers.name_align_labels
 .. autoclass:: streamcorpus_pipeline._lingpipe.lingpipe
 .. autoclass:: streamcorpus_pipeline._serif.serif
+.. autoclass:: streamcorpus_pipeline._tokenizer.nltk_tokenizer_batch
 
 Writers
 =======
 
 .. autoclass:: streamcorpus_pipeline._local_storage.to_local_chunks
+.. autoclass:: streamcorpus_pipeline._local_index.to_local_index
 .. autoclass:: streamcorpus_pipeline._local_storage.to_local_tarballs
 .. autoclass:: streamcorpus_pipeline._kvlayer.to_kvlayer
 .. autoclass:: streamcorpus_pipeline._s3_storage.to_s3_chunks
@@ -373,6 +376,7 @@ class PipelineStages(StageRegistry):
         self.tryload_stage('_filters', 'filter_domains_substrings')
         self.tryload_stage('_fix_text', 'fix_text')
         self.tryload_stage('_dedup', 'dedup')
+        self.tryload_stage('_bloom', 'bloom_dedup')
         self.tryload_stage('_dump_label_stats', 'dump_label_stats')
         self.tryload_stage('_filters', 'id_filter')
         self.tryload_stage('_guess_media_type', 'file_type_stats')
@@ -403,9 +407,11 @@ class PipelineStages(StageRegistry):
         self.tryload_stage('_taggers', 'multi_token_match_align_labels')
         self.tryload_stage('_lingpipe', 'lingpipe')
         self.tryload_stage('_serif', 'serif')
+        self.tryload_stage('_tokenizer', 'nltk_tokenizer_batch')
 
         # 'writers' move data out of the pipeline
         self.tryload_stage('_local_storage', 'to_local_chunks')
+        self.tryload_stage('_local_index', 'to_local_index')
         self.tryload_stage('_local_storage', 'to_local_tarballs')
         self.tryload_stage('_kvlayer', 'to_kvlayer')
         self.tryload_stage('_s3_storage', 'to_s3_chunks')
@@ -0,0 +1,219 @@
+'''Local stand-in for the parts of Amazon S3 that the pipeline uses.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2015 Diffeo, Inc.
+
+:class:`FakeS3` serves path-style S3 requests from memory on a local
+port, so that the S3 stages can be tested through boto without AWS
+credentials or network access.  It ignores request signatures.  It
+records every request in :attr:`FakeS3.requests` so that tests can
+check how the stages talk to S3.
+
+'''
+from __future__ import absolute_import
+import BaseHTTPServer
+import SocketServer
+import collections
+import hashlib
+import re
+import threading
+import urlparse
+import uuid
+
+_range_re = re.compile(r'bytes=(\d+)-(\d*)$')
+_part_re = re.compile(r'<PartNumber>(\d+)</PartNumber>\s*<ETag>"?(\w+)"?</ETag>')
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _split(self):
+        url = urlparse.urlsplit(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        bucket = parts[0]
+        key = urlparse.unquote(parts[1]) if len(parts) > 1 else ''
+        query = urlparse.parse_qs(url.query, keep_blank_values=True)
+        self.server.fake.requests.append(
+            (self.command, bucket, key, dict(self.headers)))
+        return bucket, key, query
+
+    def _send(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        self._send(status, '<?xml version="1.0" encoding="UTF-8"?>'
+                   '<Error><Code>%s</Code></Error>' % code,
+                   {'Content-Type': 'application/xml'})
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        fake = self.server.fake
+        bucket, key, query = self._split()
+        if bucket not in fake.buckets:
+            return self._error(404, 'NoSuchBucket')
+        if not key:
+            return self._send(200, '<?xml version="1.0" encoding="UTF-8"?>'
+                              '<ListBucketResult><Name>%s</Name>'
+                              '<IsTruncated>false</IsTruncated>'
+                              '</ListBucketResult>' % bucket,
+                              {'Content-Type': 'application/xml'})
+        data = fake.buckets[bucket].get(key)
+        if data is None:
+            return self._error(404, 'NoSuchKey')
+        headers = {'ETag': '"%s"' % fake.etags[bucket, key],
+                   'Last-Modified': 'Thu, 01 Jan 2015 00:00:00 GMT',
+                   'Content-Type': 'application/octet-stream',
+                   'Accept-Ranges': 'bytes'}
+        headers.update(fake.metadata.get((bucket, key), {}))
+        m = _range_re.match(self.headers.get('Range', ''))
+        if m is None:
+            return self._send(200, data, headers)
+        first = int(m.group(1))
+        last = min(int(m.group(2) or len(data) - 1), len(data) - 1)
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last,
+                                                       len(data))
+        self._send(206, data[first:last + 1], headers)
+
+    def do_PUT(self):
+        fake = self.server.fake
+        bucket, key, query = self._split()
+        body = self._body()
+        if bucket not in fake.buckets:
+            return self._error(404, 'NoSuchBucket')
+        if 'acl' in query:
+            return self._send(200)
+        if 'uploadId' in query:
+            upload_id = query['uploadId'][0]
+            part_num = int(query['partNumber'][0])
+            if upload_id not in fake.uploads:
+                return self._error(404, 'NoSuchUpload')
+            with fake.lock:
+                if fake.part_failures[part_num] > 0:
+                    fake.part_failures[part_num] -= 1
+                    return self._error(500, 'InternalError')
+            etag = hashlib.md5(body).hexdigest()
+            fake.uploads[upload_id][part_num] = (etag, body)
+            return self._send(200, '', {'ETag': '"%s"' % etag})
+        fake.put(bucket, key, body, dict(
+            (name, value) for name, value in self.headers.items()
+            if name.lower().startswith('x-amz-meta-')))
+        self._send(200, '', {'ETag': '"%s"' % fake.etags[bucket, key]})
+
+    def do_POST(self):
+        fake = self.server.fake
+        bucket, key, query = self._split()
+        body = self._body()
+        if bucket not in fake.buckets:
+            return self._error(404, 'NoSuchBucket')
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            fake.uploads[upload_id] = {}
+            return self._send(
+                200, '<?xml version="1.0" encoding="UTF-8"?>'
+                '<InitiateMultipartUploadResult><Bucket>%s</Bucket>'
+                '<Key>%s</Key><UploadId>%s</UploadId>'
+                '</InitiateMultipartUploadResult>'
+                % (bucket, key, upload_id),
+                {'Content-Type': 'application/xml'})
+        if 'uploadId' in query:
+            parts = fake.uploads.pop(query['uploadId'][0], None)
+            if parts is None:
+                return self._error(404, 'NoSuchUpload')
+            listed = [(int(num), etag) for num, etag in _part_re.findall(body)]
+            if ([num for num, etag in listed] != range(1, len(parts) + 1) or
+                    any(parts[num][0] != etag for num, etag in listed)):
+                return self._error(400, 'InvalidPart')
+            fake.put(bucket, key, ''.join(parts[num][1]
+                                          for num, etag in listed))
+            etag = '%s-%d' % (hashlib.md5(''.join(
+                parts[num][0].decode('hex') for num, etag in listed))
+                .hexdigest(), len(listed))
+            fake.etags[bucket, key] = etag
+            return self._send(
+                200, '<?xml version="1.0" encoding="UTF-8"?>'
+                '<CompleteMultipartUploadResult><Bucket>%s</Bucket>'
+                '<Key>%s</Key><ETag>"%s"</ETag>'
+                '</CompleteMultipartUploadResult>' % (bucket, key, etag),
+                {'Content-Type': 'application/xml'})
+        self._error(400, 'InvalidRequest')
+
+    def do_DELETE(self):
+        fake = self.server.fake
+        bucket, key, query = self._split()
+        if 'uploadId' in query:
+            fake.uploads.pop(query['uploadId'][0], None)
+        else:
+            fake.buckets.get(bucket, {}).pop(key, None)
+        self._send(204)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeS3(object):
+    '''In-memory S3 service on a local port.
+
+    .. attribute:: buckets
+
+       Map from bucket name to map from key name to contents.
+
+    .. attribute:: requests
+
+       List of ``(method, bucket, key, headers)`` for every request
+       received.
+
+    .. attribute:: uploads
+
+       Map from multipart upload ID to map from part number to
+       ``(etag, data)``, for uploads in progress.
+
+    .. attribute:: part_failures
+
+       Map from part number to the number of times an upload of that
+       part should fail with a 500 error before succeeding.
+
+    '''
+    def __init__(self, buckets=('test-bucket',)):
+        self.buckets = dict((name, {}) for name in buckets)
+        self.etags = {}
+        self.metadata = {}
+        self.requests = []
+        self.uploads = {}
+        self.part_failures = collections.Counter()
+        self.lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, bucket, key, data, metadata=None):
+        self.buckets[bucket][key] = data
+        self.etags[bucket, key] = hashlib.md5(data).hexdigest()
+        self.metadata[bucket, key] = metadata or {}
+
+    def config(self, bucket='test-bucket'):
+        '''stage configuration that connects to this service'''
+        return {'bucket': bucket, 's3_host': '127.0.0.1',
+                's3_port': self.port, 's3_is_secure': False}
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
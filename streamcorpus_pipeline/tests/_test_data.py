@@ -2,6 +2,7 @@
 import os
 from streamcorpus import Chunk, StreamItem_v0_2_0, add_annotation
 from StringIO import StringIO
+import yaml
 
 
 def get_si_irish_duo_tagged_by_basis(test_data_dir):
@@ -70,3 +71,15 @@ def get_john_smith_tagged_by_lingpipe_without_labels_data(test_data_dir):
 
     o_chunk.flush()
     return fh.getvalue()
+
+
+def load_test_config(path, tmpdir):
+    '''Load the pipeline config in the file `path`, with its log,
+    temporary and output directories moved into `tmpdir`.'''
+    with open(path) as f:
+        config = yaml.load(f)
+    spc = config['streamcorpus_pipeline']
+    spc['log_dir_path'] = str(tmpdir.join('logs'))
+    spc['tmp_dir_path'] = str(tmpdir.join('data'))
+    spc['to_local_chunks']['output_path'] = str(tmpdir.join('output'))
+    return config
@@ -1,7 +1,10 @@
 '''py.test hooks for streamcorpus-pipeline.'''
 from __future__ import absolute_import
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
 
 try:
     import sysconfig
@@ -35,3 +38,27 @@ def test_data_dir(request):
         path = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                             '../../data'))
     return path
+
+
+@pytest.yield_fixture(scope='session')
+def gpg_keys():
+    '''paths to a fresh public and private key for "trec-kba"'''
+    home = tempfile.mkdtemp(prefix='test-gpg-')
+    gpg = ['gpg', '--batch', '--quiet', '--homedir', home,
+           '--pinentry-mode', 'loopback', '--passphrase', '']
+    try:
+        subprocess.check_call(gpg + ['--quick-gen-key',
+                                     'trec-kba <test@example.com>',
+                                     'future-default', 'default', 'never'])
+        public = os.path.join(home, 'key.pub')
+        private = os.path.join(home, 'key.private')
+        with open(public, 'wb') as f:
+            subprocess.check_call(gpg + ['--export'], stdout=f)
+        with open(private, 'wb') as f:
+            subprocess.check_call(gpg + ['--export-secret-keys'], stdout=f)
+    except (OSError, subprocess.CalledProcessError):
+        shutil.rmtree(home, ignore_errors=True)
+        pytest.skip('cannot make gpg keys')
+    yield public, private
+    subprocess.call(['gpgconf', '--homedir', home, '--kill', 'gpg-agent'])
+    shutil.rmtree(home, ignore_errors=True)
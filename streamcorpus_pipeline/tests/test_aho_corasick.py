@@ -0,0 +1,24 @@
+from __future__ import absolute_import
+
+from streamcorpus_pipeline._aho_corasick import AhoCorasick
+
+
+def test_overlapping_substrings():
+    automaton = AhoCorasick(['he', 'she', 'his', 'hers'])
+    found = sorted(automaton.iter_matches('ushers'))
+    assert found == [(1, 3, 1), (2, 3, 0), (2, 5, 3)]
+
+
+def test_word_sequences():
+    automaton = AhoCorasick([('john', 'smith'), ('smith',), ('bob',)])
+    words = ['said', 'john', 'smith', 'to', 'bob']
+    assert list(automaton.iter_matches(words)) == [
+        (1, 2, 0), (2, 2, 1), (4, 4, 2)]
+
+
+def test_empty_patterns():
+    automaton = AhoCorasick(['', 'abc'])
+    assert automaton.empty == [0]
+    assert len(automaton) == 2
+    assert not automaton.search('ab')
+    assert automaton.search('xabcx')
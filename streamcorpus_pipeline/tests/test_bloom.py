@@ -0,0 +1,117 @@
+'''tests for the bloom filter of stored stream items
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2016 Diffeo, Inc.
+
+'''
+from __future__ import absolute_import, division
+import os
+
+import pytest
+
+import streamcorpus
+from streamcorpus_pipeline._bloom import BloomFilter, bloom_dedup, \
+    bloom_parameters
+from streamcorpus_pipeline._local_storage import to_local_chunks
+import yakonfig
+
+
+def test_bloom_parameters():
+    num_bits, num_hashes = bloom_parameters(1000, 0.01)
+    assert 9580 <= num_bits <= 9592
+    assert num_bits % 8 == 0
+    assert num_hashes == 7
+    with pytest.raises(ValueError):
+        bloom_parameters(0, 0.01)
+    with pytest.raises(ValueError):
+        bloom_parameters(1000, 1)
+
+
+def test_bloom_filter(tmpdir):
+    path = str(tmpdir.join('sub', 'test.bloom'))
+    bloom = BloomFilter(path, capacity=1000, error_rate=0.01)
+    keys = ['key-%d' % i for i in xrange(1000)]
+    ## a key may collide with those before it
+    added = bloom.add(keys)
+    assert 990 <= added <= 1000
+    assert bloom.add(keys[:10]) == 0
+    assert bloom.count == added
+    assert all(key in bloom for key in keys)
+    bloom.close()
+
+    ## reopened read-only, ignoring the new sizing
+    bloom = BloomFilter(path, capacity=10, error_rate=0.5, writable=False)
+    assert bloom.capacity == 1000
+    assert all(key in bloom for key in keys)
+    false_positives = sum(1 for i in xrange(10000)
+                          if ('other-%d' % i) in bloom)
+    assert false_positives < 300
+    with pytest.raises(IOError):
+        bloom.add(['more'])
+    bloom.close()
+
+    not_bloom = tmpdir.join('not.bloom')
+    not_bloom.write('not a bloom filter')
+    with pytest.raises(ValueError):
+        BloomFilter(str(not_bloom))
+
+
+def test_bloom_filter_shared(tmpdir):
+    path = str(tmpdir.join('test.bloom'))
+    writer = BloomFilter(path, capacity=100)
+    reader = BloomFilter(path, writable=False)
+    assert 'a' not in reader
+    writer.add(['a'])
+    assert 'a' in reader
+    assert reader.count == 1
+
+
+def make_chunk(path, n):
+    sis = []
+    with streamcorpus.Chunk(path=path, mode='wb') as chunk:
+        for i in xrange(n):
+            si = streamcorpus.make_stream_item(
+                1400000000 + i, 'http://example.com/%d' % i)
+            chunk.add(si)
+            sis.append(si)
+    return sis
+
+
+def test_bloom_dedup(tmpdir):
+    bloom_path = str(tmpdir.join('stored.bloom'))
+    t_path = str(tmpdir.join('t_chunk'))
+    sis = make_chunk(t_path, 10)
+    writer = to_local_chunks(config={
+        'output_type': 'otherdir',
+        'output_path': str(tmpdir.mkdir('out')),
+        'output_name': 'chunk',
+        'cleanup_tmp_files': True,
+        'bloom_filter_path': bloom_path,
+        'bloom_capacity': 1000,
+    })
+    writer(t_path, {}, 'i_str')
+    assert os.path.exists(bloom_path)
+
+    dedup = bloom_dedup(config={
+        'bloom_filter_path': bloom_path,
+        'key': 'stream_id',
+        'within_input': True,
+    })
+    context = {'i_str': 'first'}
+    assert all(dedup(si, context) is None for si in sis)
+    new = streamcorpus.make_stream_item(1500000000, 'http://example.com/new')
+    assert dedup(new, context) is new
+    assert dedup(new, context) is None
+    assert (dedup.kept, dedup.dropped) == (1, 11)
+
+    ## the filter is untouched, so a retried input keeps the item
+    assert new.stream_id not in BloomFilter(bloom_path, writable=False)
+    assert dedup(new, {'i_str': 'first again'}) is new
+
+
+def test_bloom_dedup_config():
+    with pytest.raises(yakonfig.ConfigurationError):
+        bloom_dedup.check_config({'key': 'stream_id'}, 'bloom_dedup')
+    with pytest.raises(yakonfig.ConfigurationError):
+        bloom_dedup.check_config({'bloom_filter_path': 'x', 'key': 'url'},
+                                 'bloom_dedup')
@@ -0,0 +1,152 @@
+from __future__ import absolute_import
+import gzip
+import logging
+import os
+
+import pytest
+from backports import lzma
+
+from streamcorpus import Chunk, make_stream_item
+
+import streamcorpus_pipeline._compression
+from streamcorpus_pipeline._compression import CompressedFile, \
+    CompressionStats, compress_file, decompress, get_codec, \
+    parse_file_extensions, benchmark, CODECS
+from streamcorpus_pipeline._exceptions import ConfigurationError
+from streamcorpus_pipeline._local_storage import to_local_chunks, \
+    from_local_chunks
+
+logger = logging.getLogger(__name__)
+
+#: available schemes other than no compression
+SCHEMES = sorted(name for name, codec in CODECS.iteritems()
+                 if name and codec.available)
+
+
+def write_chunk(path, num=20):
+    chunk = Chunk(path=path, mode='wb')
+    for i in xrange(num):
+        si = make_stream_item(i, 'http://example.com/%d' % i)
+        si.body.clean_visible = 'document %d ' % i * 100
+        chunk.add(si)
+    chunk.close()
+
+
+@pytest.mark.parametrize('compression', [''] + SCHEMES)
+def test_compress_file(tmpdir, compression):
+    i_path = str(tmpdir.join('input.sc'))
+    o_path = str(tmpdir.join('output.sc.' + compression))
+    write_chunk(i_path)
+    stats = CompressionStats()
+    bytes_in, bytes_out = compress_file(i_path, o_path, compression,
+                                        stats=stats)
+    with open(i_path, 'rb') as f:
+        data = f.read()
+    with open(o_path, 'rb') as f:
+        compressed = f.read()
+    assert bytes_in == len(data) == stats.bytes_in
+    assert bytes_out == len(compressed) == stats.bytes_out
+    assert decompress(compressed, compression) == data
+    if compression:
+        assert stats.ratio > 1
+    ## no temporary files left behind
+    assert sorted(os.listdir(str(tmpdir))) == sorted(
+        ['input.sc', os.path.basename(o_path)])
+
+
+def test_standard_formats(tmpdir):
+    data = 'hello world\n' * 1000
+    path = str(tmpdir.join('x.gz'))
+    with CompressedFile(open(path, 'wb'), 'gz') as f:
+        f.write(data)
+    assert gzip.open(path).read() == data
+    path = str(tmpdir.join('x.xz'))
+    with CompressedFile(open(path, 'wb'), 'xz', level=1) as f:
+        f.write(data)
+    assert lzma.open(path).read() == data
+
+
+def test_chunk_write_through(tmpdir):
+    path = str(tmpdir.join('x.sc.xz'))
+    chunk = Chunk(file_obj=CompressedFile(open(path, 'wb'), 'xz'),
+                  mode='wb')
+    chunk.add(make_stream_item(0, 'http://example.com/'))
+    chunk.close()
+    assert [si.abs_url for si in Chunk(path=path, mode='rb')] == \
+        ['http://example.com/']
+
+
+def test_unknown_codec():
+    with pytest.raises(ConfigurationError):
+        get_codec('rar')
+
+
+@pytest.mark.parametrize('compression', SCHEMES)
+def test_to_local_chunks_compress(tmpdir, compression):
+    t_path = str(tmpdir.join('t_chunk'))
+    write_chunk(t_path)
+    writer = to_local_chunks(config=dict(
+        to_local_chunks.default_config,
+        output_type='otherdir', output_path=str(tmpdir.join('out')),
+        output_name='%(first)d-%(num)d', compress=True,
+        compression=compression, tmp_dir_path=str(tmpdir)))
+    o_paths = writer(t_path, {'first': 0}, 'input.sc')
+    assert o_paths == [str(tmpdir.join('out', '0-20.sc.' + compression))]
+    assert parse_file_extensions(o_paths[0])[1] == compression
+    with open(o_paths[0], 'rb') as f:
+        data = decompress(f.read(), compression)
+    assert len(list(Chunk(data=data))) == 20
+    assert writer.compression_stats.files == 1
+    assert writer.compression_stats.ratio > 1
+
+    reader = from_local_chunks(config=from_local_chunks.default_config)
+    assert len(list(reader(o_paths[0]))) == 20
+
+
+def test_parse_file_extensions():
+    assert parse_file_extensions('a/b-c.sc.zst.gpg') == ('sc', 'zst', 'gpg')
+    assert parse_file_extensions('a.fc.lz4') == ('fc', 'lz4', None)
+    assert parse_file_extensions('a.sc.xz') == ('sc', 'xz', None)
+    assert parse_file_extensions('a.sc') == ('sc', None, None)
+    assert parse_file_extensions('a.zip') == (None, None, None)
+
+
+@pytest.mark.parametrize('threads', [2, 4])
+def test_parallel_xz(tmpdir, monkeypatch, threads):
+    ## small blocks, so that there are many independent xz streams
+    monkeypatch.setattr(streamcorpus_pipeline._compression,
+                        'XZ_BLOCK_SIZE', 4096)
+    i_path = str(tmpdir.join('input.sc'))
+    o_path = str(tmpdir.join('output.sc.xz'))
+    write_chunk(i_path, 200)
+    compress_file(i_path, o_path, 'xz', threads=threads)
+    with open(i_path, 'rb') as f:
+        data = f.read()
+    assert len(data) > 10 * 4096
+    assert lzma.open(o_path).read() == data
+    with open(o_path, 'rb') as f:
+        assert decompress(f.read(), 'xz') == data
+    assert len(list(Chunk(path=o_path, mode='rb'))) == 200
+
+
+def test_parallel_xz_empty():
+    compressor = get_codec('xz').compressor(threads=2)
+    assert decompress(compressor.compress('') + compressor.flush(),
+                      'xz') == ''
+
+
+@pytest.mark.performance
+def test_codec_benchmark(test_data_dir):
+    paths = [
+        os.path.join(test_data_dir, 'john-smith',
+                     'john-smith-tagged-by-lingpipe-serif-0-197.sc.xz'),
+        os.path.join(test_data_dir, 'test',
+                     'WEBLOG-100-fd5f05c8a680faa2bf8c55413e949bbf'
+                     '-v0_3_0.sc.xz'),
+    ]
+    for scheme, level, stats in benchmark(paths):
+        logger.info('%-4s ratio %6.2f  compress %7.1f MB/s  '
+                    'decompress %7.1f MB/s', scheme, stats.ratio,
+                    stats.mb_per_sec,
+                    stats.bytes_in / stats.decompress_seconds / 2 ** 20)
+        assert stats.ratio > 1
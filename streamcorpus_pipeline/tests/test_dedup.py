@@ -8,7 +8,7 @@ from streamcorpus_pipeline._dedup import dedup
 from streamcorpus_pipeline._pipeline import PipelineFactory
 from streamcorpus_pipeline.stages import PipelineStages
 from streamcorpus_pipeline.tests._test_data import get_test_chunk_path, \
-    get_test_chunk
+    get_test_chunk, load_test_config
 import yakonfig
 
 logger = logging.getLogger(__name__)
@@ -96,8 +96,7 @@ def test_dedup_production_config(test_data_dir):
 def test_dedup_chunk_counts(request, test_data_dir, tmpdir):
     filename = str(request.fspath.dirpath('test_dedup_chunk_counts.yaml'))
     with yakonfig.defaulted_config([streamcorpus_pipeline],
-                                   filename=filename,
-                                   config={'tmp_dir_path': str(tmpdir)}
+                                   config=load_test_config(filename, tmpdir)
     ) as config:
         ## run the pipeline
         pf = PipelineFactory(PipelineStages())
@@ -12,3 +12,17 @@ def test_get_name_info(tmpdir):
     name_info = get_name_info(path, i_str='foo')
     assert name_info['date_now'] == name_info['date_time_now'][:10]
     assert name_info['date_now'] + '-' + name_info['time_now'] == name_info['date_time_now']
+
+
+def test_get_name_info_keys(tmpdir):
+    path = str(tmpdir.join('test_path'))
+    c = Chunk(path, mode='wb')
+    sis = [make_stream_item(28491 + i, 'abs_url_%d' % i) for i in range(3)]
+    for si in sis:
+        c.add(si)
+    c.close()
+
+    assert 'keys' not in get_name_info(path, i_str='foo')
+    name_info = get_name_info(path, i_str='foo', key_attr='stream_id')
+    assert name_info['keys'] == [si.stream_id for si in sis]
+    assert name_info['num'] == 3
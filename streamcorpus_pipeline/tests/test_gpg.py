@@ -0,0 +1,97 @@
+'''Tests for streaming gpg encryption and decryption.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2016 Diffeo, Inc.
+
+'''
+from __future__ import absolute_import
+from cStringIO import StringIO
+import os
+import random
+
+import pytest
+
+from streamcorpus_pipeline._exceptions import FailedExtraction
+from streamcorpus_pipeline._gpg import DecryptedFile, EncryptedFile, \
+    encode_file, open_decoded
+
+
+def make_data(size):
+    ## not very compressible, and bigger than a pipe buffer
+    rand = random.Random(17)
+    return ''.join(chr(rand.randint(0, 15)) for _ in xrange(size))
+
+
+@pytest.mark.parametrize('compression', ['', 'xz', 'zst'])
+def test_encode_file_round_trip(tmpdir, gpg_keys, compression):
+    public, private = gpg_keys
+    data = make_data(300000)
+    i_path = str(tmpdir.join('plain'))
+    o_path = str(tmpdir.join('encoded'))
+    with open(i_path, 'wb') as f:
+        f.write(data)
+    bytes_in, bytes_out = encode_file(i_path, o_path, compression, public,
+                                      tmp_dir=str(tmpdir))
+    assert bytes_in == len(data)
+    assert bytes_out == os.path.getsize(o_path)
+    with open(o_path, 'rb') as f:
+        assert data[:1000] not in f.read()
+
+    with open_decoded(open(o_path, 'rb'), compression, private,
+                      tmp_dir=str(tmpdir)) as fh:
+        parts = []
+        while True:
+            part = fh.read(7777)
+            if not part:
+                break
+            parts.append(part)
+    assert ''.join(parts) == data
+    ## only the files of the test remain, no key rings
+    assert sorted(os.listdir(str(tmpdir))) == ['encoded', 'plain']
+
+
+class Sink(object):
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+def test_encrypted_file_into_file_object(gpg_keys):
+    public, private = gpg_keys
+    data = make_data(100000)
+    sink = Sink()
+    with EncryptedFile(sink, public) as fo:
+        for i in xrange(0, len(data), 1000):
+            fo.write(data[i:i + 1000])
+    assert sink.closed
+    encrypted = ''.join(sink.parts)
+    assert fo.bytes_out == len(encrypted)
+    with DecryptedFile(StringIO(encrypted), private) as fh:
+        assert fh.read() == data
+
+
+def test_decrypt_garbage(gpg_keys):
+    public, private = gpg_keys
+    fh = DecryptedFile(StringIO('this is not a gpg message'), private)
+    try:
+        with pytest.raises(FailedExtraction):
+            fh.read()
+    finally:
+        fh.close()
+
+
+def test_encrypt_to_unknown_recipient(tmpdir, gpg_keys):
+    public, private = gpg_keys
+    i_path = str(tmpdir.join('plain'))
+    with open(i_path, 'wb') as f:
+        f.write('data')
+    o_path = str(tmpdir.join('encoded'))
+    with pytest.raises(FailedExtraction):
+        encode_file(i_path, o_path, '', public, gpg_recipient='nobody')
+    assert not os.path.exists(o_path)
@@ -5,6 +5,7 @@
 
 '''
 from __future__ import division, absolute_import
+import math
 
 import pytest
 
@@ -156,6 +157,41 @@ def test_index_limit(corpus, indexer, kvlclient):
     ]
 
 
+def index_tables(kvlclient):
+    return [sorted(kvlclient.scan(table))
+            for table in (HASH_TF_INDEX_TABLE, HASH_FREQUENCY_TABLE,
+                          HASH_KEYWORD_INDEX_TABLE)]
+
+
+@pytest.mark.parametrize('max_bytes', [2 ** 27, 1])
+def test_index_accumulated(corpus, indexer, kvlclient, max_bytes):
+    direct = LocalStorage(app_name='a', namespace='direct')
+    direct._data = {}
+    direct.setup_namespace(STREAM_ITEM_TABLE_DEFS, STREAM_ITEM_VALUE_DEFS)
+    direct_indexer = keyword_indexer(direct)
+    for si in corpus.itervalues():
+        direct_indexer.index(si)
+
+    accumulator = indexer.accumulator(max_bytes=max_bytes)
+    for si in corpus.itervalues():
+        indexer.index(si, accumulator=accumulator)
+    if max_bytes > 1:
+        ## nothing is written until the flush
+        assert index_tables(kvlclient) == [[], [], []]
+    accumulator.flush()
+    assert index_tables(kvlclient) == index_tables(direct)
+
+    assert accumulator.documents == 4
+    ## 10 words plus one document count each, less the duplicate dog
+    assert accumulator.increments == 9 + 4 + 9
+    if max_bytes > 1:
+        ## 7 distinct words plus the document count, and 7 keywords
+        assert accumulator.writes == 8 + 7
+        assert accumulator.spills == 0
+    else:
+        assert accumulator.spills == 4
+
+
 def test_invert(corpus, indexer):
     si = corpus['lazy dog']
     indexer.index(si)
@@ -229,6 +265,38 @@ def test_lookup_tf(corpus, indexer):
     ]
 
 
+def test_search(corpus, indexer):
+    for si in corpus.itervalues():
+        indexer.index(si)
+    ids = dict((phrase, si.stream_id) for (phrase, si) in corpus.iteritems())
+    idf = dict((df, math.log(1 + 4 / df)) for df in (1, 2))
+
+    assert indexer.search('dog') == [
+        (ids['dog eat dog'], 2 * idf[2]),
+        (ids['lazy dog'], idf[2]),
+    ]
+    assert indexer.search('the dog', limit=1) == [
+        (ids['dog eat dog'], 2 * idf[2]),
+    ]
+    assert indexer.search('lazy programmer') == [
+        (ids['lazy programmer'], idf[2] + idf[1]),
+        (ids['lazy dog'], idf[2]),
+    ]
+    assert sorted(indexer.search(['lazy', 'dog'])) == sorted([
+        (ids['lazy dog'], 2 * idf[2]),
+        (ids['dog eat dog'], 2 * idf[2]),
+        (ids['lazy programmer'], idf[2]),
+    ])
+
+    assert indexer.search('lazy dog', require_all=True) == [
+        (ids['lazy dog'], 2 * idf[2]),
+    ]
+    assert indexer.search('dog programmer', require_all=True) == []
+    assert indexer.search('dog unicorn', require_all=True) == []
+    assert indexer.search('unicorn') == []
+    assert indexer.search('the') == []
+
+
 def test_e2e_writer(namespace_string, corpus, tmpdir):
     t_path = str(tmpdir.join('chunk.sc'))
     with Chunk(path=t_path, mode='wb') as chunk:
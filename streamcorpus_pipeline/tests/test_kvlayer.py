@@ -7,15 +7,20 @@ from __future__ import absolute_import
 import contextlib
 import hashlib
 import logging
+from multiprocessing.pool import ThreadPool
 
 import kvlayer
 import pytest
 import streamcorpus
 
+from streamcorpus_pipeline._bloom import BloomFilter
 from streamcorpus_pipeline._kvlayer import from_kvlayer, to_kvlayer, \
-    serialize_si_key
+    serialize_si_key, TableBuffer, get_kvlayer_stream_items, \
+    split_key_space, key_space_i_strs, key_space_work_units, \
+    parse_index_query, stream_item_client, clear_stream_item_clients, \
+    get_kvlayer_stream_item, get_kvlayer_stream_items_by_doc_ids
 from streamcorpus_pipeline._kvlayer_table_names import STREAM_ITEMS_TABLE, \
-    STREAM_ITEM_TABLE_DEFS, STREAM_ITEM_VALUE_DEFS, \
+    key_for_stream_item, STREAM_ITEM_TABLE_DEFS, STREAM_ITEM_VALUE_DEFS, \
     STREAM_ITEMS_SOURCE_INDEX, STREAM_ITEMS_TIME_INDEX
 from streamcorpus_pipeline.tests._test_data import get_test_v0_3_0_chunk_path
 import yakonfig
@@ -204,3 +209,337 @@ def test_kvlayer_index_by_time(configurator, test_data_dir):
         swapped_keys = [(key[1], key[0]) for key in stream_item_keys]
         expected = [(key, '') for key in sorted(swapped_keys)]
         assert list(client.scan(STREAM_ITEMS_TIME_INDEX)) == expected
+
+
+def test_kvlayer_parallel_writer(configurator, tmpdir):
+    chunkfile = str(tmpdir.join('chunk.sc'))
+    expected = []
+    with streamcorpus.Chunk(path=chunkfile, mode='wb') as chunk:
+        for i in xrange(50):
+            si = streamcorpus.make_stream_item(
+                1400000000 + i, 'test://test.stream.item/%d' % i)
+            si.body.clean_visible = 'document %d ' % i * 50
+            si.source = 'test'
+            chunk.add(si)
+            expected.append(si.stream_id)
+
+    overlay = {'streamcorpus_pipeline': {'to_kvlayer': {
+        'indexes': ['with_source'],
+        'num_workers': 2,
+        'batch_size': 3,
+        'buffer_bytes': 2000,
+        'put_threads': 2,
+        'max_puts_in_flight': 1,
+    }}}
+    with configurator(overlay):
+        writer = to_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'to_kvlayer'))
+        si_keys = writer(chunkfile, {}, '')
+        ## in chunk order, whatever order the workers finish in
+        assert si_keys == [serialize_si_key(key_for_stream_item(si))
+                           for si in streamcorpus.Chunk(chunkfile)]
+        ## one pool for every chunk until shutdown
+        pool = writer._pool
+        assert pool is not None
+        assert writer(chunkfile, {}, '') == si_keys
+        assert writer._pool is pool
+        writer.shutdown()
+        assert writer._pool is None
+        reader = from_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'from_kvlayer'))
+        assert sorted(si.stream_id for si in reader('')) == sorted(expected)
+        client = kvlayer.client()
+        client.setup_namespace(STREAM_ITEM_TABLE_DEFS, STREAM_ITEM_VALUE_DEFS)
+        assert len(list(client.scan_keys(STREAM_ITEMS_SOURCE_INDEX))) == 50
+
+
+class RecordingStorage(object):
+    def __init__(self):
+        self.puts = []
+
+    def put(self, table_name, *items):
+        self.puts.append((table_name, items))
+
+
+def test_table_buffer_batches():
+    kvl = RecordingStorage()
+    buf = TableBuffer(kvl, 't', buffer_count=10, buffer_bytes=100)
+    for i in xrange(5):
+        buf.put(('k',), 'x' * 30)
+    ## 31 bytes each, so a batch every four items
+    assert [len(items) for table, items in kvl.puts] == [4]
+    for i in xrange(20):
+        buf.put(('k',), '')
+    buf.flush()
+    assert [len(items) for table, items in kvl.puts] == [4, 10, 10, 1]
+    assert (buf.items, buf.batches) == (25, 4)
+    buf.flush()
+    assert len(kvl.puts) == 4
+
+
+def test_table_buffer_background_error():
+    class FailingStorage(object):
+        def put(self, table_name, *items):
+            raise IOError('no space')
+    pool = ThreadPool(1)
+    try:
+        buf = TableBuffer(FailingStorage(), 't', buffer_count=1, pool=pool)
+        buf.put(('k',), 'v')
+        with pytest.raises(IOError):
+            buf.flush()
+    finally:
+        pool.terminate()
+
+
+def write_test_chunk(path, n):
+    sis = []
+    with streamcorpus.Chunk(path=path, mode='wb') as chunk:
+        for i in xrange(n):
+            si = streamcorpus.make_stream_item(
+                1400000000 + i, 'test://test.stream.item/%d' % i)
+            si.body.clean_visible = 'document %d ' % i * 50
+            chunk.add(si)
+            sis.append(si)
+    return sis
+
+
+def test_kvlayer_batched_get(configurator, tmpdir):
+    chunkfile = str(tmpdir.join('chunk.sc'))
+    sis = write_test_chunk(chunkfile, 30)
+    overlay = {'streamcorpus_pipeline': {'from_kvlayer': {
+        'get_batch_size': 7,
+        'num_workers': 2,
+    }}}
+    with configurator(overlay):
+        writer = to_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'to_kvlayer'))
+        si_keys = writer(chunkfile, {}, '')
+        reader = from_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'from_kvlayer'))
+        get = reader.client.get
+        gets = []
+
+        def counting_get(table_name, *keys):
+            gets.append(len(keys))
+            return get(table_name, *keys)
+        reader.client.get = counting_get
+
+        ## not in key order
+        wanted = list(reversed(sis))
+        got = list(reader(','.join(si.stream_id for si in wanted)))
+        assert [si.stream_id for si in got] == \
+            [si.stream_id for si in wanted]
+        assert gets == [7, 7, 7, 7, 2]
+
+        ## binary keys, and a range in the middle
+        del gets[:]
+        i_str = (si_keys[5] + ';' + si_keys[3] + ';' +
+                 si_keys[10] + '<' + si_keys[10] + ';' + si_keys[0])
+        assert [si.stream_id for si in reader(i_str)] == \
+            [sis[i].stream_id for i in (5, 3, 10, 0)]
+        assert gets == [2, 1]
+
+
+def test_get_kvlayer_stream_items(configurator, tmpdir):
+    chunkfile = str(tmpdir.join('chunk.sc'))
+    sis = write_test_chunk(chunkfile, 5)
+    with configurator():
+        writer = to_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'to_kvlayer'))
+        writer(chunkfile, {}, '')
+        missing = '1400000000-' + 'f' * 32
+        stream_ids = [sis[3].stream_id, missing, sis[1].stream_id]
+        got = list(get_kvlayer_stream_items(None, stream_ids, batch_size=2))
+        assert [stream_id for stream_id, si in got] == stream_ids
+        assert got[0][1].stream_id == sis[3].stream_id
+        assert got[1][1] is None
+        assert got[2][1].body.clean_visible == sis[1].body.clean_visible
+
+
+def test_split_key_space():
+    ranges = split_key_space(5)
+    assert len(ranges) == 5
+    assert ranges[0][0] == ('\x00' * 16, -2 ** 31)
+    assert ranges[-1][1] == ('\xff' * 16, 2 ** 31 - 1)
+    for (keya, keyb), (nexta, _) in zip(ranges, ranges[1:]):
+        assert keya < keyb
+        assert keyb == nexta
+        assert '\x00' not in keyb[0]
+    assert split_key_space(1) == [(('\x00' * 16, -2 ** 31),
+                                   ('\xff' * 16, 2 ** 31 - 1))]
+    assert len(key_space_work_units(5)) == 5
+    with pytest.raises(ValueError):
+        split_key_space(0)
+
+
+def test_kvlayer_threaded_scan(configurator, tmpdir):
+    chunkfile = str(tmpdir.join('chunk.sc'))
+    sis = write_test_chunk(chunkfile, 40)
+    overlay = {'streamcorpus_pipeline': {'from_kvlayer': {
+        'scan_threads': 3,
+        'scan_splits': 7,
+        'scan_buffer': 2,
+    }}}
+    with configurator(overlay):
+        writer = to_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'to_kvlayer'))
+        writer(chunkfile, {}, '')
+        reader = from_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'from_kvlayer'))
+        expected = [si.stream_id for si in reader._loadrange(None, None)]
+        assert sorted(expected) == sorted(si.stream_id for si in sis)
+        assert [si.stream_id for si in reader('')] == expected
+
+        ## the ranges as separate inputs cover each key exactly once
+        got = []
+        for i_str in key_space_i_strs(7):
+            got.extend(si.stream_id for si in reader(i_str))
+        assert got == expected
+
+        ## stopping early does not leave threads blocked
+        scan = reader('')
+        assert next(scan).stream_id == expected[0]
+        scan.close()
+
+
+def test_parse_index_query():
+    assert parse_index_query('') is None
+    assert parse_index_query(serialize_si_key(('a' * 16, 1))) is None
+    assert parse_index_query('time:10-20') == \
+        {'time': (10, 20), 'sources': None}
+    assert parse_index_query('time:-5--1;source:news,social') == \
+        {'time': (-5, -1), 'sources': set(['news', 'social'])}
+    assert parse_index_query('time:-20') == \
+        {'time': (None, 20), 'sources': None}
+    assert parse_index_query('source:news') == \
+        {'time': None, 'sources': set(['news'])}
+    for bad in ['time:10', 'time:1-2;time:3-4', 'source:', 'time:1-2;x']:
+        with pytest.raises(ValueError):
+            parse_index_query(bad)
+
+
+def test_kvlayer_index_query(configurator, tmpdir):
+    sis = write_test_chunk(str(tmpdir.join('plain.sc')), 20)
+    chunkfile = str(tmpdir.join('chunk.sc'))
+    with streamcorpus.Chunk(path=chunkfile, mode='wb') as chunk:
+        for i, si in enumerate(sis):
+            si.source = ['news', 'social', 'forum'][i % 3]
+            chunk.add(si)
+    overlay = {'streamcorpus_pipeline': {
+        'to_kvlayer': {'indexes': ['by_time', 'with_source']},
+        'from_kvlayer': {'get_batch_size': 3},
+    }}
+    with configurator(overlay):
+        writer = to_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'to_kvlayer'))
+        writer(chunkfile, {}, '')
+        reader = from_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'from_kvlayer'))
+
+        def stream_ids(i_str):
+            return sorted(si.stream_id for si in reader(i_str))
+
+        ## sis[i] has stream time 1400000000 + i
+        assert stream_ids('time:1400000005-1400000012') == \
+            sorted(si.stream_id for si in sis[5:12])
+        assert reader.index_stats == {
+            STREAM_ITEMS_TIME_INDEX: {'scanned': 7, 'matched': 7}}
+        assert stream_ids('time:1400000015-') == \
+            sorted(si.stream_id for si in sis[15:])
+
+        assert stream_ids('source:news,forum') == \
+            sorted(si.stream_id for si in sis if si.source != 'social')
+        assert reader.index_stats == {
+            STREAM_ITEMS_SOURCE_INDEX: {'scanned': 20, 'matched': 13}}
+
+        assert stream_ids('time:1400000003-1400000009;source:social') == \
+            [sis[4].stream_id, sis[7].stream_id]
+        assert reader.index_stats == {
+            STREAM_ITEMS_TIME_INDEX: {'scanned': 6, 'matched': 6},
+            STREAM_ITEMS_SOURCE_INDEX: {'scanned': 6, 'matched': 2}}
+
+        ## an index entry for a deleted stream item is skipped
+        reader.client.delete(STREAM_ITEMS_TABLE, key_for_stream_item(sis[5]))
+        assert stream_ids('time:1400000005-1400000007') == \
+            [sis[6].stream_id]
+
+
+def test_kvlayer_bloom_filter(configurator, tmpdir):
+    chunkfile = str(tmpdir.join('chunk.sc'))
+    sis = write_test_chunk(chunkfile, 10)
+    bloom_path = str(tmpdir.join('stored.bloom'))
+    overlay = {'streamcorpus_pipeline': {'to_kvlayer': {
+        'bloom_filter_path': bloom_path,
+        'bloom_capacity': 1000,
+    }}}
+    with configurator(overlay):
+        writer = to_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'to_kvlayer'))
+        writer(chunkfile, {}, '')
+    bloom = BloomFilter(bloom_path, writable=False)
+    assert bloom.count == 10
+    assert all(si.stream_id in bloom for si in sis)
+
+
+def test_stream_item_client(configurator, tmpdir):
+    chunkfile = str(tmpdir.join('chunk.sc'))
+    sis = write_test_chunk(chunkfile, 6)
+    with configurator():
+        writer = to_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'to_kvlayer'))
+        writer(chunkfile, {}, '')
+        client = stream_item_client()
+        assert stream_item_client() is client
+        other = dict(yakonfig.get_global_config('kvlayer'),
+                     app_name='other')
+        assert stream_item_client(other) is not client
+        assert get_kvlayer_stream_item(None, sis[2].stream_id).stream_id == \
+            sis[2].stream_id
+
+        doc_ids = [sis[4].doc_id, 'f' * 32, sis[0].doc_id]
+        got = list(get_kvlayer_stream_items_by_doc_ids(None, doc_ids,
+                                                       num_threads=2))
+        assert [doc_id for doc_id, _ in got] == doc_ids
+        assert [si.stream_id for si in got[0][1]] == [sis[4].stream_id]
+        assert got[1][1] == []
+        assert [si.stream_id for si in got[2][1]] == [sis[0].stream_id]
+        clear_stream_item_clients()
+        assert stream_item_client() is not client
+        clear_stream_item_clients()
+
+
+def test_kvlayer_decode_pool(configurator, tmpdir, monkeypatch):
+    chunkfile = str(tmpdir.join('chunk.sc'))
+    write_test_chunk(chunkfile, 40)
+    overlay = {'streamcorpus_pipeline': {'from_kvlayer': {
+        'num_workers': 3,
+        'get_batch_size': 4,
+    }}}
+    with configurator(overlay):
+        writer = to_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'to_kvlayer'))
+        writer(chunkfile, {}, '')
+        reader = from_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'from_kvlayer'))
+        expected = [si.stream_id for si in reader._loadrange(None, None)]
+        reader.shutdown()
+        reader.num_workers = 1
+        assert [si.stream_id for si in reader('')] == expected
+        reader.num_workers = 3
+
+        ## an item that fails to decode is skipped, as when inline;
+        ## worker processes are forked after this
+        bad = expected[5]
+        decrypt_and_uncompress = streamcorpus.decrypt_and_uncompress
+
+        def failing(data):
+            errors, data = decrypt_and_uncompress(data)
+            if streamcorpus.deserialize(data).stream_id == bad:
+                return ['corrupt'], None
+            return errors, data
+        monkeypatch.setattr(streamcorpus, 'decrypt_and_uncompress', failing)
+        reader = from_kvlayer(yakonfig.get_global_config(
+            'streamcorpus_pipeline', 'from_kvlayer'))
+        assert [si.stream_id for si in reader('')] == \
+            [stream_id for stream_id in expected if stream_id != bad]
+        reader.shutdown()
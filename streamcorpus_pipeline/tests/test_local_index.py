@@ -0,0 +1,181 @@
+'''tests for the local keyword index
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2016 Diffeo, Inc.
+
+'''
+from __future__ import division, absolute_import
+import math
+import os
+
+import pytest
+
+from streamcorpus import Chunk, make_stream_item, Sentence, Token
+
+mmh3 = pytest.importorskip('mmh3')
+from streamcorpus_pipeline._local_index import LocalIndex, OffsetIndex, \
+    Segment, offset_index_path, segment_paths, to_local_index
+
+
+def make_chunk(path, phrases):
+    with Chunk(path=path, mode='wb') as chunk:
+        for phrase in phrases:
+            initials = [word[0] for word in phrase.split()]
+            si = make_stream_item(1234567890, 'test:///' + ''.join(initials))
+            si.body.raw = phrase
+            si.body.clean_visible = phrase
+            si.body.sentences['test'] = [Sentence(tokens=[
+                Token(token_num=n, token=word, sentence_pos=n)
+                for (n, word) in enumerate(phrase.split())
+            ])]
+            chunk.add(si)
+
+
+@pytest.fixture
+def stream_ids():
+    return dict((phrase, make_stream_item(
+        1234567890, 'test:///' + ''.join(w[0] for w in phrase.split())
+    ).stream_id) for phrase in ['quick brown fox', 'lazy dog',
+                                'lazy programmer', 'dog eat dog'])
+
+
+@pytest.mark.parametrize('merge_factor', [2, 100])
+def test_local_index(tmpdir, stream_ids, merge_factor):
+    index_path = str(tmpdir.join('index'))
+    writer = to_local_index(config={
+        'index_path': index_path,
+        'merge_factor': merge_factor,
+        'keyword_size_limit': 128,
+    })
+    for i, phrases in enumerate([['quick brown fox', 'lazy dog'],
+                                 ['lazy programmer'],
+                                 ['dog eat dog']]):
+        t_path = str(tmpdir.join('t_chunk%d' % i))
+        make_chunk(t_path, phrases)
+        (o_path,) = writer(t_path, {}, 'i_str')
+        assert os.path.exists(o_path)
+    segments = [p for p in os.listdir(index_path) if p.endswith('.seg')]
+    assert len(segments) == (1 if merge_factor == 2 else 3)
+
+    index = LocalIndex(index_path)
+    assert index.num_docs == 4
+    idf = math.log(1 + 4 / 2)
+    assert index.search('dog') == [(stream_ids['dog eat dog'], 2 * idf),
+                                   (stream_ids['lazy dog'], idf)]
+    assert index.search('the DOG', limit=1) == \
+        [(stream_ids['dog eat dog'], 2 * idf)]
+    assert index.search('lazy dog', require_all=True) == \
+        [(stream_ids['lazy dog'], 2 * idf)]
+    assert index.search('lazy fox', require_all=True) == []
+    assert sorted(sid for (sid, _) in index.search('lazy fox')) == \
+        sorted([stream_ids['lazy dog'], stream_ids['lazy programmer'],
+                stream_ids['quick brown fox']])
+    assert index.search('cat') == []
+
+    [(si, score)] = list(index.search_stream_items('programmer'))
+    assert si.body.clean_visible == 'lazy programmer'
+    si = index.get_stream_item(stream_ids['quick brown fox'])
+    assert si.body.clean_visible == 'quick brown fox'
+    with pytest.raises(KeyError):
+        index.get_stream_item('1234567890-' + 'f' * 32)
+
+    writer.merge(force=True)
+    merged = LocalIndex(index_path)
+    assert len(merged.segments) == 1
+    assert merged.search('lazy dog') == index.search('lazy dog')
+    index.close()
+    merged.close()
+
+
+def test_tiered_merge(tmpdir):
+    index_path = str(tmpdir.join('index'))
+    writer = to_local_index(config={
+        'index_path': index_path,
+        'merge_factor': 2,
+        'keyword_size_limit': 128,
+    })
+
+    def add(i, n):
+        t_path = str(tmpdir.join('t_chunk%d' % i))
+        make_chunk(t_path, ['word%d number%d' % (i, j) for j in xrange(n)])
+        writer(t_path, {}, 'i_str')
+        return sorted(Segment(path).num_docs
+                      for path in segment_paths(index_path))
+
+    ## a large segment is not rewritten for a small one
+    assert add(0, 8) == [8]
+    assert add(1, 1) == [1, 8]
+    assert add(2, 1) == [2, 8]
+    assert add(3, 1) == [1, 2, 8]
+    assert add(4, 1) == [4, 8]
+    writer.merge(force=True)
+    assert sorted(Segment(path).num_docs
+                  for path in segment_paths(index_path)) == [12]
+
+
+def test_top_k_search(tmpdir, monkeypatch):
+    index_path = str(tmpdir.join('index'))
+    writer = to_local_index(config={
+        'index_path': index_path,
+        'merge_factor': 100,
+        'keyword_size_limit': 128,
+    })
+    ## "common" is in every document once; "rare" is in a few, often
+    for c in xrange(3):
+        t_path = str(tmpdir.join('t_chunk%d' % c))
+        phrases = []
+        for i in xrange(100):
+            words = ['common', 'doc%dx%d' % (c, i)]
+            if i % 25 == 7:
+                words += ['rare'] * (i % 4 + 2)
+            if i % 10 == 3:
+                words += ['medium'] * (i % 3 + 1)
+            phrases.append(' '.join(words))
+        make_chunk(t_path, phrases)
+        writer(t_path, {}, 'i_str')
+
+    index = LocalIndex(index_path)
+    for query in ['rare common', 'common medium rare', 'medium common']:
+        everything = index.search(query)
+        for limit in [1, 3, 10]:
+            assert index.search(query, limit=limit) == everything[:limit]
+
+    ## once the rare documents are kept, documents with only the
+    ## common term are not even looked up
+    document = Segment.document
+    looked_up = []
+
+    def counted(self, docno):
+        looked_up.append(self.path)
+        return document(self, docno)
+    monkeypatch.setattr(Segment, 'document', counted)
+    index.search('rare common', limit=3)
+    ## after the first segment, at most the four documents in each
+    ## with "rare"
+    for segment in index.segments[1:]:
+        assert looked_up.count(segment.path) <= 4
+    assert index.search('common', limit=0) == []
+    index.close()
+
+
+def test_offset_index(tmpdir, stream_ids):
+    writer = to_local_index(config={
+        'index_path': str(tmpdir),
+        'merge_factor': 8,
+        'keyword_size_limit': 128,
+    })
+    t_path = str(tmpdir.join('t_chunk'))
+    make_chunk(t_path, ['lazy dog', 'dog eat dog', 'quick brown fox'])
+    writer(t_path, {}, 'i_str')
+    (chunk_name,) = [p for p in os.listdir(str(tmpdir.join('chunks')))
+                     if p.endswith('.sc')]
+    chunk_path = str(tmpdir.join('chunks', chunk_name))
+
+    index = OffsetIndex(offset_index_path(chunk_path))
+    assert len(index) == 3
+    with open(chunk_path, 'rb') as f:
+        data = f.read()
+    [(offset, length)] = index.find(stream_ids['dog eat dog'])
+    assert 'dog eat dog' in data[offset:offset + length]
+    assert index.find(stream_ids['lazy programmer']) == []
+    index.close()
@@ -5,8 +5,10 @@ import time
 
 import pytest
 
+import streamcorpus
+from streamcorpus_pipeline._compression import compress_file, open_chunk
 from streamcorpus_pipeline._local_storage import from_local_chunks, \
-    from_local_files
+    from_local_files, patient_move, to_local_chunks
 
 
 def test_max_retries():
@@ -119,3 +121,142 @@ def test_file_epoch_ticks_now(monkeypatch):
     assert len(sis) == 1
     si = sis[0]
     assert si.stream_time.epoch_ticks == 1470258369
+
+
+def make_xz_chunk(tmpdir, name, n):
+    plain = str(tmpdir.join(name + '.sc'))
+    with streamcorpus.Chunk(path=plain, mode='wb') as chunk:
+        for i in xrange(n):
+            chunk.add(streamcorpus.make_stream_item(
+                1400000000 + i, 'http://example.com/%s/%d' % (name, i)))
+    compress_file(plain, plain + '.xz', 'xz')
+    os.remove(plain)
+    return plain + '.xz'
+
+
+def test_prefetch(tmpdir):
+    paths = [make_xz_chunk(tmpdir, name, 3) for name in 'abc']
+    spool = tmpdir.mkdir('spool')
+    flc = from_local_chunks(config={
+        'streamcorpus_version': 'v0_3_0',
+        'prefetch': 1,
+        'prefetch_dir_path': str(spool),
+    })
+    assert flc.prefetch_depth == 1
+
+    expected = [[si.stream_id for si in open_chunk(path)] for path in paths]
+    got = []
+    for i in xrange(len(paths)):
+        flc.prefetch(paths[i:])
+        if i > 0:
+            ## must come from the spool now
+            path, fetched = flc._prefetcher._entries[paths[i]]
+            fetched.wait()
+            os.remove(paths[i])
+        got.append([si.stream_id for si in flc(paths[i])])
+    assert got == expected
+
+    flc.prefetch([])
+    assert spool.listdir() == []
+
+
+@pytest.mark.parametrize('method', ['copy_file_range', 'sendfile', 'read'])
+def test_patient_move(tmpdir, monkeypatch, method):
+    import streamcorpus_pipeline._file_copy as file_copy
+    if method != 'copy_file_range':
+        monkeypatch.setattr(file_copy, '_copy_file_range', None)
+    if method == 'read':
+        monkeypatch.setattr(file_copy, '_sendfile', None)
+    data = ''.join(chr(i % 256) for i in xrange(300000))
+    src = tmpdir.join('src')
+    src.write(data, mode='wb')
+    os.chmod(str(src), 0640)
+    o_dir = tmpdir.mkdir('out')
+    assert file_copy.copy_file(str(src), str(o_dir.join('copy'))) in \
+        (method, 'read')
+    assert o_dir.join('copy').read(mode='rb') == data
+
+    patient_move(str(src), str(o_dir.join('moved')))
+    assert not src.exists()
+    assert o_dir.join('moved').read(mode='rb') == data
+    assert os.stat(str(o_dir.join('moved'))).st_mode & 0777 == 0640
+    assert sorted(p.basename for p in o_dir.listdir()) == ['copy', 'moved']
+
+
+def test_move_into_place_cross_device(tmpdir, monkeypatch):
+    import streamcorpus_pipeline._local_storage as local_storage
+    rename = os.rename
+    renames = []
+
+    def exdev_rename(src, dst):
+        ## only the final rename of the copy, inside the output
+        ## directory, can succeed
+        renames.append(dst)
+        if os.path.dirname(src) != os.path.dirname(dst):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        rename(src, dst)
+    monkeypatch.setattr(os, 'rename', exdev_rename)
+
+    t_path = tmpdir.join('t_chunk')
+    t_path.write('chunk data')
+    o_path = tmpdir.mkdir('out').join('chunk.sc')
+    local_storage.move_into_place(str(t_path), str(o_path))
+    assert o_path.read() == 'chunk data'
+    assert not t_path.exists()
+    assert len(renames) == 2
+    assert os.path.basename(renames[1]) == 'chunk.sc'
+
+
+@pytest.mark.parametrize('offset_index', [True, False])
+def test_fetch_stream_items(tmpdir, offset_index):
+    t_path = str(tmpdir.join('t_chunk'))
+    with streamcorpus.Chunk(path=t_path, mode='wb') as chunk:
+        for i in xrange(10):
+            chunk.add(streamcorpus.make_stream_item(
+                1400000000 + i, 'http://example.com/%d' % i))
+    stream_ids = [si.stream_id for si in streamcorpus.Chunk(path=t_path)]
+    tlc = to_local_chunks(config={
+        'output_type': 'otherdir',
+        'output_path': str(tmpdir.mkdir('out')),
+        'output_name': 'chunk',
+        'cleanup_tmp_files': True,
+        'offset_index': offset_index,
+    })
+    (o_path,) = tlc(t_path, {}, 'i_str')
+    assert os.path.exists(o_path + '.offsets') == offset_index
+
+    flc = from_local_chunks(config={'streamcorpus_version': 'v0_3_0'})
+    wanted = [stream_ids[7], stream_ids[2], stream_ids[9]]
+    got = list(flc(o_path + '#' + ','.join(wanted)))
+    assert [si.stream_id for si in got] == wanted
+    assert got[0].abs_url == 'http://example.com/7'
+    with pytest.raises(KeyError):
+        list(flc(o_path + '#1400000000-' + 'f' * 32))
+
+
+def test_copy_file_short_kernel_copy(tmpdir, monkeypatch):
+    import streamcorpus_pipeline._file_copy as file_copy
+    data = 'x' * 100000
+    src = tmpdir.join('src')
+    src.write(data, mode='wb')
+
+    ## a file system that cannot copy this file returns 0 at once
+    monkeypatch.setattr(file_copy, '_copy_file_range',
+                        lambda *args: 0)
+    monkeypatch.setattr(file_copy, '_sendfile', None)
+    dst = tmpdir.join('dst')
+    assert file_copy.copy_file(str(src), str(dst)) == 'read'
+    assert dst.read(mode='rb') == data
+
+    ## running dry part way through is an error, not a short file
+    calls = []
+
+    def short_copy(fd_in, off_in, fd_out, off_out, count, flags):
+        calls.append(count)
+        if len(calls) > 1:
+            return 0
+        os.write(fd_out, os.read(fd_in, 1000))
+        return 1000
+    monkeypatch.setattr(file_copy, '_copy_file_range', short_copy)
+    with pytest.raises(IOError):
+        file_copy.copy_file(str(src), str(tmpdir.join('short')))
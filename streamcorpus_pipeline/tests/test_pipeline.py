@@ -10,18 +10,19 @@ import streamcorpus_pipeline.config
 from streamcorpus_pipeline.stages import PipelineStages
 from streamcorpus_pipeline._local_storage import to_local_chunks
 from streamcorpus_pipeline._pipeline import PipelineFactory, Pipeline
-from streamcorpus_pipeline.run import SimpleWorkUnit
-from streamcorpus_pipeline.tests._test_data import get_test_chunk_path
+from streamcorpus_pipeline.run import SimpleWorkUnit, process_inputs
+from streamcorpus_pipeline.tests._test_data import get_test_chunk_path, \
+    load_test_config
 import yakonfig
 
 logger = logging.getLogger(__name__)
 
 
 @pytest.mark.slow
-def test_pipeline(request, test_data_dir):
+def test_pipeline(request, test_data_dir, tmpdir):
     filename = str(request.fspath.dirpath('test_dedup_chunk_counts.yaml'))
     with yakonfig.defaulted_config([streamcorpus_pipeline],
-                                   filename=filename):
+                                   config=load_test_config(filename, tmpdir)):
         # run the pipeline
         stages = PipelineStages()
         pf = PipelineFactory(stages)
@@ -34,10 +35,10 @@ def test_pipeline(request, test_data_dir):
 
 
 @pytest.mark.slow
-def test_post_batch_incremental_stage(request, test_data_dir):
+def test_post_batch_incremental_stage(request, test_data_dir, tmpdir):
     filename = str(request.fspath.dirpath('test_post_batch_incremental.yaml'))
     with yakonfig.defaulted_config([streamcorpus_pipeline],
-                                   filename=filename):
+                                   config=load_test_config(filename, tmpdir)):
         stages = PipelineStages()
         pf = PipelineFactory(stages)
         p = pf(yakonfig.get_global_config('streamcorpus_pipeline'))
@@ -172,3 +173,50 @@ def test_one_si_per_output(tmpdir):
     assert tmpdir.join('output-1-1.sc').check()
     assert wu.data['output'] == [str(tmpdir.join('output-0-1.sc')),
                                  str(tmpdir.join('output-1-1.sc'))]
+
+
+class PrefetchingReader(TwoItemReader):
+    prefetch_depth = 2
+
+    def __init__(self):
+        self.hints = []
+
+    def prefetch(self, i_strs):
+        self.hints.append(i_strs)
+
+
+def test_process_inputs_prefetch(tmpdir):
+    reader = PrefetchingReader()
+    writer = to_local_chunks({'output_type': 'otherdir',
+                              'output_name': 'output-%(input_fname)s',
+                              'output_path': str(tmpdir),
+                              'cleanup_tmp_files': True})
+    p = Pipeline(1000, 1000, False, str(tmpdir), True, None, None,
+                 reader, [], [], [], [writer])
+    process_inputs(p, iter(['a\n', 'b\n', 'c\n', 'd\n']))
+
+    assert reader.hints == [['a', 'b', 'c'], ['b', 'c', 'd'], ['c', 'd'],
+                            ['d'], []]
+    for name in 'abcd':
+        assert tmpdir.join('output-%s.sc' % name).check()
+
+
+class ShutdownReader(TwoItemReader):
+    def __init__(self):
+        self.shutdowns = 0
+
+    def shutdown(self):
+        self.shutdowns += 1
+
+
+def test_run_shuts_down_reader(tmpdir):
+    reader = ShutdownReader()
+    writer = to_local_chunks({'output_type': 'otherdir',
+                              'output_name': 'output-%(input_fname)s',
+                              'output_path': str(tmpdir),
+                              'cleanup_tmp_files': True})
+    p = Pipeline(1000, 1000, False, str(tmpdir), True, None, None,
+                 reader, [], [], [], [writer])
+    p.run('a')
+    p.run('b')
+    assert reader.shutdowns == 2
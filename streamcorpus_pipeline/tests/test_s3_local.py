@@ -0,0 +1,385 @@
+'''Tests for the S3 stages against a local S3 stand-in.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2012-2016 Diffeo, Inc.
+
+'''
+from __future__ import absolute_import, division, print_function
+from cStringIO import StringIO
+import hashlib
+import os
+
+from backports import lzma
+import pytest
+import yakonfig
+
+import streamcorpus
+from streamcorpus_pipeline._exceptions import ConfigurationError, \
+    FailedVerification
+import streamcorpus_pipeline._s3_storage as s3stage
+from streamcorpus_pipeline.tests._fake_s3 import FakeS3
+
+
+@pytest.yield_fixture
+def fake_s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'test-access-key')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'test-secret-key')
+    fake = FakeS3()
+    yield fake
+    s3stage.connection_pool.clear()
+    fake.close()
+
+
+def make_chunk_data(n=50):
+    fh = StringIO()
+    with streamcorpus.Chunk(file_obj=fh, mode='wb') as chunk:
+        for i in xrange(n):
+            si = streamcorpus.make_stream_item(1400000000 + i,
+                                               'http://example.com/%d' % i)
+            si.body.clean_visible = 'document number %d ' % i * 100
+            chunk.add(si)
+        chunk.flush()
+        return fh.getvalue()
+
+
+def from_s3_chunks(fake, **config):
+    config = dict(dict(fake.config(), tries=1), **config)
+    with yakonfig.defaulted_config([s3stage.from_s3_chunks],
+                                   config={'from_s3_chunks': config}) as c:
+        return s3stage.from_s3_chunks(c['from_s3_chunks'])
+
+
+def range_gets(fake, key):
+    return [headers['range'] for method, bucket, k, headers in fake.requests
+            if method == 'GET' and k == key and 'range' in headers]
+
+
+@pytest.mark.parametrize('compression', ['', 'xz'])
+def test_from_s3_chunks_streaming(fake_s3, compression):
+    data = make_chunk_data()
+    key = '%s.sc' % hashlib.md5(data).hexdigest()
+    if compression:
+        key += '.' + compression
+        data = lzma.compress(data)
+    fake_s3.put('test-bucket', key, data)
+
+    buffered = from_s3_chunks(fake_s3, compare_md5_in_file_name=True)
+    expected = [si.stream_id for si in buffered(key)]
+    assert len(expected) == 50
+    assert range_gets(fake_s3, key) == []
+
+    streaming = from_s3_chunks(fake_s3, compare_md5_in_file_name=True,
+                               streaming_download=True,
+                               download_part_size=1000, download_threads=3)
+    assert [si.stream_id for si in streaming(key)] == expected
+    ranges = range_gets(fake_s3, key)
+    assert len(ranges) == (len(data) + 999) // 1000
+    assert 'bytes=0-999' in ranges
+
+
+def test_from_s3_chunks_streaming_bad_md5(fake_s3):
+    data = make_chunk_data()
+    key = '%s.sc.xz' % hashlib.md5('something else').hexdigest()
+    fake_s3.put('test-bucket', key, lzma.compress(data))
+
+    streaming = from_s3_chunks(fake_s3, compare_md5_in_file_name=True,
+                               streaming_download=True,
+                               download_part_size=1000)
+    items = streaming(key)
+    with pytest.raises(FailedVerification):
+        list(items)
+
+
+def test_ranged_key_reader(fake_s3):
+    data = ''.join(chr(i % 251) for i in xrange(10000))
+    fake_s3.put('test-bucket', 'blob', data)
+    bucket = s3stage.get_bucket(fake_s3.config())
+    reader = s3stage.RangedKeyReader(bucket.get_key('blob'),
+                                     part_size=777, threads=2)
+    try:
+        parts = []
+        for size in (1, 10, 1000, 5000):
+            parts.append(reader.read(size))
+            assert len(parts[-1]) == size
+        parts.append(reader.read())
+        assert reader.read() == ''
+    finally:
+        reader.close()
+    assert ''.join(parts) == data
+
+
+def test_from_s3_chunks_prefetch(fake_s3, tmpdir):
+    keys = []
+    for name in 'abc':
+        data = make_chunk_data(5)
+        keys.append('%s-%s.sc.xz' % (name, hashlib.md5(data).hexdigest()))
+        fake_s3.put('test-bucket', keys[-1], lzma.compress(data))
+    expected = [[si.stream_id for si in from_s3_chunks(fake_s3)(key)]
+                for key in keys]
+
+    reader = from_s3_chunks(fake_s3, compare_md5_in_file_name=True,
+                            prefetch=1, prefetch_dir_path=str(tmpdir))
+    got = []
+    for i, key in enumerate(keys):
+        reader.prefetch(keys[i:])
+        if i > 0:
+            ## must come from the spool now
+            path, fetched = reader._prefetcher._entries[key]
+            fetched.wait()
+            del fake_s3.buckets['test-bucket'][key]
+        got.append([si.stream_id for si in reader(key)])
+    assert got == expected
+
+    reader.prefetch([])
+    assert tmpdir.listdir() == []
+
+
+def test_connection_pool(fake_s3):
+    keys = []
+    for name in 'abc':
+        keys.append('%s.sc' % name)
+        fake_s3.put('test-bucket', keys[-1], make_chunk_data(2))
+    before = s3stage.connection_pool.report()
+    reader = from_s3_chunks(fake_s3)
+    for key in keys:
+        assert len(list(reader(key))) == 2
+    stats = s3stage.connection_pool.report()
+    assert stats['connections'] - before.get('connections', 0) == 1
+    assert stats['buckets'] - before.get('buckets', 0) == 1
+    assert stats['bucket_reuses'] - before.get('bucket_reuses', 0) == 2
+    ## one bucket check and three HEAD/GET pairs over one socket
+    assert stats['http_requests'] - before.get('http_requests', 0) == 7
+    assert stats['http_connections'] - before.get('http_connections', 0) == 1
+    bucket_gets = [r for r in fake_s3.requests if r[2] == '']
+    assert len(bucket_gets) == 1
+
+    reader = from_s3_chunks(fake_s3, s3_keep_alive=False)
+    assert len(list(reader(keys[0]))) == 2
+    assert len([r for r in fake_s3.requests if r[2] == '']) == 2
+    assert s3stage.connection_pool.report() == stats
+
+
+def test_connection_pool_fork(fake_s3, monkeypatch):
+    pool = s3stage.S3ConnectionPool()
+    config = fake_s3.config()
+    conn = pool.get_connection(config)
+    assert pool.get_connection(config) is conn
+    closed = []
+    monkeypatch.setattr(conn, 'close', lambda: closed.append(conn))
+    ## as in a forked child
+    pid = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: pid + 1)
+    child_conn = pool.get_connection(config)
+    assert child_conn is not conn
+    assert closed == []
+
+
+def test_connection_pool_without_boto_internals(fake_s3, monkeypatch):
+    ## a boto ConnectionPool without mutex and host_to_pool
+    conn = s3stage.S3ConnectionPool().get_connection(fake_s3.config())
+    put = []
+    monkeypatch.setattr(conn, '_pool', object())
+    monkeypatch.setattr(
+        s3stage.S3Connection, 'put_http_connection',
+        lambda self, *args: put.append(args))
+    conn.put_http_connection('host', 80, False, 'connection')
+    assert put == [('host', 80, False, 'connection')]
+
+
+def to_s3_chunks(fake, tmpdir, **config):
+    config = dict(dict(fake.config(), output_name='%(input_fname)s',
+                       tries=1, is_private=True, verify=True,
+                       tmp_dir_path=str(tmpdir)), **config)
+    with yakonfig.defaulted_config([s3stage.to_s3_chunks],
+                                   config={'to_s3_chunks': config}) as c:
+        return s3stage.to_s3_chunks(c['to_s3_chunks'])
+
+
+def write_chunk(tmpdir, data):
+    t_path = str(tmpdir.join('t_chunk'))
+    with open(t_path, 'wb') as f:
+        f.write(data)
+    return t_path
+
+
+def multipart_requests(fake):
+    return [method for method, bucket, key, headers in fake.requests
+            if method == 'POST']
+
+
+@pytest.mark.parametrize(('compression', 'part_size'),
+                         [('', 20000), ('xz', 2000)])
+def test_to_s3_chunks_multipart(fake_s3, tmpdir, compression, part_size):
+    data = make_chunk_data(200)
+    writer = to_s3_chunks(fake_s3, tmpdir, compression=compression,
+                          multipart_upload=True, upload_part_size=part_size,
+                          upload_threads=3)
+    t_path = write_chunk(tmpdir, data)
+    o_paths = writer(t_path, {}, 'input-name')
+
+    assert o_paths == ['input-name.sc' + ('.xz' if compression else '')]
+    assert not os.path.exists(t_path)
+    stored = fake_s3.buckets['test-bucket'][o_paths[0]]
+    if compression:
+        stored = lzma.decompress(stored)
+    assert stored == data
+    ## initiate and complete, with no compressed copy left on disk
+    assert multipart_requests(fake_s3) == ['POST', 'POST']
+    size = len(fake_s3.buckets['test-bucket'][o_paths[0]])
+    assert fake_s3.etags['test-bucket', o_paths[0]].endswith(
+        '-%d' % ((size + part_size - 1) // part_size))
+    assert fake_s3.uploads == {}
+    assert tmpdir.listdir() == []
+
+
+def test_to_s3_chunks_single_part(fake_s3, tmpdir):
+    data = make_chunk_data(5)
+    writer = to_s3_chunks(fake_s3, tmpdir, multipart_upload=True)
+    o_paths = writer(write_chunk(tmpdir, data), {}, 'input-name')
+    assert lzma.decompress(fake_s3.buckets['test-bucket'][o_paths[0]]) \
+        == data
+    assert multipart_requests(fake_s3) == []
+
+
+def test_to_s3_chunks_part_retry(fake_s3, tmpdir):
+    data = make_chunk_data(50)
+    fake_s3.part_failures[2] = 1
+    writer = to_s3_chunks(fake_s3, tmpdir, compression='', tries=2,
+                          multipart_upload=True, upload_part_size=2000)
+    o_paths = writer(write_chunk(tmpdir, data), {}, 'input-name')
+    assert fake_s3.buckets['test-bucket'][o_paths[0]] == data
+    ## only the failed part was sent again, in the one upload
+    assert multipart_requests(fake_s3) == ['POST', 'POST']
+
+
+def test_to_s3_chunks_part_failure(fake_s3, tmpdir):
+    fake_s3.part_failures[2] = 1
+    writer = to_s3_chunks(fake_s3, tmpdir, compression='',
+                          multipart_upload=True, upload_part_size=2000)
+    with pytest.raises(Exception):
+        writer(write_chunk(tmpdir, make_chunk_data(50)), {}, 'input-name')
+    assert fake_s3.buckets['test-bucket'] == {}
+    ## the upload was cancelled
+    assert fake_s3.uploads == {}
+
+
+def object_requests(fake, key):
+    return [method for method, bucket, k, headers in fake.requests
+            if k == key and method in ('GET', 'HEAD')]
+
+
+@pytest.mark.parametrize('part_size', [2000, 2 ** 20])
+def test_to_s3_chunks_verify_etag(fake_s3, tmpdir, part_size):
+    data = make_chunk_data(50)
+    writer = to_s3_chunks(fake_s3, tmpdir, verify_mode='etag',
+                          multipart_upload=True, upload_part_size=part_size)
+    o_path, = writer(write_chunk(tmpdir, data), {}, 'input-name')
+    ## one HEAD, no download
+    assert object_requests(fake_s3, o_path) == ['HEAD']
+
+    writer = to_s3_chunks(fake_s3, tmpdir, verify_mode='etag',
+                          verify_sample_rate=1.0, multipart_upload=True,
+                          upload_part_size=part_size)
+    del fake_s3.requests[:]
+    writer(write_chunk(tmpdir, data), {}, 'input-name')
+    assert object_requests(fake_s3, o_path) == ['HEAD', 'HEAD', 'GET']
+
+
+def test_to_s3_chunks_verify_etag_mismatch(fake_s3, tmpdir, monkeypatch):
+    writer = to_s3_chunks(fake_s3, tmpdir, verify_mode='etag',
+                          multipart_upload=False)
+    put = writer.put
+
+    def put_then_clobber(o_path, t_path, compression=''):
+        etag, size = put(o_path, t_path, compression)
+        fake_s3.put('test-bucket', o_path, 'something else')
+        return etag, size
+    monkeypatch.setattr(writer, 'put', put_then_clobber)
+
+    with pytest.raises(Exception) as excinfo:
+        writer(write_chunk(tmpdir, make_chunk_data(5)), {}, 'input-name')
+    assert 'verify failed' in str(excinfo.value)
+
+
+def test_to_s3_chunks_bad_verify_mode(fake_s3, tmpdir):
+    with pytest.raises(ConfigurationError):
+        to_s3_chunks(fake_s3, tmpdir, verify_mode='psychic')
+
+
+def object_gets(fake, key):
+    return [method for method, bucket, k, headers in fake.requests
+            if k == key and method == 'GET']
+
+
+def test_from_s3_chunks_chunk_cache(fake_s3, tmpdir):
+    data = make_chunk_data(5)
+    key = '%s.sc.xz' % hashlib.md5(data).hexdigest()
+    fake_s3.put('test-bucket', key, lzma.compress(data))
+    cache_path = str(tmpdir.join('cache'))
+
+    reader = from_s3_chunks(fake_s3, compare_md5_in_file_name=True,
+                            chunk_cache_path=cache_path)
+    expected = [si.stream_id for si in reader(key)]
+    assert len(expected) == 5
+    assert object_gets(fake_s3, key) == ['GET']
+
+    ## a second process sharing the cache does not download again
+    reader = from_s3_chunks(fake_s3, compare_md5_in_file_name=True,
+                            chunk_cache_path=cache_path,
+                            streaming_download=True)
+    assert [si.stream_id for si in reader(key)] == expected
+    assert object_gets(fake_s3, key) == ['GET']
+    assert (reader.chunk_cache.hits, reader.chunk_cache.misses) == (1, 0)
+
+    ## a new version of the object has a new ETag
+    data = make_chunk_data(3)
+    fake_s3.put('test-bucket', key, lzma.compress(data))
+    reader = from_s3_chunks(fake_s3, chunk_cache_path=cache_path)
+    assert len(list(reader(key))) == 3
+    assert object_gets(fake_s3, key) == ['GET', 'GET']
+    assert (reader.chunk_cache.hits, reader.chunk_cache.misses) == (0, 1)
+
+
+def test_chunk_cache_eviction(tmpdir):
+    from streamcorpus_pipeline._chunk_cache import ChunkCache
+    cache = ChunkCache(str(tmpdir), max_bytes=3500)
+    keys = [cache.key('bucket', 'key-%d' % i, '"etag"') for i in xrange(4)]
+    for i, key in enumerate(keys[:3]):
+        cache.put(key, str(i) * 1000)
+        os.utime(cache._entry_path(key), (i, i))
+    ## touching the oldest entry makes the next one least recent
+    assert cache.get(keys[0]) == '0' * 1000
+    cache.put(keys[3], '3' * 1000)
+
+    assert cache.get(keys[1]) is None
+    assert [cache.get(key) for key in (keys[0], keys[2], keys[3])] == \
+        ['0' * 1000, '2' * 1000, '3' * 1000]
+    assert cache.evictions == 1
+    assert (cache.hits, cache.misses) == (4, 1)
+
+
+@pytest.mark.parametrize('multipart_upload', [True, False])
+def test_s3_chunks_gpg(fake_s3, tmpdir, gpg_keys, multipart_upload):
+    public, private = gpg_keys
+    data = make_chunk_data(200)
+    writer = to_s3_chunks(fake_s3, tmpdir, gpg_encryption_key_path=public,
+                          gpg_decryption_key_path=private,
+                          multipart_upload=multipart_upload,
+                          upload_part_size=5000)
+    o_path, = writer(write_chunk(tmpdir, data),
+                     {'md5': hashlib.md5(data).hexdigest()},
+                     'input-name')
+    assert o_path == 'input-name.sc.xz.gpg'
+    assert multipart_requests(fake_s3) == \
+        (['POST', 'POST'] if multipart_upload else [])
+    ## nothing left behind: no compressed copy, no key ring
+    assert tmpdir.listdir() == []
+
+    expected = [si.stream_id for si in streamcorpus.Chunk(data=data)]
+    for streaming in (False, True):
+        reader = from_s3_chunks(fake_s3, gpg_decryption_key_path=private,
+                                streaming_download=streaming,
+                                download_part_size=3000,
+                                tmp_dir_path=str(tmpdir))
+        assert [si.stream_id for si in reader(o_path)] == expected
+    assert tmpdir.listdir() == []
@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+import os
+import stat
+
+import pytest
+
+from streamcorpus import Chunk, make_stream_item
+
+from streamcorpus_pipeline._exceptions import PipelineBaseException
+from streamcorpus_pipeline._serif import serif
+
+## stands in for Serif: copies each input chunk to OUT_DIR/output,
+## and records the policy file it was given
+FAKE_SERIF = '''#!/bin/sh
+echo "$1" >> "$(dirname "$0")/par-paths"
+mkdir -p "$3/output"
+cat "$4" > "$3/output/$(basename "$4")"
+'''
+
+## succeeds without tagging anything
+EMPTY_SERIF = '''#!/bin/sh
+mkdir -p "$3/output"
+: > "$3/output/$(basename "$4")"
+'''
+
+BROKEN_SERIF = '''#!/bin/sh
+echo "Exception: no models" >&2
+exit 1
+'''
+
+
+def make_stage(tmpdir, script, **kwargs):
+    third = tmpdir.mkdir('third')
+    exe = third.mkdir('serif').join('fake-serif')
+    exe.write(script)
+    os.chmod(str(exe), stat.S_IRWXU)
+    config = dict(serif.default_config)
+    config.update({
+        'third_dir_path': str(third),
+        'path_in_third': 'serif',
+        'serif_exe': 'fake-serif',
+        'tmp_dir_path': str(tmpdir.mkdir('tmp')),
+    })
+    config.update(kwargs)
+    return serif(config)
+
+
+def write_chunk(path, num):
+    chunk = Chunk(path=path, mode='wb')
+    for i in xrange(num):
+        si = make_stream_item(i, 'http://example.com/%d' % i)
+        si.body.clean_visible = 'document %d' % i
+        chunk.add(si)
+    chunk.close()
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_serif_round_trip(tmpdir, streaming):
+    stage = make_stage(tmpdir, FAKE_SERIF, streaming=streaming)
+    for name in ['a.sc', 'b.sc']:
+        path = str(tmpdir.join(name))
+        write_chunk(path, 5)
+        stage.process_path(path)
+        assert [si.body.clean_visible for si in Chunk(path)] == \
+            ['document %d' % i for i in xrange(5)]
+
+    ## policy files are rendered once for the stage
+    par_paths = tmpdir.join('third', 'serif', 'par-paths').readlines()
+    assert len(set(par_paths)) == 1
+    assert os.path.exists(par_paths[0].strip())
+    stage.shutdown()
+    assert not os.path.exists(par_paths[0].strip())
+    ## nothing left behind in the pipeline's tmp dir
+    assert tmpdir.join('tmp').listdir() == []
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_serif_failure(tmpdir, streaming):
+    stage = make_stage(tmpdir, BROKEN_SERIF, streaming=streaming)
+    path = str(tmpdir.join('a.sc'))
+    write_chunk(path, 5)
+    with pytest.raises(PipelineBaseException) as excinfo:
+        stage.process_path(path)
+    assert 'no models' in str(excinfo.value)
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+@pytest.mark.parametrize(('script', 'message'), [
+    (BROKEN_SERIF, 'no models'),
+    (EMPTY_SERIF, 'serif returned'),
+])
+def test_serif_cached_failure(tmpdir, streaming, script, message):
+    ## with the cache on, serif errors and short output still fail
+    ## the chunk rather than truncating it
+    stage = make_stage(tmpdir, script, streaming=streaming,
+                       tagger_cache_path=str(tmpdir.join('cache')))
+    path = str(tmpdir.join('a.sc'))
+    write_chunk(path, 5)
+    with pytest.raises(PipelineBaseException) as excinfo:
+        stage.process_path(path)
+    assert message in str(excinfo.value)
+    assert not tmpdir.join('cache').check() or \
+        not tmpdir.join('cache').listdir()
@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+import fcntl
+import os
+
+import pytest
+
+from streamcorpus import Chunk, make_stream_item, Sentence, Token, Tagging
+
+from streamcorpus_pipeline._disk_cache import LOCK_NAME
+from streamcorpus_pipeline._tagger_cache import TaggerCache, config_namespace
+from streamcorpus_pipeline._taggers import TaggerBatchTransform
+
+
+class copy_tagger(TaggerBatchTransform):
+    '''"tags" each document as one sentence with one token'''
+    tagger_id = 'copy'
+    template = 'cp %(clean_visible_path)s %(ner_xml_path)s'
+    tagged = 0
+
+    def get_sentences(self, ner_dom):
+        copy_tagger.tagged += 1
+        text = ner_dom.firstChild.data if ner_dom.firstChild else u''
+        return [Sentence(tokens=[Token(token=text.encode('utf8'))])], [], []
+
+
+def make_si(num, text):
+    si = make_stream_item(num, 'http://example.com/%d' % num)
+    si.body.clean_visible = text
+    return si
+
+
+def write_chunk(path, texts):
+    if os.path.exists(path):
+        os.remove(path)
+    chunk = Chunk(path=path, mode='wb')
+    for num, text in enumerate(texts):
+        chunk.add(make_si(num, text))
+    chunk.close()
+
+
+def test_namespace_ignores_volatile_keys():
+    base = config_namespace('lingpipe', {'path_in_third': 'a'})
+    assert base == config_namespace(
+        'lingpipe', {'path_in_third': 'a', 'tmp_dir_path': '/tmp/x'})
+    assert base != config_namespace('lingpipe', {'path_in_third': 'b'})
+    assert base != config_namespace('serif', {'path_in_third': 'a'})
+
+
+def test_put_get_apply(tmpdir):
+    cache = TaggerCache(str(tmpdir), 'copy', 'ns')
+    si = make_si(1, 'hello')
+    key = cache.key(si)
+    assert cache.get(key) is None
+    assert cache.misses == 1
+
+    si.body.taggings['copy'] = Tagging(tagger_id='copy')
+    si.body.sentences['copy'] = [Sentence(tokens=[Token(token='hello')])]
+    si.body.sentences['other'] = [Sentence()]
+    cache.put(key, si)
+
+    other = make_si(1, 'hello')
+    assert cache.key(other) == key
+    cache.apply(cache.get(key), other)
+    assert cache.hits == 1
+    assert other.body.sentences['copy'][0].tokens[0].token == 'hello'
+    assert 'other' not in other.body.sentences
+    assert other.body.taggings['copy'].tagger_id == 'copy'
+
+    assert cache.key(make_si(1, '')) is None
+
+
+def test_eviction(tmpdir):
+    cache = TaggerCache(str(tmpdir), 'copy', 'ns', max_bytes=1000)
+    for num in xrange(50):
+        si = make_si(num, 'doc %d' % num)
+        si.body.sentences['copy'] = [Sentence(tokens=[Token(token='x' * 50)])]
+        cache.put(cache.key(si), si)
+    assert cache.evictions > 0
+    assert cache._scan_total_bytes() <= 1000
+
+
+def test_eviction_lock(tmpdir):
+    cache = TaggerCache(str(tmpdir), 'copy', 'ns', max_bytes=1000)
+    ## another process evicting holds the lock, so this one leaves
+    ## the cache to it
+    with open(str(tmpdir.join(LOCK_NAME)), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for num in xrange(50):
+            si = make_si(num, 'doc %d' % num)
+            si.body.sentences['copy'] = [
+                Sentence(tokens=[Token(token='x' * 50)])]
+            cache.put(cache.key(si), si)
+        assert cache.evictions == 0
+    cache.evict()
+    assert cache.evictions > 0
+    assert cache._scan_total_bytes() <= 1000
+
+
+@pytest.mark.parametrize('texts', [
+    ['one', 'two', '', 'three'],
+    ['one', 'one', 'two'],
+])
+def test_tagger_batch_transform_cache(tmpdir, texts):
+    config = {
+        'third_dir_path': str(tmpdir),
+        'path_in_third': '',
+        'cleanup_tmp_files': True,
+        'tagger_cache_path': str(tmpdir.join('cache')),
+    }
+    chunk_path = str(tmpdir.join('chunk.sc'))
+
+    write_chunk(chunk_path, texts)
+    copy_tagger.tagged = 0
+    copy_tagger(dict(config)).process_path(chunk_path)
+    assert copy_tagger.tagged == len(texts)
+    first = [si.body.sentences.get('copy') for si in Chunk(chunk_path)]
+
+    write_chunk(chunk_path, texts + ['four'])
+    copy_tagger.tagged = 0
+    copy_tagger(dict(config)).process_path(chunk_path)
+    ## only the new document and the one without clean_visible
+    assert copy_tagger.tagged == 1 + texts.count('')
+    second = [si.body.sentences.get('copy') for si in Chunk(chunk_path)]
+    assert second[:-1] == first
+    assert second[-1][0].tokens[0].token == 'four'
+
+    copy_tagger.tagged = 0
+    write_chunk(chunk_path, [t for t in texts if t])
+    copy_tagger(dict(config)).process_path(chunk_path)
+    assert copy_tagger.tagged == 0
+    assert len(list(Chunk(chunk_path))) == len([t for t in texts if t])
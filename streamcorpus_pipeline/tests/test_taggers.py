@@ -1,14 +1,19 @@
 from __future__ import absolute_import
+import logging
+import time
+
 import pytest
 from streamcorpus import Chunk, make_stream_item, add_annotation, \
-    Sentence, Token, Annotator, Target, Rating
+    Sentence, Token, Annotator, Target, Rating, Label, Offset, OffsetType
 
 import streamcorpus_pipeline.stages
 from streamcorpus_pipeline.tests._test_data import \
     get_john_smith_tagged_by_lingpipe_without_labels_data
 
-from streamcorpus_pipeline._taggers import multi_token_match, \
-    look_ahead_match
+from streamcorpus_pipeline._taggers import multi_token_match, MentionMatcher, \
+    look_ahead_match, byte_offset_labels
+
+logger = logging.getLogger(__name__)
 
 @pytest.fixture(scope='module')
 def stages():
@@ -101,3 +106,66 @@ def test_look_ahead_match():
         assert boolean
 
     assert set(look_ahead_match(rating, tokens)) == set([1, 2, 3, 4, 5])
+
+
+def test_mention_matcher_many_ratings():
+    tokens = [(['john'], 1), (['smith'], 2), (['and'], False),
+              (['bob', 'smith'], 3), ([''], 4), (['jr'], 5)]
+    matcher = MentionMatcher([['John Smith', 'Bob'],
+                              ['Smith Jr'],
+                              ['ur"^jo.*$"']])
+    matched = matcher.match(tokens)
+    assert sorted(matched[0]) == [1, 2, 3]
+    ## must start at the first cleansed string of a token, and skips
+    ## tokens left empty by cleansing
+    assert sorted(matched[1]) == []
+    assert matched[2] == [1]
+
+    tokens[3] = (['smith'], 3)
+    assert sorted(matcher.match(tokens)[1]) == [3, 4, 5]
+
+
+def make_link_heavy_stream_item(num_links, words_per_link=3):
+    '''a page that is nothing but anchors, each labeled at BYTES
+    offsets the way hyperlink_labels does'''
+    tagger_id = 'test_tagger'
+    annotator_id = 'author'
+    si = make_stream_item(0, '')
+    tokens = []
+    offset = 0
+    for link in xrange(num_links):
+        value = ' '.join('w%d_%d' % (link, w) for w in xrange(words_per_link))
+        label = Label(annotator=Annotator(annotator_id=annotator_id),
+                      target=Target(target_id='http://x.com/%d' % link),
+                      offsets={OffsetType.BYTES: Offset(
+                          type=OffsetType.BYTES, first=offset,
+                          length=len(value), value=value)})
+        add_annotation(si.body, label)
+        for word in value.split(' '):
+            tokens.append(Token(token=word, offsets={OffsetType.BYTES: Offset(
+                type=OffsetType.BYTES, first=offset, length=len(word))}))
+            offset += len(word) + 1
+    si.body.sentences[tagger_id] = [Sentence(tokens=tokens)]
+    return si, dict(tagger_id=tagger_id, annotator_id=annotator_id)
+
+
+def test_byte_offset_labels_link_heavy():
+    si, aligner_data = make_link_heavy_stream_item(50)
+    byte_offset_labels(si, aligner_data)
+    for tok in si.body.sentences['test_tagger'][0].tokens:
+        labels = tok.labels['author']
+        assert len(labels) == 1
+        link = int(tok.token[1:].split('_')[0])
+        assert labels[0].target.target_id == 'http://x.com/%d' % link
+
+
+@pytest.mark.slow
+def test_byte_offset_labels_link_heavy_benchmark():
+    num_links = 20000
+    si, aligner_data = make_link_heavy_stream_item(num_links)
+    start = time.time()
+    byte_offset_labels(si, aligner_data)
+    elapsed = time.time() - start
+    logger.info('aligned %d link labels in %.3f seconds (%.0f labels/sec)',
+                num_links, elapsed, num_links / elapsed)
+    assert all(tok.labels for tok in si.body.sentences['test_tagger'][0].tokens)
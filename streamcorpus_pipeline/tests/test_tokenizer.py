@@ -1,8 +1,13 @@
 
 from __future__ import absolute_import
-from streamcorpus import Annotator, Label, make_stream_item, Offset, \
+import copy
+
+import pytest
+
+from streamcorpus import Annotator, Chunk, Label, make_stream_item, Offset, \
     OffsetType, Target
-from streamcorpus_pipeline._tokenizer import nltk_tokenizer
+from streamcorpus_pipeline._tokenizer import nltk_tokenizer, \
+    nltk_tokenizer_batch
 
 def test_tokenizer():
     si = make_stream_item('2014-01-21T13:00:00.000Z',
@@ -102,3 +107,55 @@ def test_tokenizer_require_char_offset():
     si = t.process_item(si, {})
     assert all(tok.labels == {}
                for tok in si.body.sentences['nltk_tokenizer'][0].tokens)
+
+
+def test_tokenizer_byte_offsets():
+    si = make_stream_item('2014-01-21T13:00:00.000Z',
+                          'file:///test_tokenizer.py')
+    si.body.clean_visible = u'Caf\xe9 na\xefve \u2603 snow.'.encode('utf8')
+    t = nltk_tokenizer(config={})
+    si = t.process_item(si, {})
+    for tok in si.body.sentences['nltk_tokenizer'][0].tokens:
+        off = tok.offsets[OffsetType.BYTES]
+        assert si.body.clean_visible[off.first:off.first + off.length] == \
+            tok.token
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_tokenizer_batch(tmpdir, num_workers):
+    path = str(tmpdir.join('input.sc'))
+    chunk = Chunk(path=path, mode='wb')
+    expected = []
+    t = nltk_tokenizer(config={'annotator_id': 'author'})
+    for i in xrange(20):
+        si = make_stream_item('2014-01-21T13:00:00.000Z',
+                              'file:///test_tokenizer.py/%d' % i)
+        si.body.clean_visible = ('Document %d.  The president is John.' % i)
+        label = Label(annotator=Annotator(annotator_id='author'),
+                      target=Target(target_id='john'),
+                      offsets={OffsetType.CHARS:
+                               Offset(type=OffsetType.CHARS,
+                                      first=len(si.body.clean_visible) - 5,
+                                      length=4)})
+        si.body.labels = {'author': [label]}
+        chunk.add(si)
+        expected.append(t.process_item(copy.deepcopy(si), {})
+                        .body.sentences['nltk_tokenizer'])
+    ## documents without clean_visible pass through untouched
+    chunk.add(make_stream_item('2014-01-21T13:00:00.000Z',
+                               'file:///test_tokenizer.py/empty'))
+    chunk.close()
+
+    batch = nltk_tokenizer_batch(config={
+        'annotator_id': 'author', 'num_workers': num_workers,
+        'batch_size': 3, 'tmp_dir_path': str(tmpdir)})
+    try:
+        batch.process_path(path)
+    finally:
+        batch.shutdown()
+    sis = list(Chunk(path=path, mode='rb'))
+    assert len(sis) == 21
+    assert [si.body.sentences['nltk_tokenizer'] for si in sis[:20]] == \
+        expected
+    assert sis[19].body.sentences['nltk_tokenizer'][1].tokens[3].mention_id == 0
+    assert 'nltk_tokenizer' not in sis[20].body.sentences